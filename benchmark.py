@@ -0,0 +1,421 @@
+import os
+import sys
+import csv
+import json
+import time
+import random
+import platform
+import argparse
+import datetime
+import tempfile
+import statistics
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from openpyxl import Workbook
+from openpyxl.styles import Font
+
+import exporter
+
+
+# Этапы конвейера в порядке выполнения (имена попадают в файл результатов)
+STAGES = [
+    "load_raw_data",
+    "create_report_model",
+    "apply_derived_columns",
+    "compute_aggregated_row",
+    "fill_template",
+    "save_xlsx",
+    "export_to_pdf",
+]
+
+# Заголовки raw-выгрузки для каждой категории (как в шаблоне temp1.xlsx)
+RAW_HEADERS = {
+    "Balances": [
+        ["USDT Balances"],
+        ["User ID", "Margin Balance", "MM", "IM", "Equity", "Available Balance",
+         "Monthly Deposit", "Monthly Withdrawals", "Monthly Net Deposit"],
+    ],
+    "Trading Summary": [
+        ["USDT Monthly Trading Summary"],
+        ["User ID", "Aggregated", None, None, "Perpetuals", None, None, "Options"],
+        [None] + ["Total Volume", "Taker Volume", "Maker Volume"] * 3,
+    ],
+    "Fees Summary": [
+        ["USDT Monthly Fees Summary"],
+        ["User ID", "Aggregated", None, None, "Perpetuals", None, None, "Options"],
+        [None] + ["Total Fees", "Taker Fees", "Maker Fees"] * 3,
+    ],
+    "Positions": [
+        ["USDT Positions"],
+        ["User ID", "Instrument", "Size", "Value", "Index", "Mark", "Type (Perpetual / Option)", "Direction"],
+    ],
+}
+
+
+# =============================================================
+# Генератор синтетических raw-файлов
+# =============================================================
+def iter_synthetic_rows(users, positions, extra_columns=0, seed=0):
+    """
+    Строки синтетической raw-выгрузки в том порядке, который ожидает load_raw_data:
+    строка с названием категории в первой ячейке, затем дублирующие заголовки (их удаляют deletion_rules)
+    и строки данных; между категориями – пустая строка.
+      - users – число пользователей (строк в Balances, Trading Summary и Fees Summary),
+      - positions – число строк в Positions,
+      - extra_columns – дополнительные числовые столбцы в конце каждой строки Positions (широкие выгрузки).
+    Числа в Balances выдаются строками, как в реальной выгрузке, остальные – числами.
+    """
+    rnd = random.Random(seed)
+    user_ids = [100000 + u for u in range(max(users, 1))]
+
+    yield ["Balances"]
+    yield from RAW_HEADERS["Balances"]
+    for user_id in user_ids[:users]:
+        yield [user_id] + [f"{rnd.uniform(0, 1e6):.2f}" for _ in range(8)]
+    yield []
+
+    for category in ("Trading Summary", "Fees Summary"):
+        yield [category]
+        yield from RAW_HEADERS[category]
+        for user_id in user_ids[:users]:
+            yield [user_id] + [round(rnd.uniform(0, 1e7), 2) for _ in range(9)]
+        yield []
+
+    yield ["Positions"]
+    yield from RAW_HEADERS["Positions"]
+    instruments = ["BTCUSD-PERP", "ETHUSD-PERP", "BTCUSD-27JUN25-100000-C", "ETHUSD-27JUN25-3000-P"]
+    for p in range(positions):
+        instrument = instruments[p % len(instruments)]
+        row = [
+            user_ids[p % len(user_ids)],
+            instrument,
+            round(rnd.uniform(-50, 50), 4),
+            round(rnd.uniform(0, 1e6), 2),
+            round(rnd.uniform(1e3, 1e5), 2),
+            round(rnd.uniform(1e3, 1e5), 2),
+            "Perpetual" if instrument.endswith("PERP") else "Option",
+            "Long" if p % 2 else "Short",
+        ]
+        row += [round(rnd.uniform(0, 1e4), 2) for _ in range(extra_columns)]
+        yield row
+
+
+def generate_raw_workbook(path, users, positions, extra_columns=0, seed=0):
+    """
+    Записывает синтетический raw-файл (см. iter_synthetic_rows) в формате по расширению path:
+      - .xlsx – лист в режиме write_only, поэтому генерация больших файлов не упирается в память,
+      - .csv – та же раскладка строк,
+      - .parquet – таблица со столбцом "category" без разделителей и дублирующих заголовков (нужен pyarrow).
+    """
+    extension = os.path.splitext(path)[1].lower()
+    rows = iter_synthetic_rows(users, positions, extra_columns, seed)
+    if extension == ".xlsx":
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Report")
+        for row in rows:
+            ws.append(row)
+        wb.save(path)
+    elif extension == ".csv":
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            csv.writer(f).writerows(rows)
+    elif extension == ".parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        categories = exporter.get_report_settings()["categories"]
+        records, category, position = [], None, 0
+        for row in rows:
+            if row and row[0] in categories:
+                category, position = row[0], 0
+                continue
+            position += 1
+            if row and position > len(RAW_HEADERS[category]):  # без дублирующих заголовков
+                records.append([category] + row)
+        width = max(len(record) for record in records)
+        table = {}
+        for j in range(width):
+            values = [record[j] if j < len(record) else None for record in records]
+            present = [value for value in values if value is not None]
+            if all(isinstance(value, int) for value in present):
+                array_type = pa.int64()
+            elif all(isinstance(value, (int, float)) for value in present):
+                array_type = pa.float64()
+            else:
+                # Столбец общий для всех категорий: если где-то в нём текст, он хранится строками
+                array_type = pa.string()
+                values = [None if value is None else str(value) for value in values]
+            table["category" if j == 0 else f"c{j}"] = pa.array(values, type=array_type)
+        pq.write_table(pa.table(table), path)
+    else:
+        raise ValueError(f"Неподдерживаемый формат: {path}")
+
+
+# =============================================================
+# Замер этапов конвейера
+# =============================================================
+def run_pipeline_timed(raw_file, template_file, output_dir, settings, report_time):
+    """
+    Прогоняет конвейер отчёта для одного raw-файла, замеряя каждый этап отдельно (time.perf_counter).
+    Возвращает словарь { этап: секунды } в порядке STAGES.
+    """
+    categories = settings["categories"]
+    numeric_fields = settings["numeric_fields"]
+    filename = os.path.basename(raw_file)
+    timings = {}
+
+    def timed(stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+        return result
+
+    numeric_cols = exporter.raw_numeric_columns(template_file, categories, numeric_fields)
+    if settings["memory_budget_mb"]:
+        # Режим ограниченной памяти: загрузка и построение модели – один потоковый этап
+        rows = exporter.iter_raw_rows(raw_file, categories, settings["deletion_rules"], numeric_cols)
+        report = timed("load_raw_data", exporter.create_spilled_report_model, template_file, rows, categories,
+                       numeric_fields, settings["memory_budget_mb"], settings["spill_dir"])
+    else:
+        data_dict = timed("load_raw_data", exporter.load_raw_data, raw_file, categories, settings["deletion_rules"], numeric_cols)
+        report = timed("create_report_model", exporter.create_report_model, template_file, data_dict, categories, numeric_fields)
+    timed("apply_derived_columns", exporter.apply_derived_columns, report, filename, settings["derived_columns"])
+    for sheet_name, aggregate_all in (("Balances", False), ("Trading Summary", True), ("Fees Summary", True)):
+        if sheet_name in report.sheetnames:
+            header_rows = categories[sheet_name]
+            timed("compute_aggregated_row", exporter.compute_aggregated_row, report[sheet_name], header_rows,
+                  header_rows + 1, numeric_fields[sheet_name], indicator_header="User ID", aggregate_all=aggregate_all)
+    wb = timed("fill_template", exporter.fill_template, report, Font(bold=True, size=11))
+    timed("save_xlsx", exporter.save_workbook_stable, wb, os.path.join(output_dir, "report.xlsx"), report_time)
+    timed("export_to_pdf", exporter.export_to_pdf, report, settings["sheet_order"], os.path.join(output_dir, "report.pdf"),
+          settings["header_rows_pdf"], cover_company="Benchmark", report_time=report_time,
+          fast_rows_threshold=settings["pdf_fast_rows_threshold"])
+    report.close()
+    return {stage: timings[stage] for stage in STAGES if stage in timings}
+
+
+def pipeline_peak_rss(raw_file, template_file, output_dir, settings, report_time):
+    """Прогоняет конвейер (run_pipeline_timed) и возвращает пиковый RSS процесса в МБ."""
+    run_pipeline_timed(raw_file, template_file, output_dir, settings, report_time)
+    return exporter.peak_rss_mb()
+
+
+def measure_peak_rss(raw_file, template_file, output_dir, settings, report_time):
+    """
+    Пиковая память конвейера на одном raw-файле: отдельный прогон в новом процессе (spawn).
+    ru_maxrss – пик за всё время жизни процесса, поэтому в процессе бенчмарка он показывал бы наибольший пик
+    всех предыдущих размеров. В значение входит и сам интерпретатор с импортированными модулями.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(pipeline_peak_rss, raw_file, template_file, output_dir, settings, report_time).result()
+
+
+# =============================================================
+# Замер запуска
+# =============================================================
+# Команды запуска exporter в отдельном процессе: импорт модуля и CLI без работы (--help)
+STARTUP_COMMANDS = {
+    "import": ["-c", "import exporter"],
+    "help": ["exporter.py", "--help"],
+}
+
+
+def measure_startup(repeat=3):
+    """
+    Время запуска exporter в отдельном процессе для каждой команды из STARTUP_COMMANDS (медиана repeat замеров, с)
+    и признак reportlab_on_import: загружается ли ReportLab уже при импорте (запуски без PDF не должны его загружать).
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    startup = {}
+    for name, command in STARTUP_COMMANDS.items():
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + command, cwd=script_dir, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            samples.append(time.perf_counter() - start)
+        startup[name] = {"median": statistics.median(samples), "samples": samples}
+    check = subprocess.run([sys.executable, "-c", "import sys, exporter; print('reportlab' in sys.modules)"],
+                           cwd=script_dir, check=True, capture_output=True, text=True)
+    startup["reportlab_on_import"] = check.stdout.strip() == "True"
+    return startup
+
+
+def git_revision():
+    """Текущая ревизия git (если скрипт запущен из репозитория), иначе None."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(sizes, template_file, repeat=3, users=None, extra_columns=0, work_dir=None, raw_format="xlsx",
+                  memory_budget_mb=None):
+    """
+    Для каждого размера (число строк Positions) генерирует raw-файл в формате raw_format (xlsx, csv или parquet)
+    и repeat раз прогоняет конвейер.
+    Для каждого этапа сохраняются все замеры и медиана; время на строку позволяет сравнивать размеры между собой.
+    memory_budget_mb – прогон в режиме ограниченной памяти (см. exporter.SpilledSheetModel).
+    Для каждого размера записывается и пиковая память (peak_rss_mb) – отдельным прогоном в новом процессе
+    (см. measure_peak_rss).
+    Возвращает словарь результатов, готовый к записи в JSON.
+    """
+    settings = exporter.get_report_settings()
+    settings["memory_budget_mb"] = memory_budget_mb
+    report_time = datetime.datetime(2000, 1, 1)
+    # В имени файла – клиент с производными столбцами, чтобы этап apply_derived_columns выполнялся полностью
+    clients = [client for specs in settings["derived_columns"].values() for spec in specs for client in spec.get("clients", ())]
+    client = clients[0] if clients else "bench"
+
+    results = {
+        "created": datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "raw_format": raw_format,
+        "memory_budget_mb": memory_budget_mb,
+        "startup": measure_startup(repeat),
+        "runs": [],
+    }
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        for rows in sizes:
+            n_users = users if users is not None else max(1, rows // 20)
+            raw_file = os.path.join(tmp_dir, f"mm-monthly-report-{client.lower()}-{rows}.{raw_format}")
+            print(f"Генерация raw-файла: {rows} позиций, {n_users} пользователей, доп. столбцов: {extra_columns}")
+            generate_raw_workbook(raw_file, n_users, rows, extra_columns=extra_columns, seed=rows)
+
+            samples = {stage: [] for stage in STAGES}
+            for i in range(repeat):
+                output_dir = os.path.join(tmp_dir, f"out-{rows}-{i}")
+                os.makedirs(output_dir)
+                for stage, seconds in run_pipeline_timed(raw_file, template_file, output_dir, settings, report_time).items():
+                    samples[stage].append(seconds)
+
+            output_dir = os.path.join(tmp_dir, f"out-{rows}-rss")
+            os.makedirs(output_dir)
+            peak_rss = measure_peak_rss(raw_file, template_file, output_dir, settings, report_time)
+
+            stages = {}
+            for stage, values in samples.items():
+                if values:
+                    median = statistics.median(values)
+                    stages[stage] = {"median": median, "min": min(values), "samples": values,
+                                     "us_per_row": median / rows * 1e6 if rows else None}
+            total = sum(stage["median"] for stage in stages.values())
+            results["runs"].append({"rows": rows, "users": n_users, "extra_columns": extra_columns,
+                                    "raw_file_bytes": os.path.getsize(raw_file), "total": total,
+                                    "peak_rss_mb": peak_rss, "stages": stages})
+    return results
+
+
+# =============================================================
+# Отчёт и сравнение прогонов
+# =============================================================
+def print_results(results):
+    """Печатает время запуска и таблицу медиан по этапам для каждого размера."""
+    startup = results.get("startup")
+    if startup:
+        print("Запуск: " + ", ".join(f"{name} {startup[name]['median']:.3f}s" for name in STARTUP_COMMANDS if name in startup)
+              + (" (ReportLab загружается при импорте)" if startup["reportlab_on_import"] else ""))
+    runs = results["runs"]
+    print(f"\n{'Этап':<26}" + "".join(f"{run['rows']:>14,}" for run in runs))
+    for stage in STAGES:
+        cells = "".join(f"{run['stages'][stage]['median']:>13.3f}s" if stage in run["stages"] else f"{'-':>14}"
+                        for run in runs)
+        print(f"{stage:<26}" + cells)
+    print(f"{'total':<26}" + "".join(f"{run['total']:>13.3f}s" for run in runs))
+    if all(run.get("peak_rss_mb") is not None for run in runs):
+        print(f"{'peak_rss_mb':<26}" + "".join(f"{run['peak_rss_mb']:>14.1f}" for run in runs))
+
+
+def check_scaling(results, tolerance=1.5):
+    """
+    Проверяет масштабирование: если при росте числа строк время этапа на строку растёт более чем в tolerance раз,
+    этап отмечается как нелинейный (например, квадратичные проходы по объединённым ячейкам или строкам).
+    Возвращает список предупреждений.
+    """
+    warnings = []
+    runs = sorted(results["runs"], key=lambda run: run["rows"])
+    for small, large in zip(runs, runs[1:]):
+        for stage in STAGES:
+            a, b = small["stages"].get(stage), large["stages"].get(stage)
+            if not a or not b or not a["us_per_row"] or a["median"] < 0.01:
+                continue
+            ratio = b["us_per_row"] / a["us_per_row"]
+            if ratio > tolerance:
+                warnings.append(f"{stage}: время на строку выросло в {ratio:.1f} раза "
+                                f"({small['rows']:,} -> {large['rows']:,} строк)")
+    return warnings
+
+
+def compare_results(baseline, results, threshold=1.2):
+    """
+    Сравнивает время запуска и медианы этапов с прошлым прогоном (одинаковые размеры).
+    Возвращает список регрессий: запуск и этапы, ставшие медленнее более чем в threshold раз.
+    """
+    regressions = []
+    old_startup, startup = baseline.get("startup") or {}, results.get("startup") or {}
+    for name in STARTUP_COMMANDS:
+        if name in old_startup and name in startup and startup[name]["median"] > old_startup[name]["median"] * threshold:
+            regressions.append(f"запуск ({name}): {old_startup[name]['median']:.3f}s -> {startup[name]['median']:.3f}s")
+    previous = {run["rows"]: run for run in baseline.get("runs", [])}
+    for run in results["runs"]:
+        old = previous.get(run["rows"])
+        if old is None:
+            continue
+        for stage, stats in run["stages"].items():
+            old_stats = old["stages"].get(stage)
+            if not old_stats or old_stats["median"] < 0.01:
+                continue
+            ratio = stats["median"] / old_stats["median"]
+            if ratio > threshold:
+                regressions.append(f"{stage} ({run['rows']:,} строк): {old_stats['median']:.3f}s -> "
+                                   f"{stats['median']:.3f}s (x{ratio:.2f})")
+    return regressions
+
+
+# =============================================================
+# Точка входа
+# =============================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера отчётов на синтетических raw-файлах.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="число строк Positions для каждого прогона (по умолчанию 1000 10000 100000)")
+    parser.add_argument("--users", type=int, default=None,
+                        help="число пользователей (по умолчанию – 1 на 20 позиций)")
+    parser.add_argument("--extra-columns", type=int, default=0, help="дополнительные числовые столбцы в Positions")
+    parser.add_argument("--format", choices=["xlsx", "csv", "parquet"], default="xlsx",
+                        help="формат синтетического raw-файла (parquet требует pyarrow)")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="прогон в режиме ограниченной памяти с указанным бюджетом, МБ")
+    parser.add_argument("--repeat", type=int, default=3, help="число повторов каждого размера (берётся медиана)")
+    parser.add_argument("--template", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp1.xlsx"),
+                        help="путь к шаблону (по умолчанию temp1.xlsx рядом со скриптом)")
+    parser.add_argument("--output", default="benchmark_results.json", help="файл для результатов в формате JSON")
+    parser.add_argument("--compare", default=None, metavar="JSON",
+                        help="файл с прошлыми результатами для сравнения; при регрессиях код возврата 1")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="во сколько раз этап может замедлиться относительно --compare (по умолчанию 1.2)")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.template, repeat=args.repeat, users=args.users,
+                            extra_columns=args.extra_columns, raw_format=args.format,
+                            memory_budget_mb=args.memory_budget)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print_results(results)
+    print(f"\nРезультаты сохранены: {args.output}")
+
+    for warning in check_scaling(results):
+        print("Нелинейный рост:", warning)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare_results(json.load(f), results, args.threshold)
+        for regression in regressions:
+            print("Регрессия:", regression)
+        if regressions:
+            sys.exit(1)
+        print("Регрессий относительно", args.compare, "нет.")
@@ -1,641 +1,3806 @@
 import os
+import sys
+import time
+import csv
 import datetime
-from openpyxl import load_workbook
-from openpyxl.styles import Font
-
-# Импортируем модули ReportLab для экспорта в PDF
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_CENTER
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-
-
-# Регистрируем шрифт Calibri (убедитесь, что путь к Calibri.ttf указан правильно)
-pdfmetrics.registerFont(TTFont('Calibri', 'Calibri.ttf'))
-
-
-def process_exception_column(wb, filename, exceptions_list, sheet_name="Balances", header_row=2):
-    """
-    Если имя файла (filename) содержит одно из слов из exceptions_list (без учёта регистра),
-    то для листа sheet_name (по умолчанию "Balances") выполняется следующее:
-      1. Находится столбец с заголовком "IM" в строке заголовков (header_row).
-      2. Если сразу после него (то есть в столбце с индексом IM+1) уже не стоит заголовок "Trading credits",
-         то вставляется новый столбец в эту позицию.
-      3. В новой колонке в заголовке устанавливается "Trading credits".
-      4. Для всех строк с данными (начиная со строки header_row+1) в этой колонке устанавливается значение 1,000,000.00.
-      5. Затем для каждой строки пересчитывается значение в колонке "Equity" как:
-             Equity = Margin Balance - Trading credits
-         (учтите, что после вставки столбец "Equity" смещается на одну позицию вправо, если он находился правее "IM").
-    """
-    # Проверяем наличие исключения в имени файла (без учёта регистра)
-    if not any(exc.lower() in filename.lower() for exc in exceptions_list):
-        return  # Если имя файла не содержит ни одного из исключений, выходим
-
-    if sheet_name not in wb.sheetnames:
-        print(f"Лист '{sheet_name}' не найден в книге.")
-        return
+import io
+import shutil
+import tempfile
+import pickle
+import json
+import math
+import re
+import hashlib
+import importlib
+import weakref
+from array import array
+import argparse
+import traceback
+import queue
+import signal
+import threading
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from types import SimpleNamespace
+from copy import copy
+from itertools import chain
+from fractions import Fraction
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, is_zipfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit, parse_qs, quote
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.writer.excel import ExcelWriter
+from openpyxl.styles import Font, PatternFill
+
+# Модули ReportLab для экспорта в PDF импортируются при первом экспорте (см. load_reportlab):
+# запуски без PDF (например, --xlsx-only) их не загружают
+_REPORTLAB = None
+
+# Пиковая память процесса (ru_maxrss) доступна только на Unix; на Windows модуля resource нет
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Необязательные зависимости импортируются при первом использовании (см. optional_import):
+#   pyarrow.parquet – чтение raw-выгрузок в формате Parquet (см. iter_parquet_rows);
+#   watchdog.observers – уведомления файловой системы (inotify, ReadDirectoryChangesW, FSEvents) для режима
+#     наблюдения; без него папка опрашивается с интервалом (см. watch_raw_files);
+#   pypdf – склейка PDF-фрагментов листов при параллельном экспорте в PDF (см. export_to_pdf).
+_OPTIONAL_MODULES = {}
+
+# Шрифт таблиц PDF (регистрируется при первом экспорте в PDF, см. load_reportlab): путь относительно
+# текущей папки или абсолютный; можно задать переменной окружения CC_REPORT_FONT (см. --font)
+PDF_FONT_ENV = "CC_REPORT_FONT"
+PDF_FONT_FILE = os.environ.get(PDF_FONT_ENV, "Calibri.ttf")
+
+# Папка с данными по умолчанию (raw_data, template, result)
+BASE_FOLDER = r"C:\Users\_\Desktop\CC_report"
 
-    ws = wb[sheet_name]
 
-    # Считываем заголовочную строку (header_row)
-    header_cells = list(ws[header_row])
+# =============================================================
+# Загрузка зависимостей по требованию
+# =============================================================
+def optional_import(name):
+    """Необязательный модуль name, импортированный при первом обращении, или None, если он не установлен."""
+    try:
+        return _OPTIONAL_MODULES[name]
+    except KeyError:
+        pass
+    try:
+        module = importlib.import_module(name)
+    except ImportError:
+        module = None
+    _OPTIONAL_MODULES[name] = module
+    return module
+
+
+def load_reportlab():
+    """
+    Модули ReportLab для экспорта в PDF: rl = load_reportlab(), далее rl.Paragraph, rl.colors и т. д.
+    (а также rl.SpilledTable из pdf_tables). При первом вызове импортирует их и регистрирует шрифт Calibri
+    (PDF_FONT_FILE) – один раз на процесс. Файл шрифта разбирается один раз; в каждый PDF встраивается только
+    подмножество использованных символов.
+    """
+    global _REPORTLAB
+    if _REPORTLAB is not None:
+        return _REPORTLAB
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate, Table, LongTable, TableStyle, Paragraph, Spacer, PageBreak
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.lib.enums import TA_CENTER
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfbase import pdfmetrics
+    from pdf_tables import SpilledTable
+    pdfmetrics.registerFont(TTFont('Calibri', PDF_FONT_FILE))
+    # Присваивается последним: признак того, что ReportLab загружен и шрифт зарегистрирован
+    _REPORTLAB = SimpleNamespace(
+        colors=colors, A4=A4, SimpleDocTemplate=SimpleDocTemplate, Table=Table, LongTable=LongTable,
+        TableStyle=TableStyle, Paragraph=Paragraph, Spacer=Spacer, PageBreak=PageBreak,
+        ParagraphStyle=ParagraphStyle, TA_CENTER=TA_CENTER, pdfmetrics=pdfmetrics, SpilledTable=SpilledTable)
+    return _REPORTLAB
 
-    im_index = None
-    margin_index = None
-    equity_index = None
 
-    # Определяем номера столбцов по заголовкам (сравниваем без учета регистра и пробелов)
-    for cell in header_cells:
-        if cell.value is not None:
-            val = str(cell.value).strip().lower()
-            if val == "im":
-                im_index = cell.column  # 1-индексация
-            elif val == "margin balance":
-                margin_index = cell.column
-            elif val == "equity":
-                equity_index = cell.column
+# =============================================================
+# Индекс заголовков листа (SheetSchema)
+# =============================================================
+def normalize_header(value):
+    """Нормализует заголовок для поиска: без учёта регистра, крайних и повторяющихся пробелов."""
+    if value is None:
+        return ""
+    return " ".join(str(value).split()).lower()
 
-    if im_index is None:
-        print("Столбец 'IM' не найден в заголовке листа.")
-        return
-    if margin_index is None:
-        print("Столбец 'Margin Balance' не найден в заголовке листа.")
-        return
-    if equity_index is None:
-        print("Столбец 'Equity' не найден в заголовке листа.")
-        return
 
-    # Проверяем, не существует ли уже столбец "Trading credits" сразу после "IM".
-    # Если заголовок в ячейке с индексом (im_index + 1) равен "Trading credits", то ничего не делаем.
-    next_cell = ws.cell(row=header_row, column=im_index + 1).value
-    if next_cell is not None and str(next_cell).strip().lower() == "trading credits":
-        print("Столбец 'Trading credits' уже существует. Обновляем его данные...")
-        trading_credits_index = im_index + 1
-    else:
-        # Вставляем новый столбец после "IM" (то есть в позиции im_index + 1)
-        ws.insert_cols(im_index + 1)
-        # Записываем заголовок "Trading credits" в строке заголовков
-        ws.cell(row=header_row, column=im_index + 1, value="Trading credits")
-        trading_credits_index = im_index + 1
-        # Обновляем индексы столбцов для тех, что находятся правее новой колонки.
-        # Если Equity находился правее "IM", то его новый индекс увеличивается на 1.
-        if equity_index > im_index:
-            equity_index += 1
-
-    # # Записываем значение Trading credits (1,000,000.00) для каждой строки с данными (начиная со строки header_row+1)
-    for r in range(header_row + 1, ws.max_row + 1):
-        cell = ws.cell(row=r, column=trading_credits_index)
-        cell.value = 0.00
-        cell.number_format = "#,##0.00"
-
-    # Пересчитываем Equity для каждой строки:
-    # Equity = Margin Balance - Trading credits
-    for r in range(header_row + 1, ws.max_row + 1):
-        try:
-            margin_val = float(ws.cell(row=r, column=margin_index).value)
-        except (TypeError, ValueError):
-            margin_val = 0.0
+class SheetSchema:
+    """
+    Индекс заголовочного блока листа (строки 1..header_rows), строится один раз на лист.
+      - find(name) – номер первого столбца по нормализованному имени заголовка
+        (поиск по всем строкам блока, порядок – построчно сверху вниз, слева направо);
+      - label(col) – "листовой" заголовок столбца: нижнее непустое значение в блоке.
+    Многострочные объединённые заголовки учитываются: значение верхней левой ячейки объединённого
+    диапазона распространяется на все его ячейки внутри блока (например, "User ID" в A2:A3).
+    Изменять заголовочный блок следует через insert_cols/set_header/merge_down схемы – тогда индекс остаётся корректным.
+    """
+
+    def __init__(self, ws, header_rows):
+        self.ws = ws
+        self.header_rows = header_rows
+        self._build()
+
+    def _build(self):
+        ws = self.ws
+        grid = {}
+        for r in range(1, self.header_rows + 1):
+            for cell in ws[r]:
+                if cell.value is not None and str(cell.value).strip() != "":
+                    grid[(r, cell.column)] = str(cell.value).strip()
+        for merged_range in ws.merged_cells.ranges:
+            if merged_range.min_row > self.header_rows:
+                continue
+            value = grid.get((merged_range.min_row, merged_range.min_col))
+            if value is None:
+                continue
+            for r in range(merged_range.min_row, min(merged_range.max_row, self.header_rows) + 1):
+                for c in range(merged_range.min_col, merged_range.max_col + 1):
+                    grid.setdefault((r, c), value)
+
+        self._columns = {}
+        self._labels = {}
+        self._paths = {}
+        for (r, c), value in sorted(grid.items()):
+            columns = self._columns.setdefault(normalize_header(value), [])
+            if c not in columns:
+                columns.append(c)
+            self._labels[c] = value  # строки идут сверху вниз – остаётся нижнее значение
+            path = self._paths.setdefault(c, [])
+            if r > 1 and (not path or path[-1] != value):
+                path.append(value)  # строка 1 – название листа
+
+    def find(self, name):
+        """Номер первого столбца с заголовком name или None."""
+        columns = self._columns.get(normalize_header(name))
+        return columns[0] if columns else None
+
+    def label(self, col):
+        """Нижний непустой заголовок столбца col или None."""
+        return self._labels.get(col)
+
+    def header_path(self, col):
+        """
+        Полный заголовок столбца col по строкам блока под названием листа (строка 1), через " / ",
+        например "Perpetuals / Taker Volume"; объединённые по вертикали заголовки не повторяются.
+        """
+        return " / ".join(self._paths.get(col, []))
+
+    def find_path(self, name):
+        """
+        Номер столбца по полному заголовку (см. header_path), например "Perpetuals / Taker Volume",
+        а если такого нет – по имени заголовка (find).
+        """
+        wanted = normalize_header(name)
+        for c, path in sorted(self._paths.items()):
+            if normalize_header(" / ".join(path)) == wanted:
+                return c
+        return self.find(name)
+
+    def group_end(self, col):
+        """
+        Последний столбец группы заголовков, в которую входит col: объединённой по горизонтали ячейки
+        между названием листа (строка 1) и нижней строкой блока, например "Aggregated" в B2:D2.
+        Для столбца вне группы – сам col.
+        """
+        end = col
+        for mr in self.ws.merged_cells.ranges:
+            if 1 < mr.min_row and mr.max_row < self.header_rows and mr.min_col <= col <= mr.max_col:
+                end = max(end, mr.max_col)
+        return end
+
+    def merge_down(self, row, col):
+        """Объединяет ячейки столбца col от строки row до нижней строки блока (как "User ID" в A2:A3)."""
+        if row < self.header_rows:
+            self.ws.merge_cells(start_row=row, start_column=col, end_row=self.header_rows, end_column=col)
+            self._build()
+
+    def columns_with_label(self, names):
+        """Номера столбцов (по возрастанию), чей нижний заголовок входит в names."""
+        wanted = {normalize_header(name) for name in names}
+        return [c for c, value in sorted(self._labels.items()) if normalize_header(value) in wanted]
+
+    def set_header(self, row, col, value):
+        """Записывает заголовок в ячейку (row, col) блока и обновляет индекс."""
+        self.ws.cell(row=row, column=col, value=value)
+        self._build()
+
+    def insert_cols(self, idx, amount=1):
+        """
+        Вставляет столбцы перед idx только в заголовочном блоке (строки 1..header_rows): ячейки правее сдвигаются,
+        новые ячейки получают стиль столбца слева, объединённые диапазоны правее сдвигаются, а пересекающие idx
+        (например, название листа в A1:I1) – расширяются. Строки ниже блока не затрагиваются: данные листа
+        хранятся в модели (SheetModel), поэтому ws.insert_cols, переписывающий все ячейки листа, не нужен.
+        """
+        ws = self.ws
+        max_col = ws.max_column
+        merged = [copy(mr) for mr in ws.merged_cells.ranges if mr.min_row <= self.header_rows]
+        for mr in merged:
+            ws.unmerge_cells(mr.coord)
+        for r in range(1, self.header_rows + 1):
+            for c in range(max_col, idx - 1, -1):
+                src = ws.cell(row=r, column=c)
+                dst = ws.cell(row=r, column=c + amount)
+                dst.value = src.value
+                dst._style = copy(src._style)
+            for c in range(idx, idx + amount):
+                cell = ws.cell(row=r, column=c)
+                cell.value = None
+                if idx > 1:
+                    cell._style = copy(ws.cell(row=r, column=idx - 1)._style)
+        for mr in merged:
+            if mr.min_col >= idx:
+                mr.shift(col_shift=amount)
+            elif mr.max_col >= idx:
+                mr.expand(right=amount)
+            ws.merge_cells(mr.coord)
+        self._build()
+
+
+# Схемы уже проиндексированных листов: лист -> SheetSchema
+_SHEET_SCHEMAS = weakref.WeakKeyDictionary()
+
+
+def sheet_schema(ws, header_rows=None):
+    """
+    Возвращает SheetSchema листа ws, построенную один раз и переиспользуемую всеми функциями.
+    Если header_rows не задан, возвращает уже построенную схему (или None).
+    """
+    schema = _SHEET_SCHEMAS.get(ws)
+    if header_rows is None or (schema is not None and schema.header_rows == header_rows):
+        return schema
+    schema = SheetSchema(ws, header_rows)
+    _SHEET_SCHEMAS[ws] = schema
+    return schema
+
+
+# =============================================================
+# Модель отчёта в памяти: между загрузкой raw-данных и выводом в xlsx/PDF
+# =============================================================
+NUMBER_FORMAT = "#,##0.00"
+
+
+class ReportColumn:
+    """
+    Типизированный столбец данных листа.
+    Числовой столбец (numeric=True) хранит значения в array('d'); ячейки, которые не приводятся к float
+    (пустые, текст), хранятся как NaN, а их исходные значения – в словаре raw (индекс строки -> значение).
+    В готовом array('d') (результат формулы) NaN означает «нет значения» – такие ячейки выводятся пустыми.
+    Текстовый столбец хранит значения списком как есть.
+    """
+
+    def __init__(self, numeric=False, values=()):
+        self.numeric = numeric
+        self.values = array("d") if numeric else []
+        self.raw = {}
+        if numeric and isinstance(values, array) and values.typecode == "d":
+            self.values = values  # готовый числовой столбец (например, результат формулы) – без копирования
+            self.raw = {i: None for i, value in enumerate(values) if value != value}
+            return
+        for value in values:
+            self.append(value)
+
+    def append(self, value):
+        if not self.numeric:
+            self.values.append(value)
+            return
+        if value.__class__ is float or value.__class__ is int:
+            self.values.append(value)
+            return
+        number = to_number(value)
+        if number is None:
+            self.raw[len(self.values)] = value
+            number = float("nan")
+        self.values.append(number)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if self.numeric and i in self.raw:
+            return self.raw[i]
+        return self.values[i]
+
+    def is_number(self, i):
+        """Значение i – число, приведённое к float (выводится в формате "#,##0.00")."""
+        return self.numeric and i not in self.raw
+
+    def numbers(self):
+        """Значения столбца как array('d') с NaN на месте нечисловых ячеек (для агрегации)."""
+        if self.numeric:
+            return self.values
+        nan = float("nan")
+        return array("d", (nan if number is None else number for number in map(to_number, self.values)))
+
+    def delete(self, start, count):
+        """Удаляет строки start..start+count-1."""
+        del self.values[start:start + count]
+        if self.raw:
+            self.raw = {i if i < start else i - count: v for i, v in self.raw.items()
+                        if not start <= i < start + count}
+
+
+class SheetModel:
+    """
+    Лист отчёта в памяти.
+      - ws – лист книги-шаблона: заголовочный блок (строки 1..header_rows) со стилями и объединёнными ячейками;
+      - columns – типизированные столбцы данных (columns[0] – столбец A), все одной длины n_rows;
+      - summary – агрегированная строка { номер столбца: (значение, числовой формат) } или None.
+    Номера строк и столбцов в методах – как на листе Excel: данные начинаются со строки header_rows + 1.
+    """
+
+    def __init__(self, ws, header_rows, columns=None, n_rows=0):
+        self.ws = ws
+        self.title = ws.title
+        self.header_rows = header_rows
+        self.columns = columns or []
+        self.n_rows = n_rows
+        self.summary = None
+
+    @property
+    def schema(self):
+        return sheet_schema(self.ws, self.header_rows)
+
+    @property
+    def width(self):
+        """Число столбцов листа: по заголовкам шаблона и по данным."""
+        return max(self.ws.max_column, len(self.columns))
+
+    @property
+    def max_row(self):
+        """Номер последней строки листа (с учётом агрегированной строки)."""
+        return self.header_rows + self.n_rows + (1 if self.summary is not None else 0)
+
+    def value(self, i, col):
+        """Значение строки данных i (с 0) в столбце col (с 1)."""
+        if col > len(self.columns):
+            return None
+        return self.columns[col - 1][i]
+
+    def row_cells(self, i):
+        """Строка данных i (с 0): [(значение, числовой формат) ...] по столбцам модели."""
+        return [(column[i], NUMBER_FORMAT if column.is_number(i) else "General") for column in self.columns]
+
+    def numbers(self, col):
+        """Столбец col как array('d') с NaN на месте нечисловых значений."""
+        return column_numbers(self.columns, col, self.n_rows)
+
+    def column_chunks(self):
+        """
+        Данные листа порциями строк: пары (число строк, [столбцы порции]). Лист в памяти – одна порция;
+        листы с данными на диске (SpilledSheetModel) выдают порции по очереди.
+        """
+        yield self.n_rows, self.columns
+
+    def derived_column(self, inputs, formula):
+        """Производный столбец: formula от числовых столбцов inputs (номера с 1), вычисляется сразу."""
+        return ReportColumn(numeric=True, values=formula(*(self.numbers(col) for col in inputs)))
+
+    def set_column(self, col, column):
+        """Заменяет столбец col (с 1); при необходимости дополняет лист пустыми столбцами."""
+        while len(self.columns) < col:
+            self.columns.append(ReportColumn(values=[None] * self.n_rows))
+        self.columns[col - 1] = column
+
+    def insert_column(self, col, header_row, header, column=None):
+        """
+        Вставляет столбец перед col: в заголовочный блок шаблона (через SheetSchema – это всего несколько строк)
+        и в данные; в строку header_row записывается заголовок header.
+        """
+        self.schema.insert_cols(col)
+        self.schema.set_header(header_row, col, header)
+        while len(self.columns) < col - 1:
+            self.columns.append(ReportColumn(values=[None] * self.n_rows))
+        self.columns.insert(col - 1, column or ReportColumn(values=[None] * self.n_rows))
+        if self.summary:
+            self.summary = {(c + 1 if c >= col else c): v for c, v in self.summary.items()}
+
+    def delete_rows(self, idx, amount=1):
+        """Удаляет строки данных idx..idx+amount-1 (номера строк листа)."""
+        if idx <= self.header_rows:
+            raise ValueError(f"Удаление заголовочных строк листа '{self.title}' не поддерживается (строка {idx}).")
+        start = idx - self.header_rows - 1
+        count = max(0, min(amount, self.n_rows - start))
+        for column in self.columns:
+            column.delete(start, count)
+        self.n_rows -= count
+
+    def iter_cells(self, fills=True):
+        """
+        Выдаёт строки листа для вывода: (номер строки, [(значение, числовой формат, цвет заливки) ...]),
+        каждая строка дополнена до width столбцов. Заголовки берутся из шаблона, данные – из столбцов модели.
+        fills=False – без цветов заливки (None): для записи xlsx они не нужны, а ReportLab не загружается.
+        """
+        width = self.width
+        for row in self.ws.iter_rows(min_row=1, max_row=self.header_rows, max_col=width):
+            yield row[0].row, [(cell.value, cell.number_format, solid_fill_color(cell) if fills else None)
+                               for cell in row]
+        row_num = self.header_rows + 1
+        for n, columns in self.column_chunks():
+            padding = [(None, "General", None)] * (width - len(columns))
+            for i in range(n):
+                cells = []
+                for column in columns:
+                    value = column[i]
+                    cells.append((value, NUMBER_FORMAT if column.is_number(i) else "General", None))
+                yield row_num, cells + padding
+                row_num += 1
+        if self.summary is not None:
+            yield self.max_row, [self.summary.get(col, (None, "General")) + (None,) for col in range(1, width + 1)]
+
+
+class ReportModel:
+    """
+    Отчёт клиента в памяти: книга-шаблон (заголовки, стили, служебные листы) и модели листов категорий.
+    Поддерживает sheetnames и доступ по имени листа, как книга openpyxl.
+    """
+
+    def __init__(self, workbook):
+        self.workbook = workbook
+        self.sheets = {}
+
+    def __setstate__(self, state):
+        # Модель передаётся между процессами конвейера (см. run_pipeline) через pickle
+        self.__dict__.update(state)
+        restore_dimension_factories(self.workbook)
+
+    @property
+    def sheetnames(self):
+        return list(self.sheets)
+
+    def __getitem__(self, name):
+        return self.sheets[name]
+
+    def __contains__(self, name):
+        return name in self.sheets
+
+    def close(self):
+        """Удаляет файлы порций листов с данными на диске (режим ограниченной памяти, см. SpilledSheetModel)."""
+        for sheet in self.sheets.values():
+            if isinstance(sheet, SpilledSheetModel):
+                sheet.store.remove()
+
+
+def column_numbers(columns, col, n_rows):
+    """Столбец col (с 1) из списка столбцов как array('d'); отсутствующий столбец – n_rows значений NaN."""
+    if col > len(columns):
+        return array("d", [float("nan")]) * n_rows
+    return columns[col - 1].numbers()
+
+
+def build_columns(rows, numeric_cols):
+    """
+    Переводит строки данных в типизированные столбцы (ReportColumn) одной длины; короткие строки
+    дополняются None. numeric_cols – номера числовых столбцов (с 1).
+    """
+    width = max((len(row) for row in rows), default=0)
+    columns = [ReportColumn(numeric=(j in numeric_cols)) for j in range(1, width + 1)]
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(value)
+        for column in columns[len(row):]:
+            column.append(None)
+    return columns
+
+
+def create_report_model(template_file, data_dict, categories, numeric_fields):
+    """
+    Строит модель отчёта: копия шаблона (см. load_template) и типизированные столбцы данных для каждого листа.
+    Столбцы, чей заголовок (нижняя строка заголовочного блока) входит в numeric_fields, становятся числовыми.
+    """
+    wb = load_template(template_file)
+    report = ReportModel(wb)
+
+    for cat, header_rows in categories.items():
+        if cat not in wb.sheetnames:
+            print(f"Лист '{cat}' не найден в шаблоне. Пропускаем.")
+            continue
+
+        ws = wb[cat]
+        rows = data_dict[cat]
+        numeric_cols = set(sheet_schema(ws, header_rows).columns_with_label(numeric_fields.get(cat, [])))
+        report.sheets[cat] = SheetModel(ws, header_rows, build_columns(rows, numeric_cols), len(rows))
+
+    return report
+
+
+def report_model_from_columns(template_file, sheet_columns, categories):
+    """
+    Модель отчёта по готовым столбцам листов { категория: (число строк, столбцы) } – например,
+    из кэша разобранного raw-файла (см. load_raw_columns).
+    """
+    wb = load_template(template_file)
+    report = ReportModel(wb)
+
+    for cat, header_rows in categories.items():
+        if cat not in wb.sheetnames:
+            print(f"Лист '{cat}' не найден в шаблоне. Пропускаем.")
+            continue
+        n_rows, columns = sheet_columns[cat]
+        report.sheets[cat] = SheetModel(wb[cat], header_rows, columns, n_rows)
+
+    return report
+
+
+# =============================================================
+# Режим ограниченной памяти: данные листов порциями на диске
+# =============================================================
+# Оценка памяти на одну ячейку порции, байт: значение в строке raw-файла, в типизированном столбце,
+# pickle-запись и текст ячейки при выводе (см. spill_chunk_rows)
+SPILL_CELL_BYTES = 400
+# Минимальный размер порции, строк: при очень маленьком бюджете порции не дробятся до отдельных строк
+SPILL_MIN_CHUNK_ROWS = 256
+
+
+def spill_chunk_rows(memory_budget_mb, width):
+    """Число строк в порции листа шириной width столбцов, чтобы порция укладывалась в memory_budget_mb."""
+    return max(SPILL_MIN_CHUNK_ROWS, int(memory_budget_mb * 1024 * 1024) // (max(width, 1) * SPILL_CELL_BYTES))
+
+
+class SpillStore:
+    """
+    Строки данных одного листа на диске. Строки копятся порциями по chunk_rows, каждая порция переводится
+    в типизированные столбцы (см. build_columns) и дописывается pickle-записью во временный файл.
+    В памяти остаются только копящаяся порция и после загрузки (finish) – последняя порция листа (tail):
+    по ней распознаётся строка "Aggregated" из выгрузки (см. compute_aggregated_row).
+    Между процессами конвейера передаётся путь к файлу, а не его содержимое. Файл удаляет remove
+    (см. ReportModel.close); у копий в других процессах финализаторов нет.
+    """
+
+    def __init__(self, numeric_cols, chunk_rows, directory=None):
+        fd, self.path = tempfile.mkstemp(prefix="cc_report_", suffix=".spill", dir=directory)
+        os.close(fd)
+        self.numeric_cols = numeric_cols
+        self.chunk_rows = chunk_rows
+        self.offsets = []  # (смещение в файле, число строк) записанных порций
+        self.pending = []
+        self.tail = None   # (число строк, столбцы) последней порции
+        self.n_rows = 0
+        self.width = 0
+
+    def append(self, row):
+        self.pending.append(row)
+        self.n_rows += 1
+        if len(row) > self.width:
+            self.width = len(row)
+        if len(self.pending) >= self.chunk_rows:
+            self._write(len(self.pending), build_columns(self.pending, self.numeric_cols))
+            self.pending = []
+
+    def _write(self, n, columns):
+        with open(self.path, "ab") as f:
+            self.offsets.append((f.tell(), n))
+            pickle.dump(columns, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def finish(self):
+        """Завершает загрузку: последняя порция остаётся в памяти (tail)."""
+        if self.pending:
+            self.tail = (len(self.pending), build_columns(self.pending, self.numeric_cols))
+            self.pending = []
+        elif self.offsets:
+            offset, n = self.offsets.pop()
+            with open(self.path, "r+b") as f:
+                f.seek(offset)
+                self.tail = (n, pickle.load(f))
+                f.truncate(offset)
+
+    def chunks(self):
+        """Порции по порядку строк: (число строк, столбцы); с диска читается по одной порции."""
+        if self.offsets:
+            with open(self.path, "rb") as f:
+                for offset, n in self.offsets:
+                    f.seek(offset)
+                    yield n, pickle.load(f)
+        if self.tail is not None and self.tail[0]:
+            yield self.tail
+
+    def tail_start(self):
+        """Индекс (с 0) первой строки последней порции."""
+        return self.n_rows - (self.tail[0] if self.tail is not None else 0)
+
+    def delete_tail_rows(self, start, count):
+        """Удаляет строки start..start+count-1 (индексы листа с 0); они должны входить в последнюю порцию."""
+        first = self.tail_start()
+        if start < first:
+            raise ValueError(f"Строки до {first + 1}-й уже записаны на диск; удалять можно только последнюю порцию.")
+        n, columns = self.tail
+        for column in columns:
+            column.delete(start - first, count)
+        self.tail = (n - count, columns)
+        self.n_rows -= count
+
+    def remove(self):
         try:
-            equity_val = float(ws.cell(row=r, column=equity_index).value)
-        except (TypeError, ValueError):
-            equity_val = 0.0
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class DerivedColumn:
+    """Производный столбец листа с данными на диске: formula от столбцов inputs, вычисляется для каждой порции."""
+
+    def __init__(self, inputs, formula):
+        self.inputs = inputs    # элементы раскладки столбцов (см. SpilledSheetModel.layout)
+        self.formula = formula
+
+
+class SpilledSheetModel(SheetModel):
+    """
+    Лист отчёта с данными на диске (SpillStore) для режима ограниченной памяти (settings["memory_budget_mb"]).
+    Столбцы листа описываются раскладкой layout: номер столбца порции на диске, DerivedColumn или None
+    (пустой столбец), поэтому вставка производных столбцов не переписывает данные. Запись xlsx, агрегаты
+    и PDF читают данные порциями (column_chunks); память не зависит от числа строк листа.
+    Произвольный доступ к строкам есть только для последней порции (value, row_cells, delete_rows).
+    """
+
+    def __init__(self, ws, header_rows, store):
+        super().__init__(ws, header_rows, n_rows=store.n_rows)
+        self.store = store
+        self.layout = list(range(store.width))
+
+    @property
+    def width(self):
+        return max(self.ws.max_column, len(self.layout))
+
+    def _materialize(self, n, stored):
+        """Столбцы порции по раскладке: столбцы с диска как есть, производные – вычисляются."""
+        derived = {}
+
+        def resolve(entry):
+            if isinstance(entry, DerivedColumn):
+                if id(entry) not in derived:
+                    inputs = (resolve(item).numbers() for item in entry.inputs)
+                    derived[id(entry)] = ReportColumn(numeric=True, values=entry.formula(*inputs))
+                return derived[id(entry)]
+            if entry is None or entry >= len(stored):
+                return ReportColumn(values=[None] * n)
+            return stored[entry]
+
+        return [resolve(entry) for entry in self.layout]
+
+    def column_chunks(self):
+        for n, stored in self.store.chunks():
+            yield n, self._materialize(n, stored)
+
+    def _tail_columns(self, i):
+        start = self.store.tail_start()
+        if i < start:
+            raise ValueError(f"Строка {i + 1} листа '{self.title}' уже записана на диск; доступна только последняя порция.")
+        n, stored = self.store.tail
+        return self._materialize(n, stored), i - start
+
+    def value(self, i, col):
+        columns, i = self._tail_columns(i)
+        return columns[col - 1][i] if col <= len(columns) else None
+
+    def row_cells(self, i):
+        columns, i = self._tail_columns(i)
+        return [(column[i], NUMBER_FORMAT if column.is_number(i) else "General") for column in columns]
+
+    def numbers(self, col):
+        raise ValueError(f"Данные листа '{self.title}' хранятся порциями на диске; используйте column_chunks.")
+
+    def derived_column(self, inputs, formula):
+        return DerivedColumn([self.layout[col - 1] if col <= len(self.layout) else None for col in inputs], formula)
+
+    def set_column(self, col, column):
+        while len(self.layout) < col:
+            self.layout.append(None)
+        self.layout[col - 1] = column
+
+    def insert_column(self, col, header_row, header, column=None):
+        self.schema.insert_cols(col)
+        self.schema.set_header(header_row, col, header)
+        while len(self.layout) < col - 1:
+            self.layout.append(None)
+        self.layout.insert(col - 1, column)
+        if self.summary:
+            self.summary = {(c + 1 if c >= col else c): v for c, v in self.summary.items()}
+
+    def delete_rows(self, idx, amount=1):
+        if idx <= self.header_rows:
+            raise ValueError(f"Удаление заголовочных строк листа '{self.title}' не поддерживается (строка {idx}).")
+        start = idx - self.header_rows - 1
+        count = max(0, min(amount, self.n_rows - start))
+        self.store.delete_tail_rows(start, count)
+        self.n_rows -= count
+
+
+def create_spilled_report_model(template_file, rows, categories, numeric_fields, memory_budget_mb, spill_dir=None):
+    """
+    Строит модель отчёта в режиме ограниченной памяти: строки rows (пары (категория, строка), см. iter_raw_rows)
+    сразу уходят порциями на диск (SpillStore), data_dict не создаётся. Размер порции каждого листа
+    выбирается по memory_budget_mb и ширине листа в шаблоне (см. spill_chunk_rows).
+    spill_dir – папка временных файлов (по умолчанию системная). Файлы удаляются вызовом report.close().
+    """
+    wb = load_template(template_file)
+    report = ReportModel(wb)
+    stores = {}
+    for cat, header_rows in categories.items():
+        if cat not in wb.sheetnames:
+            print(f"Лист '{cat}' не найден в шаблоне. Пропускаем.")
+            continue
+        ws = wb[cat]
+        numeric_cols = set(sheet_schema(ws, header_rows).columns_with_label(numeric_fields.get(cat, [])))
+        stores[cat] = SpillStore(numeric_cols, spill_chunk_rows(memory_budget_mb, ws.max_column), spill_dir)
+
+    try:
+        for category, row in rows:
+            store = stores.get(category)
+            if store is not None:
+                store.append(row)
+        for cat, store in stores.items():
+            store.finish()
+            report.sheets[cat] = SpilledSheetModel(wb[cat], categories[cat], store)
+    except BaseException:
+        for store in stores.values():
+            store.remove()
+        raise
+    return report
+
+
+# =============================================================
+# Производные столбцы (объявляются в настройках, см. derived_columns)
+# =============================================================
+def trading_credits(margin, equity):
+    """
+    Trading credits = Margin Balance - Equity, если Margin Balance > 0, иначе 0.
+    Нечисловые значения (NaN) считаются нулём. Один проход по столбцам array('d').
+    """
+    return array("d", [(m - e if e == e else m) if m > 0 else 0.0 for m, e in zip(margin, equity)])
+
+
+# Формулы производных столбцов: имя -> функция(входные столбцы array('d') ...) -> array('d')
+DERIVED_COLUMN_FORMULAS = {
+    "trading_credits": trading_credits,
+}
+
+
+def add_derived_column(sheet, spec):
+    """
+    Добавляет на лист модели производный столбец по описанию spec:
+        { "header": заголовок, "after": заголовок столбца, после которого он ставится,
+          "inputs": [заголовки входных столбцов], "formula": имя формулы из DERIVED_COLUMN_FORMULAS }
+    Значения вычисляются одним проходом по числовым столбцам модели до записи листа; в шаблон столбец
+    вставляется только в заголовочном блоке. Если столбец с таким заголовком уже стоит на своём месте,
+    его значения пересчитываются. Возвращает номер столбца или None, если нужные заголовки не найдены.
+    """
+    schema = sheet.schema
+    header = spec["header"]
+    after = schema.find(spec["after"])
+    if after is None:
+        print(f"Столбец '{spec['after']}' не найден в заголовке листа '{sheet.title}'.")
+        return None
+    inputs = []
+    for name in spec["inputs"]:
+        col = schema.find(name)
+        if col is None:
+            print(f"Столбец '{name}' не найден в заголовке листа '{sheet.title}'.")
+            return None
+        inputs.append(col)
+
+    formula = DERIVED_COLUMN_FORMULAS[spec["formula"]]
+    column = sheet.derived_column(inputs, formula)
+    col = after + 1
+    if normalize_header(schema.label(col)) == normalize_header(header):
+        print(f"Столбец '{header}' уже существует. Обновляем его данные...")
+        sheet.set_column(col, column)
+    else:
+        sheet.insert_column(col, sheet.header_rows, header, column)
+    return col
+
+
+def apply_derived_columns(report, filename, derived_columns):
+    """
+    Добавляет производные столбцы, объявленные в настройках:
+        { "Имя листа": [описание столбца (см. add_derived_column) ...] }
+    Описание может содержать "clients" – список слов; тогда столбец добавляется, только если имя файла
+    содержит одно из них (без учёта регистра), например, "Trading credits" для клиента Antalpha.
+    """
+    for sheet_name, specs in derived_columns.items():
+        for spec in specs:
+            clients = spec.get("clients")
+            if clients is not None and not any(client.lower() in filename.lower() for client in clients):
+                continue
+            if sheet_name not in report.sheetnames:
+                print(f"Лист '{sheet_name}' не найден в книге.")
+                break
+            if add_derived_column(report[sheet_name], spec) is not None:
+                print(f"Для файла '{filename}' в листе '{sheet_name}' добавлен столбец '{spec['header']}' после '{spec['after']}'.")
+
+
+# =============================================================
+# Колоночный движок агрегации
+# =============================================================
+def to_number(value):
+    """Приводит значение ячейки к float; для пустых и нечисловых значений возвращает None."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
 
-        new_trading_val = margin_val - equity_val if margin_val > 0 else 0
-        tc_cell = ws.cell(row=r, column=trading_credits_index)
-        tc_cell.value = new_trading_val
-        tc_cell.number_format = "#,##0.00"
+REDUCTIONS = ("sum", "count", "min", "max", "mean", "wavg")
 
-    print(f"Для файла '{filename}' в листе '{sheet_name}' вставлен столбец 'Trading credits' после 'IM', и 'Equity' пересчитана.")
 
+class ColumnReducer:
+    """
+    Нарастающий итог агрегации одной колонки по порциям строк: update(значения порции[, веса порции])
+    для каждой порции по порядку строк, затем result(). Суммы продолжают друг друга (sum со стартовым
+    значением), поэтому итог по порциям тот же, что при свёртке всей колонки сразу.
+    """
 
-def compute_aggregated_row(ws, header_rows_count, data_start_row, numeric_headers,
-                           indicator_header="User ID", aggregate_all=False):
+    def __init__(self, how="sum"):
+        if how not in REDUCTIONS:
+            raise ValueError(f"Неизвестный тип агрегации: {how!r}")
+        self.how = how
+        self.total = 0
+        self.weight = 0
+        self.count = 0
+        self.extreme = None
+
+    def update(self, values, weights=None):
+        if self.how == "wavg":
+            pairs = [(v, w) for v, w in zip(values, weights) if v == v and w == w]
+            self.weight = sum((w for _, w in pairs), self.weight)
+            self.total = sum((v * w for v, w in pairs), self.total)
+            return
+        present = [v for v in values if v == v]  # NaN != NaN – отбрасываем пропуски
+        self.count += len(present)
+        if self.how in ("sum", "mean"):
+            self.total = sum(present, self.total)
+        elif present:
+            extreme = min(present) if self.how == "min" else max(present)
+            if self.extreme is not None:
+                extreme = min(self.extreme, extreme) if self.how == "min" else max(self.extreme, extreme)
+            self.extreme = extreme
+
+    def result(self):
+        if self.how == "wavg":
+            return self.total / self.weight if self.weight else None
+        if self.how == "sum":
+            return self.total
+        if self.how == "count":
+            return self.count
+        if not self.count:
+            return None
+        if self.how == "mean":
+            return self.total / self.count
+        return self.extreme
+
+
+def compute_aggregated_row(sheet, header_rows_count, data_start_row, numeric_headers,
+                           indicator_header="User ID", aggregate_all=False, reductions=None):
     """
-    Для рабочего листа ws:
+    Для листа модели отчёта sheet (SheetModel):
       - header_rows_count – количество строк, занятых заголовками (например, 2 для Balances, 3 для Trading Summary).
       - data_start_row – номер строки, с которой начинаются данные (обычно header_rows_count + 1).
       - numeric_headers – список имен столбцов для агрегирования (используется, если aggregate_all==False).
       - indicator_header – имя столбца, по которому определяется наличие агрегированной строки.
         Если столбец объединён (например, в Trading Summary), функция ищет его во всех строках заголовочного блока.
       - aggregate_all – если True, агрегируются данные по всем столбцам (кроме индикаторного), иначе только по numeric_headers.
+      - reductions – словарь { "Заголовок": способ }, где способ – "sum", "count", "min", "max", "mean"
+        или ("wavg", "Заголовок весов"). Для столбцов, не указанных в словаре, используется "sum".
+        Заголовок столбца – ближайшее к данным непустое значение в заголовочном блоке (см. SheetSchema.label).
 
     Алгоритм:
-      1. Поиск индикаторного столбца (обычно "User ID") в строках от 1 до header_rows_count.
-      2. Если в последней строке (в этом столбце) уже написано "Aggregated" (без учёта регистра) – агрегированная строка уже есть.
+      1. Поиск индикаторного столбца (обычно "User ID") по индексу заголовков листа (SheetSchema).
+      2. Если агрегированная строка уже есть (или в последней строке данных в этом столбце написано "Aggregated"
+         без учёта регистра – тогда она становится агрегированной строкой), её значения пересчитываются.
          Иначе добавляется новая строка, и в индикаторном столбце записывается "Aggregated".
-      3. Если aggregate_all==True, то для каждого столбца (от 1 до ws.max_column, пропуская индикаторный) вычисляется сумма значений
-         (от data_start_row до агрегированной строки-1) и записывается в соответствующую ячейку агрегированной строки.
-         Если aggregate_all==False, то для каждого имени из numeric_headers ищется его столбец (в заголовочном блоке) и суммируются данные.
+      3. Определяется набор агрегируемых столбцов: все (от 1 до sheet.width, кроме индикаторного) при aggregate_all==True,
+         иначе – столбцы, найденные по именам из numeric_headers в индексе заголовков.
+      4. Строки данных проходятся один раз, порциями (лист в памяти – одна порция, см. SheetModel.column_chunks);
+         каждый столбец накапливает нарастающий итог (см. ColumnReducer), результат записывается в агрегированную строку.
     """
+    reductions = reductions or {}
+
+    schema = sheet_schema(sheet.ws, header_rows_count)
+
     # 1. Поиск индикаторного столбца в заголовочных строках
-    indicator_col = None
-    for r in range(1, header_rows_count + 1):
-        for cell in ws[r]:
-            if cell.value is not None and str(cell.value).strip().lower() == indicator_header.lower():
-                indicator_col = cell.column
-                break
-        if indicator_col is not None:
-            break
+    indicator_col = schema.find(indicator_header)
     if indicator_col is None:
         indicator_col = 1  # если не найдено, используем первый столбец
 
-    # 2. Определяем агрегированную строку: если в последней строке в индикаторном столбце уже написано "Aggregated" – используем её;
-    # иначе добавляем новую строку.
-    last_row = ws.max_row
-    cell_val = ws.cell(row=last_row, column=indicator_col).value
-    if cell_val is not None and str(cell_val).strip().lower() == "aggregated":
-        aggregated_row = last_row
-    else:
-        aggregated_row = last_row + 1
-        ws.cell(row=aggregated_row, column=indicator_col).value = "Aggregated"
+    # 2. Определяем агрегированную строку: если в последней строке данных в индикаторном столбце уже написано
+    # "Aggregated" – она становится агрегированной; иначе добавляем новую строку.
+    if sheet.summary is None:
+        last_value = sheet.value(sheet.n_rows - 1, indicator_col) if sheet.n_rows else None
+        if last_value is not None and str(last_value).strip().lower() == "aggregated":
+            last = sheet.n_rows - 1
+            sheet.summary = {col: cell for col, cell in enumerate(sheet.row_cells(last), start=1) if cell[0] is not None}
+            sheet.delete_rows(sheet.header_rows + 1 + last)
+        else:
+            sheet.summary = {indicator_col: ("Aggregated", "General")}
+    first = data_start_row - sheet.header_rows - 1  # индекс первой агрегируемой строки данных
 
-    # 3. Агрегирование данных:
+    # 3. Набор агрегируемых столбцов
     if aggregate_all:
-        # Суммируем данные по всем столбцам (от 1 до ws.max_column), пропуская индикаторный столбец.
-        for col in range(1, ws.max_column + 1):
-            if col == indicator_col:
-                continue
-            total = 0
-            for r in range(data_start_row, aggregated_row):
-                val = ws.cell(row=r, column=col).value
-                try:
-                    total += float(val)
-                except (TypeError, ValueError):
-                    pass
-            agg_cell = ws.cell(row=aggregated_row, column=col)
-            agg_cell.value = total
-            agg_cell.number_format = "#,##0.00"
+        target_cols = [col for col in range(1, sheet.width + 1) if col != indicator_col]
     else:
-        # Для каждого столбца из numeric_headers ищем его в заголовочном блоке (во всех строках от 1 до header_rows_count)
+        target_cols = []
         for header in numeric_headers:
-            col_index = None
-            for r in range(1, header_rows_count + 1):
-                for cell in ws[r]:
-                    if cell.value is not None and str(cell.value).strip() == header:
-                        col_index = cell.column
-                        break
-                if col_index is not None:
-                    break
-            if col_index is None:
+            col_index = schema.find(header)
+            if col_index is not None and col_index not in target_cols:
+                target_cols.append(col_index)
+
+    reducers = {}  # столбец -> (ColumnReducer, столбец весов или None)
+    for col in target_cols:
+        how = reductions.get(schema.label(col), "sum")
+        weight_col = None
+        if isinstance(how, tuple):
+            how, weight_header = how
+            weight_col = schema.find(weight_header)
+            if weight_col is None:
+                print(f"Столбец весов '{weight_header}' не найден в листе '{sheet.title}'.")
                 continue
-            total = 0
-            for r in range(data_start_row, aggregated_row):
-                val = ws.cell(row=r, column=col_index).value
-                try:
-                    total += float(val)
-                except (TypeError, ValueError):
-                    pass
-            agg_cell = ws.cell(row=aggregated_row, column=col_index)
-            agg_cell.value = total
-            agg_cell.number_format = "#,##0.00"
+        reducers[col] = (ColumnReducer(how), weight_col)
+
+    # 4. Один проход по порциям строк данных с нарастающими итогами
+    offset = 0
+    for n, columns in sheet.column_chunks():
+        skip = max(0, first - offset)  # строки до data_start_row не агрегируются
+        offset += n
+        if skip >= n:
+            continue
+        for col, (reducer, weight_col) in reducers.items():
+            weights = column_numbers(columns, weight_col, n)[skip:] if weight_col is not None else None
+            reducer.update(column_numbers(columns, col, n)[skip:], weights)
+    for col, (reducer, _) in reducers.items():
+        sheet.summary[col] = (reducer.result(), "#,##0" if reducer.how == "count" else NUMBER_FORMAT)
 
 
 # =============================================================
 # Функция для загрузки данных из raw-файла и группировки по категориям
 # =============================================================
-def load_raw_data(raw_file, categories):
+def duplicate_header_filter(categories, deletion_rules):
     """
-    Читает raw-файл и распределяет строки по категориям.
-    Строка, в которой первая ячейка равна имени категории, служит разделителем и не сохраняется.
+    Переводит deletion_rules в фильтр строк raw-файла.
+    deletion_rules — словарь вида:
+         { "Имя листа": (начальная_строка, количество_строк) }
+    Номера строк – как на листе отчёта (данные начинаются со строки header_rows + 1); в raw-выгрузке
+    на этих местах стоят дублирующие заголовки. Возвращает { категория: range(номеров строк данных с 0) }.
     """
-    raw_wb = load_workbook(raw_file, data_only=True)
-    raw_ws = raw_wb.active
+    skip = {}
+    for sheet_name, (start_row, num_rows) in deletion_rules.items():
+        if sheet_name not in categories:
+            print(f"Лист '{sheet_name}' не найден среди категорий для удаления строк.")
+            continue
+        header_rows = categories[sheet_name]
+        if start_row <= header_rows:
+            raise ValueError(f"Удаление заголовочных строк листа '{sheet_name}' не поддерживается (строка {start_row}).")
+        first = start_row - header_rows - 1
+        skip[sheet_name] = range(first, first + num_rows)
+    return skip
 
-    data_dict = {cat: [] for cat in categories.keys()}
-    current_category = None
 
-    for row in raw_ws.iter_rows(values_only=True):
-        first_cell = row[0]  # предполагаем, что в первой ячейке может быть название категории
+def split_categories(rows, categories):
+    """
+    Распределяет поток строк raw-выгрузки по категориям и выдаёт пары (категория, строка).
+    Строка, в которой первая ячейка равна имени категории, служит разделителем и не выдаётся;
+    пустые строки и строки до первого разделителя пропускаются.
+    """
+    current_category = None
+    for row in rows:
+        first_cell = row[0] if row else None  # предполагаем, что в первой ячейке может быть название категории
         if first_cell in categories:
             current_category = first_cell
-            continue  # не сохраняем строку с названием категории
+            continue  # не выдаём строку с названием категории
         if current_category is not None:
             if all(cell is None for cell in row):
                 continue  # пропускаем пустые строки
-            data_dict[current_category].append(list(row))
+            yield current_category, list(row)
+
+
+def iter_xlsx_rows(raw_file, categories, numeric_cols=None):
+    """
+    Потоково читает raw-файл .xlsx (openpyxl в режиме read_only, без создания объектов ячеек).
+    Значения уже типизированы openpyxl, поэтому numeric_cols не используется.
+    """
+    raw_wb = load_workbook(raw_file, read_only=True, data_only=True)
+    try:
+        yield from split_categories(raw_wb.active.iter_rows(values_only=True), categories)
+    finally:
+        # В режиме read_only файл остаётся открытым до явного закрытия книги
+        raw_wb.close()
+
+
+# Целое число в текстовых форматах: без ведущих нулей (коды вроде "007" остаются строками)
+PLAIN_INT_RE = re.compile(r"-?(?:0|[1-9][0-9]*)$")
+
+
+def text_cell(text):
+    """
+    Значение текстовой ячейки (CSV или строкового столбца Parquet) так, как его прочитал бы openpyxl из .xlsx:
+    пустая строка – None, целое число без ведущих нулей (например, User ID) – int, остальное – строка.
+    Десятичные дроби здесь не разбираются: в текстовом столбце "100.10" должно остаться "100.10" –
+    к float приводятся только числовые столбцы (numeric_cols в iter_csv_rows / iter_parquet_rows).
+    """
+    if text == "":
+        return None
+    if PLAIN_INT_RE.match(text):
+        return int(text)
+    return text
+
+
+def iter_csv_rows(raw_file, categories, numeric_cols=None):
+    """
+    Потоково читает raw-файл .csv в той же раскладке, что и .xlsx (строки-разделители категорий,
+    дублирующие заголовки, данные). Пустые ячейки и целые числа приводятся как в .xlsx (см. text_cell).
+    numeric_cols – { категория: номера столбцов (с 0) }: значения только этих столбцов приводятся к float,
+    и столбцы модели строятся без повторного разбора строк; текст в остальных столбцах остаётся строкой.
+    """
+    numeric_cols = numeric_cols or {}
+    with open(raw_file, encoding="utf-8-sig", newline="") as f:
+        rows = ([text_cell(cell) for cell in row] for row in csv.reader(f))
+        for category, row in split_categories(rows, categories):
+            for j in numeric_cols.get(category, ()):
+                if j < len(row) and row[j].__class__ is str:
+                    try:
+                        row[j] = float(row[j])
+                    except ValueError:
+                        pass  # дублирующий заголовок или текст – решают deletion_rules и ReportColumn
+            yield category, row
+
+
+def iter_parquet_rows(raw_file, categories, numeric_cols=None):
+    """
+    Читает raw-файл .parquet (нужен pyarrow). Раскладка – таблица со столбцом "category" (имя листа)
+    и столбцами данных в порядке столбцов шаблона; строк-разделителей и дублирующих заголовков нет.
+    Типизированные числовые столбцы Parquet приходят как float без разбора; значения строковых столбцов
+    (столбец общий для категорий и где-то содержит текст) разбираются как в iter_csv_rows: к float
+    приводятся только numeric_cols.
+    Файл читается пакетами строк.
+    """
+    numeric_cols = numeric_cols or {}
+    pq = optional_import("pyarrow.parquet")
+    if pq is None:
+        raise ImportError("Для чтения .parquet нужен пакет pyarrow (pip install pyarrow).")
+    parquet_file = pq.ParquetFile(raw_file)
+    names = parquet_file.schema_arrow.names
+    if "category" not in names:
+        raise ValueError(f"В файле '{raw_file}' нет столбца 'category'.")
+    category_index = names.index("category")
+    for batch in parquet_file.iter_batches():
+        columns = [batch.column(i).to_pylist() for i in range(batch.num_columns)]
+        categories_column = columns.pop(category_index)
+        for category, row in zip(categories_column, zip(*columns)):
+            if category not in categories or all(cell is None for cell in row):
+                continue
+            row = [text_cell(cell) if cell.__class__ is str else cell for cell in row]
+            for j in numeric_cols.get(category, ()):
+                if j < len(row) and row[j].__class__ is str:
+                    try:
+                        row[j] = float(row[j])
+                    except ValueError:
+                        pass
+            yield category, row
+
+
+# Читатели raw-файлов по расширению: (функция (raw_file, categories, numeric_cols) -> пары (категория, строка),
+# есть ли в формате дублирующие заголовки выгрузки, которые отбрасываются по deletion_rules)
+RAW_READERS = {
+    ".xlsx": (iter_xlsx_rows, True),
+    ".csv": (iter_csv_rows, True),
+    ".parquet": (iter_parquet_rows, False),
+}
+RAW_EXTENSIONS = tuple(RAW_READERS)
+
+
+def iter_raw_rows(raw_file, categories, deletion_rules=None, numeric_cols=None):
+    """
+    Потоково читает raw-файл любым читателем из RAW_READERS (по расширению) и выдаёт пары (категория, строка).
+    Строки, заданные deletion_rules (дублирующие заголовки выгрузки, см. duplicate_header_filter),
+    отбрасываются при чтении – листы отчёта после заполнения не изменяются.
+    numeric_cols – { категория: номера числовых столбцов (с 0) } для читателей текстовых форматов.
+    """
+    extension = os.path.splitext(raw_file)[1].lower()
+    if extension not in RAW_READERS:
+        raise ValueError(f"Неподдерживаемый формат raw-файла '{raw_file}' (поддерживаются: {', '.join(RAW_EXTENSIONS)}).")
+    reader, has_duplicate_headers = RAW_READERS[extension]
+    skip = duplicate_header_filter(categories, deletion_rules or {}) if has_duplicate_headers else {}
+    counters = dict.fromkeys(categories, 0)
+    for category, row in reader(raw_file, categories, numeric_cols):
+        index = counters[category]
+        counters[category] = index + 1
+        if index in skip.get(category, ()):
+            continue  # дублирующий заголовок
+        yield category, row
+
+
+def raw_numeric_columns(template_file, categories, numeric_fields):
+    """Номера числовых столбцов (с 0) по заголовкам шаблона: { категория: множество номеров }."""
+    wb = load_template(template_file)
+    return {cat: {col - 1 for col in sheet_schema(wb[cat], header_rows).columns_with_label(numeric_fields.get(cat, []))}
+            for cat, header_rows in categories.items() if cat in wb.sheetnames}
+
+
+def load_raw_data(raw_file, categories, deletion_rules=None, numeric_cols=None):
+    """
+    Читает raw-файл (.xlsx, .csv или .parquet, см. RAW_READERS) и распределяет строки по категориям.
+    Строка, в которой первая ячейка равна имени категории, служит разделителем и не сохраняется;
+    дублирующие заголовки по deletion_rules отбрасываются при чтении (см. iter_raw_rows).
+    """
+    data_dict = {cat: [] for cat in categories.keys()}
+    for category, row in iter_raw_rows(raw_file, categories, deletion_rules, numeric_cols):
+        data_dict[category].append(row)
+    if not RAW_READERS.get(os.path.splitext(raw_file)[1].lower(), (None, False))[1]:
+        return data_dict
+    for sheet_name, (start_row, num_rows) in (deletion_rules or {}).items():
+        if sheet_name in categories:
+            print(f"Пропущены строки {start_row} - {start_row + num_rows - 1} листа '{sheet_name}' (дублирующие заголовки).")
     return data_dict
 
 # =============================================================
-# Функция для заполнения шаблона данными и применения стилей/форматирования
+# Кэш разобранных raw-файлов: столбцы листов рядом с результатами (result/cache или raw_cache_dir)
 # =============================================================
-def fill_template(template_file, data_dict, categories, numeric_fields, header_font):
+RAW_CACHE_DIR = "cache"
+RAW_CACHE_SUFFIX = ".columns"
+# Версия формата кэша – увеличивается при изменении разбора raw-файлов (читатели, text_cell, build_columns)
+RAW_CACHE_VERSION = 2
+
+
+def raw_cache_path(cache_dir, raw_file):
+    """Файл кэша raw-файла: <cache_dir>/<имя raw-файла>.columns."""
+    return os.path.join(cache_dir, os.path.basename(raw_file) + RAW_CACHE_SUFFIX)
+
+
+def raw_cache_key(raw_file, categories, deletion_rules, numeric_cols):
     """
-    Загружает шаблонный файл, для каждого листа:
-      - записывает данные (начиная со строки после заголовков),
-      - применяет стиль к заголовкам,
-      - форматирует числовые столбцы (приводит значения к float и задаёт формат "#,##0.00").
-    Возвращает изменённую книгу.
+    Ключ кэша: путь, размер и mtime raw-файла и отпечаток настроек разбора (категории, дублирующие
+    заголовки, числовые столбцы по шаблону) вместе с версией формата. SHA-256 содержимого добавляется
+    в ключ при первой необходимости (см. load_raw_cache и load_raw_columns).
     """
-    wb = load_workbook(template_file)
+    stat = os.stat(raw_file)
+    config = {"version": RAW_CACHE_VERSION, "categories": categories, "deletion_rules": deletion_rules,
+              "numeric_cols": {cat: sorted(cols) for cat, cols in numeric_cols.items()}}
+    return {"path": os.path.abspath(raw_file), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+            "config": hashlib.sha256(json.dumps(config, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()}
 
-    for cat, header_rows in categories.items():
-        if cat not in wb.sheetnames:
-            print(f"Лист '{cat}' не найден в шаблоне. Пропускаем.")
+
+def load_raw_cache(cache_path, raw_file, key):
+    """
+    Столбцы листов из кэша { категория: (число строк, столбцы) } или None, если кэша нет или он устарел.
+    Файл кэша – два pickle подряд: ключ (см. raw_cache_key) и столбцы листов; столбцы читаются, только
+    если ключ совпал. Числовые столбцы хранятся как array('d') и восстанавливаются без разбора значений.
+    Если размер или mtime raw-файла не совпадают с ключом, сверяется SHA-256 (простое "касание" или копирование
+    файла кэш не сбрасывает); при совпадении ключ в файле кэша обновляется, чтобы следующие запуски снова
+    обходились без хэширования. Устаревший или повреждённый файл кэша удаляется.
+    """
+    try:
+        f = open(cache_path, "rb")
+    except FileNotFoundError:
+        return None
+    sheet_columns = None
+    with f:
+        try:
+            cached = pickle.load(f)
+            if cached["path"] == key["path"] and cached["config"] == key["config"]:
+                if (cached["size"], cached["mtime"]) == (key["size"], key["mtime"]):
+                    return pickle.load(f)
+                key["sha256"] = file_sha256(raw_file)
+                if cached["sha256"] == key["sha256"]:
+                    sheet_columns = pickle.load(f)
+        except Exception as e:
+            print(f"Не удалось прочитать кэш '{cache_path}': {e}")
+    if sheet_columns is not None:
+        # Содержимое то же, изменились только размер/mtime в ключе – переписываем ключ (файл уже закрыт)
+        save_raw_cache(cache_path, key, sheet_columns)
+        return sheet_columns
+    print(f"Кэш '{cache_path}' устарел и будет перестроен.")
+    remove_file(cache_path)
+    return None
+
+
+def save_raw_cache(cache_path, key, sheet_columns):
+    """Атомарно записывает кэш raw-файла (через временный файл и os.replace); ошибки записи не прерывают отчёт."""
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(sheet_columns, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Не удалось сохранить кэш '{cache_path}': {e}")
+        remove_file(tmp_path)
+
+
+def remove_file(path):
+    """Удаляет файл, если он есть."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def raw_cache_dir(result_folder, settings):
+    """
+    Папка кэша разобранных raw-файлов: settings["raw_cache_dir"] или, если она не задана, result_folder/cache;
+    None, если кэш отключён настройкой raw_cache.
+    """
+    if not settings["raw_cache"]:
+        return None
+    return settings["raw_cache_dir"] or os.path.join(result_folder, RAW_CACHE_DIR)
+
+
+def prune_raw_cache(cache_dir, raw_files):
+    """Удаляет из cache_dir файлы кэша raw-файлов, которых больше нет в raw_files."""
+    if not os.path.isdir(cache_dir):
+        return
+    keep = {os.path.basename(raw_file) + RAW_CACHE_SUFFIX for raw_file in raw_files}
+    for name in os.listdir(cache_dir):
+        if name.endswith(RAW_CACHE_SUFFIX) and name not in keep:
+            print(f"Удалён кэш отсутствующего raw-файла: {name}")
+            remove_file(os.path.join(cache_dir, name))
+
+
+def load_raw_columns(raw_file, categories, deletion_rules, numeric_cols, cache_dir):
+    """
+    Столбцы листов raw-файла { категория: (число строк, столбцы) }: из кэша в cache_dir, если он актуален,
+    иначе разбором raw-файла (см. load_raw_data) с последующим сохранением в кэш.
+    numeric_cols – номера числовых столбцов (с 0) по категориям (см. raw_numeric_columns).
+    """
+    cache_path = raw_cache_path(cache_dir, raw_file)
+    key = raw_cache_key(raw_file, categories, deletion_rules, numeric_cols)
+    sheet_columns = load_raw_cache(cache_path, raw_file, key)
+    if sheet_columns is not None:
+        print("Данные raw-файла взяты из кэша:", cache_path)
+        return sheet_columns
+
+    # Хэш считается до разбора: если файл изменится во время чтения, кэш при следующем запуске не совпадёт
+    if "sha256" not in key:
+        key["sha256"] = file_sha256(raw_file)
+    data_dict = load_raw_data(raw_file, categories, deletion_rules, numeric_cols)
+    sheet_columns = {}
+    for cat, rows in data_dict.items():
+        sheet_columns[cat] = (len(rows), build_columns(rows, {col + 1 for col in numeric_cols.get(cat, ())}))
+    save_raw_cache(cache_path, key, sheet_columns)
+    return sheet_columns
+
+# =============================================================
+# Кэш шаблона: temp1.xlsx разбирается один раз на процесс
+# =============================================================
+# Абсолютный путь шаблона -> {"mtime", "size", "sha256", "content", "snapshot"}
+_TEMPLATE_CACHE = {}
+
+
+def restore_dimension_factories(wb):
+    """
+    После pickle.loads у column_dimensions/row_dimensions листов теряется default_factory (DimensionHolder
+    в openpyxl – подкласс defaultdict): обращение к ещё не заданному столбцу падает с KeyError,
+    а повторная сериализация книги – с TypeError. Восстанавливает фабрики на всех листах книги.
+    """
+    for ws in wb.worksheets:
+        if hasattr(ws, "_add_column"):
+            ws.column_dimensions.default_factory = ws._add_column
+            ws.row_dimensions.default_factory = ws._add_row
+    return wb
+
+
+def load_template(template_file):
+    """
+    Возвращает новую копию шаблонной книги (листы, заголовки, объединённые ячейки, стили).
+    Шаблон разбирается один раз, после чего книга хранится в виде pickle-снимка, и каждая копия –
+    это быстрая десериализация снимка вместо повторной распаковки zip и разбора XML.
+    Кэш сбрасывается, если у файла изменились mtime/размер и при этом изменился его SHA-256
+    (простое "касание" файла без изменения содержимого повторного разбора не вызывает).
+    """
+    key = os.path.abspath(template_file)
+    stat = os.stat(key)
+    entry = _TEMPLATE_CACHE.get(key)
+    if entry is None or (entry["mtime"], entry["size"]) != (stat.st_mtime_ns, stat.st_size):
+        with open(key, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if entry is None or entry["sha256"] != digest:
+            wb = load_workbook(io.BytesIO(content))
+            try:
+                snapshot = pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                snapshot = None  # книга не сериализуется – будем разбирать сохранённые байты
+            entry = {"sha256": digest, "content": content, "snapshot": snapshot}
+        entry.update(mtime=stat.st_mtime_ns, size=stat.st_size)
+        _TEMPLATE_CACHE[key] = entry
+
+    if entry["snapshot"] is not None:
+        return restore_dimension_factories(pickle.loads(entry["snapshot"]))
+    return load_workbook(io.BytesIO(entry["content"]))
+
+# =============================================================
+# Функция для заполнения шаблона данными и применения стилей/форматирования
+# =============================================================
+def copy_cell_style(src, dst):
+    """Копирует стиль ячейки src в ячейку dst другой книги (шрифт, заливка, границы, выравнивание, формат)."""
+    if src.has_style:
+        dst.font = copy(src.font)
+        dst.fill = copy(src.fill)
+        dst.border = copy(src.border)
+        dst.alignment = copy(src.alignment)
+        dst.protection = copy(src.protection)
+        dst.number_format = src.number_format
+
+
+def copy_sheet_layout(src, dst):
+    """
+    Переносит оформление листа src (книга-шаблон) на лист dst книги в режиме write_only:
+    ширины столбцов, вид листа, поля, объединённые ячейки и изображения (например, логотип).
+    Должна вызываться до записи первой строки в dst.
+    """
+    for key, dim in src.column_dimensions.items():
+        new_dim = dst.column_dimensions[key]
+        new_dim.min, new_dim.max = dim.min, dim.max
+        new_dim.width = dim.width
+        new_dim.hidden = dim.hidden
+        new_dim.outlineLevel = dim.outlineLevel
+        new_dim.bestFit = dim.bestFit
+    dst.sheet_format = copy(src.sheet_format)
+    dst.sheet_properties = copy(src.sheet_properties)
+    dst.views = copy(src.views)
+    dst.page_margins = copy(src.page_margins)
+    dst.print_options = copy(src.print_options)
+    for merged_range in src.merged_cells.ranges:
+        dst.merged_cells.add(copy(merged_range))
+    for image in src._images:
+        dst.add_image(image)
+
+
+def append_template_rows(src, dst, max_row, header_font=None, style_cache=None):
+    """
+    Дописывает в лист dst (write_only) строки 1..max_row листа-шаблона src вместе со стилями и высотой строк.
+    Если задан header_font, он применяется к непустым ячейкам.
+    Стиль переносится один раз на каждый различный стиль шаблона: style_cache (общий для листов одной книги)
+    хранит готовые стили книги dst по стилю ячейки шаблона, остальные ячейки получают копию готового стиля.
+    """
+    if style_cache is None:
+        style_cache = {}
+    for row in src.iter_rows(min_row=1, max_row=max_row):
+        row_idx = row[0].row
+        if row_idx in src.row_dimensions:
+            dim = src.row_dimensions[row_idx]
+            new_dim = dst.row_dimensions[row_idx]
+            new_dim.ht = dim.ht
+            new_dim.hidden = dim.hidden
+            new_dim.outlineLevel = dim.outlineLevel
+        cells = []
+        for cell in row:
+            if cell.value is None and not cell.has_style:
+                cells.append(None)
+                continue
+            new_cell = WriteOnlyCell(dst, value=cell.value)
+            key = (cell.has_style and tuple(cell._style), header_font is not None and cell.value is not None)
+            style = style_cache.get(key)
+            if style is None:
+                copy_cell_style(cell, new_cell)
+                if key[1]:
+                    new_cell.font = header_font
+                style = style_cache[key] = new_cell._style
+            new_cell._style = copy(style)
+            cells.append(new_cell)
+        dst.append(cells)
+
+
+def fill_template(report, header_font):
+    """
+    Записывает модель отчёта в новую книгу в режиме write_only (openpyxl): строки пишутся потоково
+    во временные файлы по мере формирования, поэтому память не зависит от размера отчёта.
+    Листы идут в порядке шаблона; служебные листы (например, "logo") копируются из шаблона как есть.
+    Для листов категорий:
+      - заголовочные строки переносятся из шаблона со стилями, высотой строк и объединёнными ячейками,
+        к ним применяется header_font,
+      - затем записываются данные и агрегированная строка; числовым значениям задаётся формат "#,##0.00"
+        (см. SheetModel.iter_cells).
+    Возвращает книгу, готовую к сохранению (см. save_workbook_stable).
+    """
+    template = report.workbook
+    wb = Workbook(write_only=True)
+    wb.properties = copy(template.properties)
+    wb.loaded_theme = template.loaded_theme
+    wb._active_sheet_index = template._active_sheet_index
+    style_cache = {}  # стили шаблона, перенесённые в новую книгу (см. append_template_rows)
+
+    for src in template.worksheets:
+        ws = wb.create_sheet(src.title)
+        copy_sheet_layout(src, ws)
+        if src.title not in report.sheets:
+            append_template_rows(src, ws, src.max_row, style_cache=style_cache)
             continue
 
-        ws = wb[cat]
+        sheet = report.sheets[src.title]
+        header_rows = sheet.header_rows
         start_row = header_rows + 1  # данные записываются после заголовков
+        append_template_rows(src, ws, header_rows, header_font, style_cache)
 
-        # Запись данных в лист
-        for i, data_row in enumerate(data_dict[cat], start=start_row):
-            for j, value in enumerate(data_row, start=1):
-                ws.cell(row=i, column=j, value=value)
-
-        # Применяем стиль к ячейкам заголовков (строки 1...header_rows)
-        for row in range(1, header_rows + 1):
-            for col in range(1, ws.max_column + 1):
-                cell = ws.cell(row=row, column=col)
-                if cell.value is not None:
-                    cell.font = header_font
-
-        # Определяем номера столбцов для числового форматирования по заголовкам
-        numeric_cols = []
-        header_row_idx = header_rows  # предполагается, что заголовки во последней строке блока
-        for cell in ws[header_row_idx]:
-            if cell.value in numeric_fields.get(cat, []):
-                numeric_cols.append(cell.column)
-
-        # Приводим значения к числовому типу и применяем формат "#,##0.00"
-        for col in numeric_cols:
-            for row in range(start_row, start_row + len(data_dict[cat])):
-                cell = ws.cell(row=row, column=col)
-                if cell.value is not None:
-                    try:
-                        numeric_val = float(cell.value)
-                        cell.value = numeric_val
-                        cell.number_format = "#,##0.00"
-                    except (ValueError, TypeError):
-                        pass
-
-        print(f"Лист '{cat}' заполнен и стилизован (данные начинаются с {start_row}-й строки).")
+        # Ячейки с форматом переиспользуются: строка записывается целиком при append
+        formatted_cells = {}
+        for row_num, cells in sheet.iter_cells(fills=False):
+            if row_num < start_row:
+                continue
+            values = []
+            for col, (value, number_format, _) in enumerate(cells, start=1):
+                if value is not None and number_format != "General":
+                    cell = formatted_cells.get((col, number_format))
+                    if cell is None:
+                        cell = formatted_cells[(col, number_format)] = WriteOnlyCell(ws)
+                        cell.number_format = number_format
+                    cell.value = value
+                    value = cell
+                values.append(value)
+            ws.append(values)
+
+        print(f"Лист '{src.title}' заполнен и стилизован (данные начинаются с {start_row}-й строки).")
 
     return wb
 
+
 # =============================================================
-# Функция для удаления лишних строк с дублирующими заголовками
+# Индекс объединённых ячеек для экспорта в PDF
 # =============================================================
-def delete_duplicate_headers(workbook, deletion_rules):
+class MergedCellIndex:
     """
-    Удаляет заданные строки с каждого листа, согласно deletion_rules.
-    deletion_rules — словарь вида:
-         { "Имя листа": (начальная_строка, количество_удаляемых_строк) }
+    Индекс объединённых диапазонов листа, строится один раз на лист:
+      - ranges – все объединённые диапазоны листа (в исходном порядке);
+      - top_left_value(row, col) – значение верхней левой ячейки диапазона, в который входит ячейка, или None
+        (за O(1) через словарь ячейка -> диапазон).
     """
-    for sheet_name, (start_row, num_rows) in deletion_rules.items():
-        if sheet_name in workbook.sheetnames:
-            ws = workbook[sheet_name]
-            ws.delete_rows(start_row, num_rows)
-            print(f"Удалены строки {start_row} - {start_row + num_rows - 1} в листе '{sheet_name}'.")
-        else:
-            print(f"Лист '{sheet_name}' не найден в книге для удаления строк.")
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.ranges = list(ws.merged_cells.ranges)
+        self._cells = {}
+        for merged_range in self.ranges:
+            for r in range(merged_range.min_row, merged_range.max_row + 1):
+                for c in range(merged_range.min_col, merged_range.max_col + 1):
+                    self._cells.setdefault((r, c), merged_range)
+
+    def top_left_value(self, row, col):
+        merged_range = self._cells.get((row, col))
+        if merged_range is None:
+            return None
+        return self.ws.cell(row=merged_range.min_row, column=merged_range.min_col).value
+
+
+# Цвет ARGB/RGB из openpyxl -> colors.HexColor (None – цвет не разбирается); один объект на цвет
+_FILL_COLORS = {}
+
+
+def solid_fill_color(cell):
+    """Цвет сплошной заливки ячейки в виде colors.HexColor или None."""
+    fill = cell.fill
+    if fill is not None and fill.fill_type == "solid":
+        fgColor = fill.fgColor
+        if fgColor is not None and fgColor.rgb is not None:
+            rgb = fgColor.rgb
+            try:
+                return _FILL_COLORS[rgb]
+            except KeyError:
+                pass
+            rl = load_reportlab()
+            try:
+                # удаляем альфа-канал, если есть
+                color = rl.colors.HexColor("#" + (rgb[-6:] if len(rgb) == 8 else rgb))
+            except Exception:
+                color = None
+            _FILL_COLORS[rgb] = color
+            return color
+    return None
+
+
+def iter_sheet_cells(sheet):
+    """
+    Строки листа для экспорта в PDF: (номер строки, [(значение, числовой формат, цвет заливки) ...]).
+    sheet – лист модели отчёта (SheetModel) или лист книги openpyxl (например, загруженного xlsx-отчёта).
+    """
+    if isinstance(sheet, SheetModel):
+        yield from sheet.iter_cells()
+        return
+    for row in sheet.rows:
+        yield row[0].row, [(cell.value, cell.number_format, solid_fill_color(cell)) for cell in row]
+
 
 # =============================================================
 # Функция для экспорта данных из книги в PDF-файл
 # =============================================================
-def export_to_pdf(workbook, sheet_order, output_pdf_file, header_rows_pdf, cover_company=None):
+# Ячейка таблицы ReportLab по умолчанию имеет отступы 6pt слева и справа
+PDF_CELL_HPADDING = 12
+# Символы, которые Paragraph обрабатывает иначе, чем простая строка (разметка, переносы, пробелы)
+PDF_MARKUP_CHARS = frozenset("<>&\n\r\t")
+
+
+def needs_paragraph(text, font_name, font_size, width):
     """
-    Экспортирует содержимое листов workbook в PDF-файл.
-    Для каждого листа:
-      - Каждая ячейка оборачивается в Paragraph для переноса длинного текста.
-      - Для первых N строк (N задаётся в header_rows_pdf для данного листа) используется header_style
-        с выравниванием по центру (горизонтально и вертикально), для остальных – body_style.
-      - Обрабатываются объединённые ячейки (merged cells) с помощью команды SPAN.
-      - Таблица растягивается равномерно на всю ширину страницы, а число столбцов определяется по первой (заголовочной) строке,
-        при этом если пустые ячейки являются частью объединённых диапазонов, они учитываются.
-    Параметр header_rows_pdf – словарь вида: { "Лист": число_заголовочных_строк }.
+    Проверяет, нужно ли оборачивать текст ячейки в Paragraph: да, если текст не помещается
+    в ширину столбца одной строкой или содержит разметку/пробельные символы, которые Paragraph
+    отображает иначе, чем простая строка.
     """
+    if not text:
+        return False
+    if text != text.strip() or "  " in text or not PDF_MARKUP_CHARS.isdisjoint(text):
+        return True
+    return load_reportlab().pdfmetrics.stringWidth(text, font_name, font_size) > width - PDF_CELL_HPADDING
 
+
+def pdf_styles():
+    """Стили абзацев PDF: (заголовочные ячейки, ячейки данных, название листа)."""
+    rl = load_reportlab()
     # Определяем стили для заголовков и для остальных ячеек
-    header_style = ParagraphStyle(
+    header_style = rl.ParagraphStyle(
         name="header_style",
         fontName="Calibri",
         fontSize=6,
         leading=10,
-        alignment=TA_CENTER
+        alignment=rl.TA_CENTER
     )
-    body_style = ParagraphStyle(
+    body_style = rl.ParagraphStyle(
         name="body_style",
         fontName="Calibri",
         fontSize=4,
         leading=6,
-        alignment=TA_CENTER  # левое выравнивание для остальных ячеек
-    )
-
-    # Настраиваем документ PDF
-    doc = SimpleDocTemplate(
-        output_pdf_file,
-        pagesize=A4,
-        leftMargin=20,
-        rightMargin=20,
-        topMargin=20,
-        bottomMargin=20
+        alignment=rl.TA_CENTER  # левое выравнивание для остальных ячеек
     )
-    elements = []
-    styles = getSampleStyleSheet()
-    # title_style = styles["Heading1"]
-    # title_style.alignment = TA_CENTER  # Заголовок листа по центру
 
-    title_style = ParagraphStyle(
+    title_style = rl.ParagraphStyle(
         name='MyTitleStyle',
         fontName='Calibri',  # Используем Calibri
         fontSize=10,  # Размер шрифта 14
         leading=6,  # Межстрочный интервал (можно настроить)
         alignment=0  # Выравнивание по центру
     )
+    return header_style, body_style, title_style
 
-    # Если задан cover_company, то добавляем первую обложную страницу
-    if cover_company:
-        # Определяем стили для обложной страницы
-        cover_style1 = ParagraphStyle(
-            name="cover_style1",
-            fontName="Calibri",
-            fontSize=24,
-            leading=28,
-            alignment=TA_CENTER
-        )
-        cover_style2 = ParagraphStyle(
-            name="cover_style2",
-            fontName="Calibri",
-            fontSize=18,
-            leading=22,
-            alignment=TA_CENTER
-        )
-        cover_style3 = ParagraphStyle(
-            name="cover_style3",
-            fontName="Calibri",
-            fontSize=12,
-            leading=16,
-            alignment=TA_CENTER
-        )
-        # Формируем строки обложной страницы
-        cover_text1 = Paragraph("MONTHLY STATEMENT", cover_style1)
-        cover_text2 = Paragraph("COINCALL X " + cover_company.upper(), cover_style2)
-        utc_now = datetime.datetime.utcnow().strftime("%d %b %Y %H:%M UTC")
-        cover_text3 = Paragraph("REPORT TIME: " + utc_now.upper(), cover_style3)
-        # Добавляем элементы: между строками можно задать отступы
-        elements.append(Spacer(1, 300))
-        elements.append(cover_text1)
-        elements.append(Spacer(1, 20))
-        elements.append(cover_text2)
-        elements.append(Spacer(1, 20))
-        elements.append(cover_text3)
-        elements.append(Spacer(1, 100))
-        elements.append(PageBreak())  # Разрыв страницы: таблицы начнутся со второй страницы
-
-    # Обрабатываем листы в порядке, заданном в sheet_order
-    for sheet_name in sheet_order:
-        if sheet_name not in workbook.sheetnames:
-            print(f"Лист '{sheet_name}' не найден для экспорта в PDF.")
-            continue
-
-        ws = workbook[sheet_name]
-        data = []  # Будущий список строк для таблицы PDF
-        excel_to_pdf_index = {}  # Сопоставление: номер строки Excel -> индекс строки в data
-
-        # Количество заголовочных строк для данного листа (если не указано – 1)
-        header_count = header_rows_pdf.get(sheet_name, 1)
 
-        # Формируем data: включаем все строки, где хотя бы одна ячейка не пуста
-        for row in ws.rows:
-            if any(cell.value is not None for cell in row):
-                pdf_index = len(data)
-                excel_to_pdf_index[row[0].row] = pdf_index
-                row_data = []
-                for cell in row:
-                    if cell.value is None:
-                        text = ""
-                    else:
-                        # Если ячейка содержит число с форматом "#,##0.00", форматируем его
-                        if isinstance(cell.value, (int, float)) and cell.number_format == "#,##0.00":
-                            text = f"{cell.value:,.2f}"
-                        else:
-                            text = str(cell.value)
-                    # Для первых header_count строк используем стиль заголовка, для остальных – базовый стиль
-                    style_to_use = header_style if pdf_index < header_count else body_style
-                    para = Paragraph(text, style_to_use)
-                    row_data.append(para)
-                data.append(row_data)
-
-        if not data:
+def pdf_document(output, report_time=None):
+    """Документ PDF отчёта (A4, поля 20 pt); output – путь или файловый объект."""
+    rl = load_reportlab()
+    # Настраиваем документ PDF
+    doc = rl.SimpleDocTemplate(
+        output,
+        pagesize=rl.A4,
+        leftMargin=20,
+        rightMargin=20,
+        topMargin=20,
+        bottomMargin=20,
+        invariant=1 if report_time is not None else None
+    )
+    return doc
+
+
+def pdf_cover_elements(cover_company, report_time=None):
+    """Элементы обложной страницы: название отчёта, компания и время отчёта; в конце – разрыв страницы."""
+    rl = load_reportlab()
+    elements = []
+    # Определяем стили для обложной страницы
+    cover_style1 = rl.ParagraphStyle(
+        name="cover_style1",
+        fontName="Calibri",
+        fontSize=24,
+        leading=28,
+        alignment=rl.TA_CENTER
+    )
+    cover_style2 = rl.ParagraphStyle(
+        name="cover_style2",
+        fontName="Calibri",
+        fontSize=18,
+        leading=22,
+        alignment=rl.TA_CENTER
+    )
+    cover_style3 = rl.ParagraphStyle(
+        name="cover_style3",
+        fontName="Calibri",
+        fontSize=12,
+        leading=16,
+        alignment=rl.TA_CENTER
+    )
+    # Формируем строки обложной страницы
+    cover_text1 = rl.Paragraph("MONTHLY STATEMENT", cover_style1)
+    cover_text2 = rl.Paragraph("COINCALL X " + cover_company.upper(), cover_style2)
+    cover_time = report_time if report_time is not None else datetime.datetime.utcnow()
+    utc_now = cover_time.strftime("%d %b %Y %H:%M UTC")
+    cover_text3 = rl.Paragraph("REPORT TIME: " + utc_now.upper(), cover_style3)
+    # Добавляем элементы: между строками можно задать отступы
+    elements.append(rl.Spacer(1, 300))
+    elements.append(cover_text1)
+    elements.append(rl.Spacer(1, 20))
+    elements.append(cover_text2)
+    elements.append(rl.Spacer(1, 20))
+    elements.append(cover_text3)
+    elements.append(rl.Spacer(1, 100))
+    elements.append(rl.PageBreak())  # Разрыв страницы: таблицы начнутся со второй страницы
+    return elements
+
+
+def background_commands(cell_fills, max_cols, keep_single=()):
+    """
+    Команды BACKGROUND таблицы PDF по заливкам ячеек [(столбец с 1, строка PDF, цвет) ...].
+    Соседние ячейки одного цвета объединяются в прямоугольники: сначала в отрезки по строке, затем
+    одинаковые отрезки соседних строк – число команд растёт с числом одноцветных областей, а не ячеек.
+    keep_single – левые верхние ячейки объединений (столбец с 0, строка PDF): они остаются отдельными
+    командами, потому что ReportLab заливает такую ячейку на всю площадь объединения.
+    Столбцы правее max_cols отбрасываются.
+    """
+    cells = sorted((row, j - 1, color) for j, row, color in cell_fills if j <= max_cols)
+    runs = []  # [строка, первый столбец, последний столбец, цвет, отдельная ячейка]
+    for row, col, color in cells:
+        single = (col, row) in keep_single
+        last = runs[-1] if runs else None
+        if not single and last and not last[4] and last[0] == row and last[2] == col - 1 and last[3] == color:
+            last[2] = col
+        else:
+            runs.append([row, col, col, color, single])
+
+    rects = []  # [первый столбец, первая строка, последний столбец, последняя строка, цвет]
+    open_rects = {}  # (первый столбец, последний столбец, цвет) -> прямоугольник, доходящий до предыдущей строки
+    for row, first, last, color, single in runs:
+        if single:
+            rects.append([first, row, last, row, color])
             continue
+        rect = open_rects.get((first, last, color))
+        if rect is not None and rect[3] == row - 1:
+            rect[3] = row
+        else:
+            rect = [first, row, last, row, color]
+            rects.append(rect)
+            open_rects[(first, last, color)] = rect
+    return [('BACKGROUND', (sc, sr), (ec, er), color) for sc, sr, ec, er, color in rects]
 
-        # Определяем Excel-номер строки для заголовка (первая строка, попавшая в PDF)
-        header_excel_row = None
-        for ex_row, pdf_index in excel_to_pdf_index.items():
-            if pdf_index == 0:
-                header_excel_row = ex_row
-                break
-        if header_excel_row is None:
-            header_excel_row = 1
-
-        # --- Вычисление "эффективного" числа столбцов по первой (заголовочной) строке ---
-        header_row = data[0]
-        effective_max_cols = 0
-        # Перебираем столбцы с конца к началу
-        for col in range(len(header_row), 0, -1):
-            text = header_row[col - 1].getPlainText().strip()
-            if text != "":
+
+def pdf_sheet_rows(sheet):
+    """
+    Непустые строки листа для PDF: (номер строки Excel, [текст ячеек], [(столбец с 1, цвет заливки) ...]).
+    Числа с форматом "#,##0.00" выводятся с разделителями тысяч и двумя знаками после точки.
+    """
+    for row_num, cells in iter_sheet_cells(sheet):
+        if any(value is not None for value, _, _ in cells):
+            texts = []
+            fills = []
+            for j, (value, number_format, cell_color) in enumerate(cells, start=1):
+                if cell_color is not None:
+                    fills.append((j, cell_color))
+                if value is None:
+                    texts.append("")
+                elif isinstance(value, (int, float)) and number_format == NUMBER_FORMAT:
+                    texts.append(f"{value:,.2f}")
+                else:
+                    texts.append(str(value))
+            yield row_num, texts, fills
+
+
+def pdf_data_row(texts, max_cols, col_width, body_style, fast_mode):
+    """
+    Ячейки строки данных таблицы PDF: строка дополняется или обрезается до max_cols, текст оборачивается
+    в Paragraph (в режиме больших листов – только там, где нужен перенос, см. needs_paragraph).
+    """
+    texts = texts[:max_cols] + [""] * (max_cols - len(texts))
+    return [load_reportlab().Paragraph(text, body_style)
+            if not fast_mode or needs_paragraph(text, body_style.fontName, body_style.fontSize, col_width) else text
+            for text in texts]
+
+
+def pdf_sheet_elements(sheet, sheet_name, header_count, doc_width, fast_rows_threshold=1000):
+    """
+    Элементы PDF для одного листа (SheetModel или лист openpyxl): заголовок листа и таблица шириной doc_width.
+    header_count – число заголовочных строк листа; fast_rows_threshold – см. export_to_pdf.
+    Лист с данными на диске (SpilledSheetModel), у которого строк данных больше fast_rows_threshold, выводится
+    потоково (pdf_tables.SpilledTable) – так же, как лист в памяти в режиме больших листов; до порога строки (не больше
+    fast_rows_threshold) собираются в памяти и лист выводится обычной таблицей, как без режима ограниченной памяти.
+    Возвращает пустой список, если на листе нет данных.
+    """
+    rl = load_reportlab()
+    header_style, body_style, title_style = pdf_styles()
+    merged_index = MergedCellIndex(sheet.ws if isinstance(sheet, SheetModel) else sheet)  # общий для всех проходов ниже
+    data = []  # Будущий список строк для таблицы PDF
+    excel_to_pdf_index = {}  # Сопоставление: номер строки Excel -> индекс строки в data
+    cell_fills = []  # Заливки ячеек, попавших в PDF: (столбец с 1, строка PDF, цвет)
+
+    # Формируем data: включаем все строки, где хотя бы одна ячейка не пуста.
+    # В том же проходе собираем фоновые цвета ячеек (отдельный проход по листу не нужен).
+    # Для первых header_count строк используем стиль заголовка; строки данных пока храним
+    # текстом – способ их вывода выбирается после расчёта ширины столбцов
+    rows = pdf_sheet_rows(sheet)
+    spilled = isinstance(sheet, SpilledSheetModel) and fast_rows_threshold is not None
+    streamed = False
+    buffered = []  # строки данных листа с данными на диске, пока их не больше fast_rows_threshold
+    for row_num, texts, fills in rows:
+        pdf_index = len(data)
+        if spilled and pdf_index - header_count >= fast_rows_threshold:
+            # Строк больше порога: прочитанные строки данных и остальные выводятся потоково (SpilledTable)
+            streamed = True
+            del data[header_count:]
+            cell_fills = [fill for fill in cell_fills if fill[1] < header_count]
+            excel_to_pdf_index = {ex_row: i for ex_row, i in excel_to_pdf_index.items() if i < header_count}
+            buffered.append((row_num, texts, fills))
+            rows = chain(buffered, rows)
+            break
+        excel_to_pdf_index[row_num] = pdf_index
+        cell_fills.extend((j, pdf_index, color) for j, color in fills)
+        if pdf_index < header_count:
+            data.append([rl.Paragraph(text, header_style) for text in texts])
+        else:
+            data.append(texts)
+            if spilled:
+                buffered.append((row_num, texts, fills))
+
+    if not data:
+        return []
+
+    # Определяем Excel-номер строки для заголовка (первая строка, попавшая в PDF)
+    header_excel_row = None
+    for ex_row, pdf_index in excel_to_pdf_index.items():
+        if pdf_index == 0:
+            header_excel_row = ex_row
+            break
+    if header_excel_row is None:
+        header_excel_row = 1
+
+    # --- Вычисление "эффективного" числа столбцов по первой (заголовочной) строке ---
+    header_row = data[0]
+    effective_max_cols = 0
+    # Перебираем столбцы с конца к началу
+    for col in range(len(header_row), 0, -1):
+        text = header_row[col - 1].getPlainText().strip()
+        if text != "":
+            effective_max_cols = col
+            break
+        else:
+            # Если ячейка пустая, проверяем, входит ли она в объединённый диапазон с ненулевым значением
+            # (значение берётся из верхней левой ячейки объединённого диапазона)
+            cell_val = merged_index.top_left_value(header_excel_row, col)
+            if cell_val is not None and str(cell_val).strip() != "":
                 effective_max_cols = col
                 break
-            else:
-                # Если ячейка пустая, проверяем, входит ли она в объединённый диапазон с ненулевым значением
-                for merged_range in ws.merged_cells.ranges:
-                    if (merged_range.min_row <= header_excel_row <= merged_range.max_row and
-                            merged_range.min_col <= col <= merged_range.max_col):
-                        # Получаем значение из верхней левой ячейки объединённого диапазона
-                        cell_val = ws.cell(row=merged_range.min_row, column=merged_range.min_col).value
-                        if cell_val is not None and str(cell_val).strip() != "":
-                            effective_max_cols = col
-                            break
-                if effective_max_cols:
-                    break
-        if effective_max_cols == 0:
-            effective_max_cols = len(header_row)
-        max_cols = effective_max_cols
-
-        # Дополняем каждую строку до max_cols, если она короче; если длиннее – обрезаем лишнее
-        for idx, r in enumerate(data):
-            if len(r) < max_cols:
-                for _ in range(max_cols - len(r)):
-                    r.append(Paragraph("", body_style))
-            elif len(r) > max_cols:
-                data[idx] = r[:max_cols]
-
-        # Равномерно распределяем ширину столбцов по всей доступной ширине страницы
-        col_width = doc.width / max_cols if max_cols else doc.width
-        col_widths = [col_width] * max_cols
-
-        # Создаём объект таблицы
-        table = Table(data, colWidths=col_widths) # , rowHeights=10
-
-        # Базовые команды стиля таблицы: сетка, выравнивание, фон и шрифт для заголовка (первые header_count строк)
-        table_style_commands = [
-            ('GRID', (0, 0), (-1, -1), 0.1, colors.gray),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('BACKGROUND', (0, 0), (-1, header_count - 1), colors.lightgrey),
-            ('FONTNAME', (0, 0), (-1, header_count - 1), 'Calibri'), # Helvetica-Bold
-            ('FONTSIZE', (0, 0), (-1, -1), 5),
-        ]
+    if effective_max_cols == 0:
+        effective_max_cols = len(header_row)
+    max_cols = effective_max_cols
 
-        # Обработка объединённых ячеек (merged cells) из Excel
-        for merged_range in ws.merged_cells.ranges:
-            min_row = merged_range.min_row
-            max_row = merged_range.max_row
-            min_col = merged_range.min_col
-            max_col = merged_range.max_col
-            if min_row in excel_to_pdf_index and max_row in excel_to_pdf_index:
-                pdf_min_row = excel_to_pdf_index[min_row]
-                pdf_max_row = excel_to_pdf_index[max_row]
-                pdf_min_col = min_col - 1  # перевод в 0-индексацию
-                pdf_max_col = max_col - 1
-                # Если объединение выходит за пределы max_cols, обрезаем его
-                if pdf_min_col >= max_cols:
-                    continue
-                pdf_max_col = min(pdf_max_col, max_cols - 1)
-                if pdf_max_col < pdf_min_col:
-                    continue
-                table_style_commands.append(('SPAN', (pdf_min_col, pdf_min_row), (pdf_max_col, pdf_max_row)))
+    # Равномерно распределяем ширину столбцов по всей доступной ширине страницы
+    col_width = doc_width / max_cols if max_cols else doc_width
+    col_widths = [col_width] * max_cols
+
+    fast_mode = streamed or (fast_rows_threshold is not None and len(data) - header_count > fast_rows_threshold)
 
-        # Обработка фонового цвета ячеек из Excel
-        for row in ws.iter_rows(min_row=1, max_row=ws.max_row):
-            if row[0].row not in excel_to_pdf_index:
+    # Дополняем каждую строку до max_cols, если она короче; если длиннее – обрезаем лишнее.
+    # Строки данных превращаем в Paragraph (в режиме больших листов – только там, где нужен перенос)
+    for idx, r in enumerate(data):
+        if idx >= header_count:
+            data[idx] = pdf_data_row(r, max_cols, col_width, body_style, fast_mode)
+            continue
+        if len(r) < max_cols:
+            for _ in range(max_cols - len(r)):
+                r.append("")
+        elif len(r) > max_cols:
+            r = data[idx] = r[:max_cols]
+        for j, cell in enumerate(r):
+            if cell == "":
+                r[j] = rl.Paragraph("", body_style)
+
+    # Базовые команды стиля таблицы: сетка, выравнивание, фон и шрифт для заголовка (первые header_count строк)
+    table_style_commands = [
+        ('GRID', (0, 0), (-1, -1), 0.1, rl.colors.gray),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('BACKGROUND', (0, 0), (-1, header_count - 1), rl.colors.lightgrey),
+        ('FONTNAME', (0, 0), (-1, header_count - 1), 'Calibri'), # Helvetica-Bold
+        ('FONTSIZE', (0, 0), (-1, -1), 5),
+    ]
+    if fast_mode:
+        # Простые строки в ячейках данных оформляем так же, как body_style
+        table_style_commands += [
+            ('FONTNAME', (0, header_count), (-1, -1), body_style.fontName),
+            ('FONTSIZE', (0, header_count), (-1, -1), body_style.fontSize),
+            ('LEADING', (0, header_count), (-1, -1), body_style.leading),
+        ]
+
+    # Обработка объединённых ячеек (merged cells) из Excel
+    span_starts = set()  # левые верхние ячейки объединений (см. background_commands)
+    for merged_range in merged_index.ranges:
+        min_row = merged_range.min_row
+        max_row = merged_range.max_row
+        min_col = merged_range.min_col
+        max_col = merged_range.max_col
+        if min_row in excel_to_pdf_index and max_row in excel_to_pdf_index:
+            pdf_min_row = excel_to_pdf_index[min_row]
+            pdf_max_row = excel_to_pdf_index[max_row]
+            pdf_min_col = min_col - 1  # перевод в 0-индексацию
+            pdf_max_col = max_col - 1
+            # Если объединение выходит за пределы max_cols, обрезаем его
+            if pdf_min_col >= max_cols:
                 continue
-            pdf_row = excel_to_pdf_index[row[0].row]
-            for j, cell in enumerate(row, start=1):
-                if j > max_cols:
-                    continue
-                fill = cell.fill
-                if fill is not None and fill.fill_type == "solid":
-                    fgColor = fill.fgColor
-                    if fgColor is not None and fgColor.rgb is not None:
-                        rgb = fgColor.rgb
-                        if len(rgb) == 8:
-                            rgb = rgb[-6:]  # удаляем альфа-канал, если есть
-                        try:
-                            cell_color = colors.HexColor("#" + rgb)
-                            table_style_commands.append(('BACKGROUND', (j - 1, pdf_row), (j - 1, pdf_row), cell_color))
-                        except Exception:
-                            pass
-
-        table.setStyle(TableStyle(table_style_commands))
-
-        # Добавляем в PDF заголовок листа, отступ и затем таблицу
-        elements.append(Paragraph(sheet_name.upper(), title_style))
-        elements.append(Spacer(1, 12))
-        elements.append(table)
-        elements.append(Spacer(1, 24))
-
-    doc.build(elements)
+            pdf_max_col = min(pdf_max_col, max_cols - 1)
+            if pdf_max_col < pdf_min_col:
+                continue
+            table_style_commands.append(('SPAN', (pdf_min_col, pdf_min_row), (pdf_max_col, pdf_max_row)))
+            span_starts.add((pdf_min_col, pdf_min_row))
+
+    # Обработка фонового цвета ячеек из Excel (собраны при формировании data): одноцветные области – одной командой
+    table_style_commands += background_commands(cell_fills, max_cols, span_starts)
+
+    # Создаём объект таблицы
+    if streamed:
+        data_rows = ((pdf_data_row(texts, max_cols, col_width, body_style, True),
+                      [(j - 1, color) for j, color in fills if j <= max_cols])
+                     for _, texts, fills in rows)
+        table = rl.SpilledTable(data, data_rows, col_widths, table_style_commands, background_commands)
+    else:
+        if fast_mode:
+            table = rl.LongTable(data, colWidths=col_widths, repeatRows=header_count)
+        else:
+            table = rl.Table(data, colWidths=col_widths) # , rowHeights=10
+        table.setStyle(rl.TableStyle(table_style_commands))
+
+    # Заголовок листа, отступ и затем таблица
+    return [rl.Paragraph(sheet_name.upper(), title_style), rl.Spacer(1, 12), table, rl.Spacer(1, 24)]
+
+
+def build_pdf(doc, elements, report_time=None):
+    """Собирает документ; если задан report_time, дата создания PDF – время отчёта (воспроизводимый файл)."""
+    if report_time is not None:
+        # В режиме invariant ReportLab ставит фиксированную дату – подменяем её на время отчёта
+        pdf_date = report_time.strftime("D:%Y%m%d%H%M%S+00'00'")
+
+        def set_creation_date(canvas, _doc):
+            canvas.setDateFormatter(lambda *args: pdf_date)
+
+        doc.build(elements, onFirstPage=set_creation_date)
+    else:
+        doc.build(elements)
+
+
+def render_pdf_fragment(elements, report_time=None):
+    """Собирает элементы в отдельный PDF-документ в памяти и возвращает его байты."""
+    buffer = io.BytesIO()
+    build_pdf(pdf_document(buffer, report_time), elements, report_time)
+    return buffer.getvalue()
+
+
+def render_sheet_pdf(sheet, sheet_name, header_count, fast_rows_threshold=1000, report_time=None):
+    """
+    PDF-фрагмент одного листа (байты) или None, если на листе нет данных. Выполняется в процессе пула
+    (см. export_to_pdf): лист приходит через pickle вместе со своей книгой, поэтому фабрики размеров
+    книги сначала восстанавливаются.
+    """
+    restore_dimension_factories((sheet.ws if isinstance(sheet, SheetModel) else sheet).parent)
+    width = pdf_document(io.BytesIO()).width
+    elements = pdf_sheet_elements(sheet, sheet_name, header_count, width, fast_rows_threshold)
+    return render_pdf_fragment(elements, report_time) if elements else None
+
+
+@contextmanager
+def pdf_pickling_sheets(sheets):
+    """
+    Листы [(лист, имя, число заголовочных строк) ...] на время передачи в процессы пула (см. export_to_pdf)
+    без картинок на всех листах их книг (лист сериализуется вместе с книгой): в PDF картинки не выводятся,
+    а после сохранения xlsx openpyxl закрывает их буферы, и книга не сериализуется
+    (ValueError: I/O operation on closed file). Картинки возвращаются на выходе.
+    """
+    workbooks = {}
+    for sheet, _, _ in sheets:
+        wb = (sheet.ws if isinstance(sheet, SheetModel) else sheet).parent
+        workbooks[id(wb)] = wb
+    images = [(ws, ws._images) for wb in workbooks.values() for ws in wb.worksheets if hasattr(ws, "_images")]
+    try:
+        for ws, _ in images:
+            ws._images = []
+        yield sheets
+    finally:
+        for ws, ws_images in images:
+            ws._images = ws_images
+
+
+def merge_pdf_fragments(fragments, output_pdf_file):
+    """
+    Склеивает PDF-фрагменты (байты) в один файл в заданном порядке. Метаданные (автор, даты создания)
+    берутся из первого фрагмента, поэтому при заданном report_time результат тоже воспроизводим.
+    """
+    pypdf = optional_import("pypdf")
+    writer = pypdf.PdfWriter()
+    metadata = None
+    for fragment in fragments:
+        reader = pypdf.PdfReader(io.BytesIO(fragment))
+        if metadata is None:
+            metadata = {key: str(value) for key, value in (reader.metadata or {}).items()}
+        writer.append(reader)
+    writer.add_metadata(metadata or {})
+    with open(output_pdf_file, "wb") as f:
+        writer.write(f)
+
+
+def export_to_pdf(workbook, sheet_order, output_pdf_file, header_rows_pdf, cover_company=None, report_time=None,
+                  fast_rows_threshold=1000, workers=1):
+    """
+    Экспортирует содержимое листов workbook в PDF-файл. workbook – модель отчёта (ReportModel)
+    или книга openpyxl; данные модели выводятся напрямую, без создания ячеек openpyxl.
+    Для каждого листа:
+      - Каждая ячейка оборачивается в Paragraph для переноса длинного текста.
+      - Для первых N строк (N задаётся в header_rows_pdf для данного листа) используется header_style
+        с выравниванием по центру (горизонтально и вертикально), для остальных – body_style.
+      - Обрабатываются объединённые ячейки (merged cells) с помощью команды SPAN.
+      - Таблица растягивается равномерно на всю ширину страницы, а число столбцов определяется по первой (заголовочной) строке,
+        при этом если пустые ячейки являются частью объединённых диапазонов, они учитываются.
+    Параметр header_rows_pdf – словарь вида: { "Лист": число_заголовочных_строк }.
+    Параметр report_time – время отчёта (UTC) для обложки и метаданных PDF. Если задан, PDF получается
+    воспроизводимым: при одинаковых данных файл совпадает побайтно.
+    Параметр fast_rows_threshold – режим больших листов: если строк данных на листе больше этого числа
+    (None – никогда), ячейки данных, которым не нужен перенос, выводятся простыми строками с тем же шрифтом,
+    размером и интерлиньяжем, что и body_style, а таблица строится как LongTable с повтором заголовочных строк
+    на каждой странице. Так ReportLab не измеряет десятки тысяч Paragraph при разбивке таблицы на страницы.
+    Параметр workers – при workers > 1 листы раскладываются на страницы параллельно, каждый в своём
+    процессе и в свой PDF-фрагмент; фрагменты склеиваются через pypdf в порядке sheet_order после обложки.
+    Каждый лист тогда начинается с новой страницы, а в последовательном режиме листы идут подряд, без разрыва
+    страницы, поэтому разбивка на страницы отличается (данные и порядок листов те же): PDF-фрагмент
+    всегда начинается с новой страницы, а границ листов, на которых последовательный экспорт сам начинает
+    новую страницу, нет.
+    Без pypdf или при одном листе экспорт идёт последовательно.
+    """
+    # Обрабатываем листы в порядке, заданном в sheet_order;
+    # количество заголовочных строк листа – из header_rows_pdf (если не указано – 1)
+    sheets = []
+    for sheet_name in sheet_order:
+        if sheet_name not in workbook.sheetnames:
+            print(f"Лист '{sheet_name}' не найден для экспорта в PDF.")
+            continue
+        sheets.append((workbook[sheet_name], sheet_name, header_rows_pdf.get(sheet_name, 1)))
+
+    if workers > 1 and len(sheets) > 1:
+        if optional_import("pypdf") is None:
+            print("pypdf не установлен – экспорт в PDF выполняется последовательно.")
+        else:
+            with pdf_pickling_sheets(sheets), ProcessPoolExecutor(max_workers=min(workers, len(sheets))) as executor:
+                futures = [executor.submit(render_sheet_pdf, sheet, sheet_name, header_count, fast_rows_threshold,
+                                           report_time)
+                           for sheet, sheet_name, header_count in sheets]
+                # Обложка собирается в этом процессе, пока листы раскладываются в пуле
+                fragments = []
+                if cover_company:
+                    fragments.append(render_pdf_fragment(pdf_cover_elements(cover_company, report_time)[:-1],
+                                                         report_time))
+                fragments.extend(fragment for fragment in (future.result() for future in futures)
+                                 if fragment is not None)
+            merge_pdf_fragments(fragments, output_pdf_file)
+            print(f"PDF-файл успешно сохранён: {output_pdf_file}")
+            return
+
+    doc = pdf_document(output_pdf_file, report_time)
+    elements = []
+
+    # Если задан cover_company, то добавляем первую обложную страницу
+    if cover_company:
+        elements.extend(pdf_cover_elements(cover_company, report_time))
+
+    for sheet, sheet_name, header_count in sheets:
+        elements.extend(pdf_sheet_elements(sheet, sheet_name, header_count, doc.width, fast_rows_threshold))
+
+    build_pdf(doc, elements, report_time)
     print(f"PDF-файл успешно сохранён: {output_pdf_file}")
 
-# =============================================================================
-# Главная функция для обработки всех файлов в директории raw_data
-# =============================================================================
-def process_all_raw_files():
-    # Пути к папкам
-    base_folder = r"C:\Users\_\Desktop\CC_report"
-    raw_data_dir = os.path.join(base_folder, "raw_data")
-    template_file = os.path.join(base_folder, "template", "temp1.xlsx")
-    result_folder = os.path.join(base_folder, "result")
-    os.makedirs(result_folder, exist_ok=True)
+# =============================================================
+# Воспроизводимое сохранение Excel-файла
+# =============================================================
+def save_workbook_stable(workbook, output_file, report_time):
+    """
+    Сохраняет книгу так же, как wb.save(), но с фиксированными временными метками:
+    дата изменения в свойствах документа и даты записей zip-архива берутся из report_time.
+    Благодаря этому один и тот же отчёт, собранный последовательно или в пуле процессов,
+    совпадает побайтно.
+    """
+    date_time = report_time.timetuple()[:6]
 
-    # Настройки: категории, числовые поля, правила удаления, количество заголовочных строк для PDF
-    categories = {
-        "Balances": 2,
-        "Trading Summary": 3,
-        "Fees Summary": 3,
-        "Positions": 2,
-    }
-    numeric_fields = {
-        "Balances": [
-            "Margin Balance", "MM", "IM", "Equity",
-            "Available Balance", "Monthly Deposit",
-            "Monthly Withdrawals", "Monthly Net Deposit"
-        ],
-        "Trading Summary": [
-            "Total Volume", "Taker Volume", "Maker Volume"
-        ],
-        "Fees Summary": [
-            "Total Fees", "Taker Fees", "Maker Fees"
-        ],
-        "Positions": [
-            "Size", "Value", "Index", "Mark"
-        ],
-    }
-    deletion_rules = {
-        "Balances": (3, 2),
-        "Trading Summary": (4, 3),
-        "Fees Summary": (4, 3),
-        "Positions": (3, 2),
+    class StableZipFile(ZipFile):
+        def writestr(self, zinfo_or_arcname, data, *args, **kwargs):
+            if not isinstance(zinfo_or_arcname, ZipInfo):
+                zinfo_or_arcname = ZipInfo(zinfo_or_arcname, date_time=date_time)
+                zinfo_or_arcname.compress_type = self.compression
+                zinfo_or_arcname.external_attr = 0o600 << 16
+            super().writestr(zinfo_or_arcname, data, *args, **kwargs)
+
+        def write(self, filename, arcname=None, *args, **kwargs):
+            # openpyxl пишет листы через временные файлы – подменяем их mtime на время отчёта
+            zinfo = ZipInfo.from_file(filename, arcname)
+            zinfo.date_time = date_time
+            zinfo.compress_type = self.compression
+            with open(filename, "rb") as src, self.open(zinfo, "w") as dest:
+                shutil.copyfileobj(src, dest, 1024 * 1024)
+
+    archive = StableZipFile(output_file, 'w', ZIP_DEFLATED, allowZip64=True)
+    workbook.properties.modified = report_time
+    ExcelWriter(workbook, archive).save()
+
+
+# =============================================================
+# Настройки отчёта
+# =============================================================
+def get_report_settings():
+    """
+    Возвращает словарь с настройками отчёта: категории (лист -> число заголовочных строк),
+    числовые поля, правила удаления дублирующих заголовков, число заголовочных строк для PDF,
+    порядок листов, порог режима больших листов в PDF, производные столбцы и история показателей по месяцам.
+    """
+    return {
+        "categories": {
+            "Balances": 2,
+            "Trading Summary": 3,
+            "Fees Summary": 3,
+            "Positions": 2,
+        },
+        "numeric_fields": {
+            "Balances": [
+                "Margin Balance", "MM", "IM", "Equity",
+                "Available Balance", "Monthly Deposit",
+                "Monthly Withdrawals", "Monthly Net Deposit"
+            ],
+            "Trading Summary": [
+                "Total Volume", "Taker Volume", "Maker Volume"
+            ],
+            "Fees Summary": [
+                "Total Fees", "Taker Fees", "Maker Fees"
+            ],
+            "Positions": [
+                "Size", "Value", "Index", "Mark"
+            ],
+        },
+        "deletion_rules": {
+            "Balances": (3, 2),
+            "Trading Summary": (4, 3),
+            "Fees Summary": (4, 3),
+            "Positions": (3, 2),
+        },
+        "header_rows_pdf": {
+            "Balances": 2,
+            "Trading Summary": 3,
+            "Fees Summary": 3,
+            "Positions": 2,
+        },
+        "sheet_order": ["Balances", "Trading Summary", "Fees Summary", "Positions"],
+        # Листы PDF с большим числом строк данных выводятся в режиме больших листов (см. export_to_pdf)
+        "pdf_fast_rows_threshold": 1000,
+        # Число процессов для параллельной раскладки листов PDF (1 – последовательно, см. export_to_pdf).
+        # Раскладка при этом другая: каждый лист начинается с новой страницы, тогда как в последовательном
+        # экспорте следующий лист продолжается на текущей странице; данные и порядок листов те же
+        "pdf_workers": 1,
+        # Режим ограниченной памяти: бюджет в МБ (None – данные листов целиком в памяти). Строки листов
+        # обрабатываются порциями и хранятся во временных файлах в spill_dir (None – системная папка).
+        # В PDF листы больше pdf_fast_rows_threshold строк выводятся потоково, меньшие – обычной таблицей, как
+        # без этого режима; при pdf_fast_rows_threshold = None все листы PDF строятся в памяти целиком
+        "memory_budget_mb": None,
+        "spill_dir": None,
+        # Кэш разобранных raw-файлов: повторный запуск по неизменённому файлу не разбирает его заново.
+        # Файлы кэша – pickle, а чтение pickle может выполнить произвольный код: в папку кэша должен писать только
+        # тот, кто запускает отчёты. По умолчанию это result/cache; если папка результатов общая (сетевой диск),
+        # задайте в raw_cache_dir личную папку (или отключите кэш: raw_cache = False)
+        "raw_cache": True,
+        "raw_cache_dir": None,
+        # Производные столбцы по листам; "clients" – для каких клиентов (по имени файла) они добавляются
+        "derived_columns": {
+            "Balances": [
+                {"header": "Trading credits", "after": "IM", "inputs": ["Margin Balance", "Equity"],
+                 "formula": "trading_credits", "clients": ["Antalpha"]},
+            ],
+        },
+        # История показателей по месяцам в result/history.sqlite (см. HistoryStore): листы, числовые столбцы
+        # которых записываются для каждого клиента и месяца после сохранения его отчёта. По умолчанию история
+        # отключена ([]) и папка результатов не меняется; чтобы включить, например:
+        #     "history_sheets": ["Balances", "Trading Summary", "Fees Summary"],
+        "history_sheets": [],
+        # Столбцы изменений по истории (см. add_history_columns), по умолчанию не добавляются – вид отчётов
+        # не меняется. Для столбца "column" – MoM (к прошлому месяцу) и YTD (с начала года: "sum" – сумма
+        # за месяцы года, "change" – изменение к декабрю, None – без YTD), например:
+        #     "Balances": [{"column": "Equity", "ytd": "change"}],
+        #     "Trading Summary": [{"column": "Aggregated / Total Volume", "ytd": "sum"}],
+        #     "Fees Summary": [{"column": "Aggregated / Total Fees", "ytd": "sum"}],
+        "history_columns": {},
     }
-    header_rows_pdf = {
-        "Balances": 2,
-        "Trading Summary": 3,
-        "Fees Summary": 3,
-        "Positions": 2,
+
+
+def make_report_base_name(filename, report_time):
+    """
+    Формирует имя отчёта по схеме "<Клиент> Coincall Monthly Report <МесГГ>".
+    Из исходного имени (например, "mm-monthly-report-Orbit.xlsx") берётся последняя часть "Orbit",
+    суффикс – сокращённое имя месяца, предшествующего report_time (например, для февраля 2025 – Jan25).
+    Возвращает пару (имя клиента, базовое имя файла).
+    """
+    base_name = os.path.splitext(filename)[0]
+    parts = base_name.split("-")
+    report_name = parts[-1].strip().capitalize() if parts else base_name.capitalize()
+    return report_name, f"{report_name} Coincall Monthly Report {report_month_suffix(report_time)}"
+
+
+def report_month_suffix(report_time):
+    """Сокращённое имя месяца, предшествующего report_time, и год: для февраля 2025 – "Jan25"."""
+    first_day_this_month = report_time.date().replace(day=1)
+    last_day_prev_month = first_day_this_month - datetime.timedelta(days=1)
+    return last_day_prev_month.strftime("%b") + last_day_prev_month.strftime("%y")
+
+
+def report_month(report_time):
+    """Месяц отчёта (предшествующий report_time) в виде "ГГГГ-ММ": для февраля 2025 – "2025-01"."""
+    first_day_this_month = report_time.date().replace(day=1)
+    return (first_day_this_month - datetime.timedelta(days=1)).strftime("%Y-%m")
+
+
+# =============================================================
+# Манифест инкрементальной пересборки
+# =============================================================
+MANIFEST_FILE = "manifest.json"
+# Настройки, от которых зависит содержимое отчёта (xlsx и PDF)
+REPORT_CONFIG_KEYS = ("categories", "numeric_fields", "deletion_rules", "derived_columns", "history_sheets",
+                      "history_columns")
+# Настройки, от которых зависит только PDF
+PDF_CONFIG_KEYS = ("header_rows_pdf", "sheet_order", "pdf_fast_rows_threshold", "pdf_workers")
+# Выходные файлы отчёта; запуск может строить только часть из них (--xlsx-only, --pdf-only)
+REPORT_OUTPUTS = ("xlsx", "pdf")
+
+
+def file_sha256(path):
+    """SHA-256 содержимого файла (читается блоками)."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def settings_fingerprint(settings, keys):
+    """SHA-256 от указанных настроек в каноническом JSON-представлении."""
+    subset = {key: settings[key] for key in keys}
+    return hashlib.sha256(json.dumps(subset, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def load_manifest(result_folder):
+    """Читает манифест из папки результатов; при отсутствии или повреждении возвращает пустой."""
+    path = os.path.join(result_folder, MANIFEST_FILE)
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if isinstance(manifest.get("files"), dict):
+            return manifest
+        print(f"Манифест '{path}' имеет неверный формат и будет перестроен.")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Не удалось прочитать манифест '{path}': {e}. Он будет перестроен.")
+    return {"version": 1, "files": {}}
+
+
+def save_manifest(result_folder, manifest):
+    """Атомарно записывает манифест (через временный файл и os.replace)."""
+    path = os.path.join(result_folder, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def raw_file_fingerprint(raw_file, previous_entry):
+    """
+    Отпечаток raw-файла: размер, mtime и SHA-256. Если размер и mtime совпадают с записью манифеста,
+    хэш берётся из неё, чтобы не перечитывать неизменённые файлы.
+    """
+    stat = os.stat(raw_file)
+    fingerprint = {"raw_size": stat.st_size, "raw_mtime": stat.st_mtime_ns}
+    if previous_entry and all(previous_entry.get(k) == v for k, v in fingerprint.items()) and previous_entry.get("raw"):
+        fingerprint["raw"] = previous_entry["raw"]
+    else:
+        fingerprint["raw"] = file_sha256(raw_file)
+    return fingerprint
+
+
+def plan_rebuild(entry, current, result_folder, force=False, pdf_only=False, outputs=REPORT_OUTPUTS):
+    """
+    Решает, что нужно пересобрать для файла: "full" (модель отчёта и выходные файлы из outputs),
+    "pdf" (только PDF по сохранённому xlsx) или "skip".
+    entry – запись манифеста с прошлого запуска, current – текущие отпечатки и имена выходных файлов.
+    pdf_only=True пересобирает PDF, даже если он не устарел.
+    """
+    if force or not entry:
+        return "full"
+    inputs_same = all(entry.get(k) == current[k] for k in ("raw", "template", "config", "history"))
+    xlsx_ok = (inputs_same and entry.get("xlsx") == current["xlsx"]
+               and os.path.exists(os.path.join(result_folder, current["xlsx"])))
+    pdf_ok = (inputs_same and not pdf_only and entry.get("pdf") == current["pdf"]
+              and entry.get("pdf_config") == current["pdf_config"]
+              and os.path.exists(os.path.join(result_folder, current["pdf"])))
+    need_xlsx = "xlsx" in outputs and not xlsx_ok
+    need_pdf = "pdf" in outputs and not pdf_ok
+    if not need_xlsx and not need_pdf:
+        return "skip"
+    if not need_xlsx and xlsx_ok:
+        return "pdf"
+    return "full"
+
+
+def common_fingerprints(template_file, settings):
+    """Отпечатки, общие для всех файлов запуска: шаблон, настройки отчёта и настройки PDF."""
+    return {
+        "template": file_sha256(template_file),
+        "config": settings_fingerprint(settings, REPORT_CONFIG_KEYS),
+        "pdf_config": settings_fingerprint(settings, PDF_CONFIG_KEYS),
     }
-    sheet_order = ["Balances", "Trading Summary", "Fees Summary", "Positions"]
-    header_font = Font(bold=True, size=11)
 
-    # Обрабатываем каждый файл в директории raw_data
-    for filename in os.listdir(raw_data_dir):
-        if not filename.lower().endswith('.xlsx'):
+
+def plan_raw_file(raw_file, manifest, common, result_folder, report_time, force=False, pdf_only=False,
+                  outputs=REPORT_OUTPUTS, history=None, history_recorded=True):
+    """
+    Текущие отпечатки raw-файла (с именами выходных файлов) и решение plan_rebuild для него.
+    history – отпечаток данных истории, от которых зависят столбцы MoM/YTD (см. history_plan; None – не зависят);
+    history_recorded=False – показателей файла за месяц нет в истории, и отчёт собирается заново, чтобы их записать.
+    Возвращает (действие, запись для манифеста).
+    """
+    filename = os.path.basename(raw_file)
+    entry = manifest["files"].get(filename)
+    _, new_base_name = make_report_base_name(filename, report_time)
+    current = dict(common, xlsx=new_base_name + ".xlsx", pdf=new_base_name + ".pdf", history=history,
+                   **raw_file_fingerprint(raw_file, entry))
+    action = plan_rebuild(entry, current, result_folder, force=force or not history_recorded, pdf_only=pdf_only,
+                          outputs=outputs)
+    return action, current
+
+
+def record_result(manifest, result, current):
+    """
+    Обновляет манифест по результату обработки: успешно собранный файл получает новые отпечатки,
+    ошибочный удаляется из манифеста, чтобы в следующий раз он был пересобран.
+    Вместе с отпечатками хранится сводка агрегированных строк (report_summary) – для сводного отчёта.
+    Выходной файл, который в этом запуске не строился (--xlsx-only, --pdf-only), записывается как None,
+    чтобы следующий полный запуск его собрал.
+    """
+    if result["status"] == "ok":
+        # Сводка агрегированных строк нужна для roll-up; при пересборке только PDF остаётся прежняя
+        previous = manifest["files"].get(result["file"]) or {}
+        summary = result.get("summary") or previous.get("summary")
+        entry = dict(current, **{output: None for output in REPORT_OUTPUTS if result.get(output) is None})
+        manifest["files"][result["file"]] = dict(entry, summary=summary) if summary else entry
+    elif result["status"] == "error":
+        manifest["files"].pop(result["file"], None)
+
+
+# =============================================================================
+# Метрики этапов обработки
+# =============================================================================
+METRICS_JSON_FILE = "metrics.json"
+METRICS_CSV_FILE = "metrics.csv"
+METRICS_CSV_FIELDS = ("file", "stage", "sheet", "wall", "cpu", "rows", "rss_growth_mb", "peak_traced_mb")
+PROFILE_MODES = ("cprofile", "tracemalloc")
+
+
+def peak_rss_mb(children=False):
+    """
+    Пиковый RSS за всё время жизни текущего процесса в МБ (None, если недоступен – например, на Windows);
+    children=True – наибольший пик среди завершённых дочерних процессов (пулов).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss на Linux – в килобайтах, на macOS – в байтах
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class StageMetrics:
+    """
+    Метрики обработки одного файла по этапам: время (wall), процессорное время (cpu),
+    число обработанных строк и прирост пиковой памяти процесса за этап.
+    profile – необязательный хук на каждый этап:
+      - "cprofile" – профиль этапа сохраняется в profile_dir/<файл>.<этап>[.<лист>].prof (смотреть через pstats/snakeviz),
+      - "tracemalloc" – пик выделенной Python-памяти за этап (peak_traced_mb); заметно замедляет обработку.
+    rss_growth_mb – на сколько этап поднял пиковый RSS процесса (ru_maxrss в конце этапа минус в начале).
+    ru_maxrss – пик за всё время жизни процесса, поэтому этап, который не превысил пик предыдущих этапов
+    и файлов, получает 0, а не свой собственный пик: это не пиковая память этапа или файла. Пик файла даёт
+    только "tracemalloc" – пик сбрасывается в начале каждого этапа (см. write_metrics); пиковый RSS
+    всего запуска – в сведениях о запуске.
+    """
+
+    def __init__(self, filename, profile=None, profile_dir=None):
+        if profile is not None and profile not in PROFILE_MODES:
+            raise ValueError(f"Неизвестный режим профилирования: '{profile}' (допустимо: {', '.join(PROFILE_MODES)}).")
+        self.filename = filename
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.rows = {}
+
+    @contextmanager
+    def stage(self, name, sheet=None, rows=None):
+        """
+        Замеряет блок кода как этап name (для этапов по листам – с указанием sheet).
+        Возвращает запись этапа; число строк можно уточнить внутри блока через record["rows"].
+        """
+        record = {"file": self.filename, "stage": name, "sheet": sheet, "wall": None, "cpu": None, "rows": rows,
+                  "rss_growth_mb": None, "peak_traced_mb": None}
+        profiler = cProfile.Profile() if self.profile == "cprofile" else None
+        if self.profile == "tracemalloc":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        rss_start = peak_rss_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record["wall"] = round(time.perf_counter() - wall_start, 4)
+            record["cpu"] = round(time.process_time() - cpu_start, 4)
+            if rss_start is not None:
+                record["rss_growth_mb"] = round(peak_rss_mb() - rss_start, 1)
+            if self.profile == "tracemalloc":
+                record["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+            if profiler is not None and self.profile_dir:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                suffix = f".{sheet}" if sheet else ""
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{self.filename}.{name}{suffix}.prof"))
+            self.stages.append(record)
+
+    def as_dict(self):
+        """Метрики файла для записи-результата (передаются из процессов-обработчиков)."""
+        return {"rows": dict(self.rows), "stages": list(self.stages)}
+
+
+def write_metrics(result_folder, results, run_info):
+    """
+    Записывает метрики запуска в result_folder:
+      - metrics.json – сведения о запуске (run_info) и по каждому файлу: статус, общее время, строки по листам, этапы
+        и peak_traced_mb – пик Python-памяти за обработку файла (наибольший из пиков этапов; только с профилем
+        "tracemalloc", иначе None);
+      - metrics.csv – плоская таблица этапов (одна строка на этап файла) для Excel/pandas.
+    Пиковый RSS – один раз на запуск, в сведениях о запуске: peak_rss_mb – основного процесса,
+    peak_children_rss_mb – наибольший среди завершённых процессов пулов (по этапам – только прирост, см. StageMetrics).
+    """
+    run_info = dict(run_info, peak_rss_mb=peak_rss_mb(), peak_children_rss_mb=peak_rss_mb(children=True))
+    files = []
+    stage_rows = []
+    for r in results:
+        metrics = r.get("metrics") or {}
+        traced = [stage["peak_traced_mb"] for stage in metrics.get("stages", []) if stage["peak_traced_mb"] is not None]
+        files.append({"file": r["file"], "status": r["status"], "wall": r.get("wall"), "cpu": r.get("cpu"),
+                      "rows": metrics.get("rows", {}), "peak_traced_mb": max(traced, default=None),
+                      "stages": metrics.get("stages", [])})
+        stage_rows.extend(metrics.get("stages", []))
+
+    with open(os.path.join(result_folder, METRICS_JSON_FILE), "w", encoding="utf-8") as f:
+        json.dump({"run": run_info, "files": files}, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(result_folder, METRICS_CSV_FILE), "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=METRICS_CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(stage_rows)
+
+
+# =============================================================================
+# История показателей по месяцам (result/history.sqlite)
+# =============================================================================
+HISTORY_FILE = "history.sqlite"
+# Пользователь агрегированной строки листа в истории
+HISTORY_AGGREGATED = "Aggregated"
+# Способы расчёта столбца YTD (см. history_columns в настройках)
+HISTORY_YTD_MODES = ("sum", "change")
+
+
+def history_file(result_folder, settings):
+    """Путь к истории показателей в result_folder или None, если история отключена (пустой history_sheets)."""
+    return os.path.join(result_folder, HISTORY_FILE) if settings["history_sheets"] else None
+
+
+def previous_month(month, months=1):
+    """Месяц "ГГГГ-ММ" на months раньше month: для "2026-01" – "2025-12"."""
+    year, mon = month.split("-")
+    index = int(year) * 12 + int(mon) - 1 - months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def history_user_key(value):
+    """Ключ пользователя в истории: числовой User ID без дробной части ("1000"); для нечисловых (NaN) – None."""
+    if value != value:
+        return None
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class HistoryStore:
+    """
+    История показателей отчётов по месяцам в файле SQLite: для каждого клиента и месяца "ГГГГ-ММ" – значения
+    числовых столбцов листов по пользователям (User ID) и агрегированной строки (пользователь "Aggregated").
+    Месяцы только добавляются: прошлые месяцы не пересчитываются, повторная запись месяца (пересборка отчёта
+    за тот же месяц) заменяет только его. Первичный ключ (клиент, лист, столбец, месяц, пользователь), поэтому
+    значения прошлого месяца и суммы с начала года читаются диапазоном по индексу, без старых raw-файлов.
+    Писать могут несколько процессов сразу (процессы конвейера): запись ждёт блокировку до timeout секунд.
+    readonly=True – только чтение (столбцы MoM/YTD, сервис отчётов): файл открывается в режиме "ro",
+    схема не создаётся, запись невозможна; если файла ещё нет, он не создаётся – история пуста.
+    sqlite3 импортируется только здесь.
+    """
+
+    def __init__(self, path, timeout=60, readonly=False):
+        import sqlite3
+        self.path = path
+        self.readonly = readonly
+        if readonly:
+            if os.path.exists(path):
+                from pathlib import Path
+                self.conn = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", timeout=timeout, uri=True)
+                return
+            self.conn = sqlite3.connect(":memory:")  # пустая история в памяти – файл не создаётся
+        else:
+            self.conn = sqlite3.connect(path, timeout=timeout)
+            # Обычный журнал отката, не WAL: в режиме WAL даже читатель "ro" оставляет рядом файлы -wal/-shm.
+            # Запись – одна короткая транзакция на отчёт, её ожидание покрывает timeout
+            self.conn.execute("PRAGMA journal_mode=DELETE")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS months (client TEXT NOT NULL, month TEXT NOT NULL, "
+                              "source TEXT, recorded TEXT, PRIMARY KEY (client, month))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS figures (client TEXT NOT NULL, sheet TEXT NOT NULL, "
+                              "header TEXT NOT NULL, month TEXT NOT NULL, user_id TEXT NOT NULL, value REAL NOT NULL, "
+                              "PRIMARY KEY (client, sheet, header, month, user_id)) WITHOUT ROWID")
+
+    def close(self):
+        self.conn.close()
+
+    def record(self, client, month, source, figures):
+        """
+        Записывает показатели клиента за месяц: figures – { (лист, заголовок, пользователь): значение }
+        (см. history_figures), source – имя raw-файла. Прежние показатели этого месяца заменяются целиком.
+        """
+        recorded = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+        with self.conn:
+            self.conn.execute("DELETE FROM figures WHERE client = ? AND month = ?", (client, month))
+            self.conn.executemany("INSERT INTO figures VALUES (?, ?, ?, ?, ?, ?)",
+                                  ((client, sheet, header, month, user, value)
+                                   for (sheet, header, user), value in figures.items()))
+            self.conn.execute("INSERT OR REPLACE INTO months VALUES (?, ?, ?, ?)", (client, month, source, recorded))
+
+    def fingerprint(self, client, month):
+        """
+        SHA-256 данных истории, от которых зависят столбцы MoM/YTD отчёта клиента за month (см. history_deltas):
+        показатели и записанные месяцы с декабря прошлого года по прошлый месяц и наличие более ранних месяцев.
+        Дозапись или исправление любого из этих месяцев меняет отпечаток.
+        """
+        first, last = f"{int(month[:4]) - 1:04d}-12", previous_month(month)
+        digest = hashlib.sha256()
+        digest.update(repr((bool(self.months(client, "0000-01", last)), self.months(client, first, last))).encode("utf-8"))
+        rows = self.conn.execute("SELECT sheet, header, month, user_id, value FROM figures WHERE client = ? "
+                                 "AND month BETWEEN ? AND ? ORDER BY sheet, header, month, user_id",
+                                 (client, first, last))
+        for row in rows:
+            digest.update(repr(row).encode("utf-8"))
+        return digest.hexdigest()
+
+    def clients(self, month):
+        """Клиенты, показатели которых записаны за месяц."""
+        return {client for client, in self.conn.execute("SELECT client FROM months WHERE month = ?", (month,))}
+
+    def months(self, client, first, last):
+        """Месяцы клиента с first по last включительно, для которых есть записи."""
+        rows = self.conn.execute("SELECT month FROM months WHERE client = ? AND month BETWEEN ? AND ? ORDER BY month",
+                                 (client, first, last))
+        return [month for month, in rows]
+
+    def values(self, client, sheet, header, month):
+        """Значения столбца header листа sheet за месяц: { пользователь: значение }."""
+        rows = self.conn.execute("SELECT user_id, value FROM figures WHERE client = ? AND sheet = ? AND header = ? "
+                                 "AND month = ?", (client, sheet, header, month))
+        return dict(rows)
+
+    def totals(self, client, sheet, header, first, last):
+        """Суммы значений столбца за месяцы с first по last включительно: { пользователь: сумма }."""
+        rows = self.conn.execute("SELECT user_id, SUM(value) FROM figures WHERE client = ? AND sheet = ? AND header = ? "
+                                 "AND month BETWEEN ? AND ? GROUP BY user_id", (client, sheet, header, first, last))
+        return dict(rows)
+
+
+def history_figures(report, sheets, numeric_fields, indicator_header="User ID"):
+    """
+    Показатели модели отчёта для истории: { (лист, заголовок, пользователь): значение } по числовым столбцам
+    (numeric_fields) листов sheets – для каждой строки данных с числовым User ID и для агрегированной строки.
+    Заголовок – полный путь (SheetSchema.header_path), как в сводке report_summary; повторы пользователя
+    на листе суммируются. Данные читаются порциями (column_chunks), в том числе в режиме ограниченной памяти.
+    """
+    figures = {}
+    for name in sheets:
+        if name not in report.sheetnames:
+            continue
+        sheet = report[name]
+        schema = sheet.schema
+        user_col = schema.find(indicator_header)
+        if user_col is None:
+            print(f"Столбец '{indicator_header}' не найден в листе '{name}': показатели не записаны в историю.")
+            continue
+        headers = [(col, schema.header_path(col) or schema.label(col))
+                   for col in schema.columns_with_label(numeric_fields.get(name, []))]
+        for n, columns in sheet.column_chunks():
+            users = [history_user_key(user) for user in column_numbers(columns, user_col, n)]
+            for col, header in headers:
+                for user, value in zip(users, column_numbers(columns, col, n)):
+                    if user is not None and value == value:
+                        key = (name, header, user)
+                        figures[key] = figures.get(key, 0.0) + value
+        for col, header in headers:
+            value = (sheet.summary or {}).get(col, (None,))[0]
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+                figures[(name, header, HISTORY_AGGREGATED)] = value
+    return figures
+
+
+class HistoryDelta:
+    """
+    Формула столбца истории (см. add_history_columns): значение строки плюс sign * значение пользователя из base
+    ({ пользователь: значение }). Пользователя нет в base – default или, если default None, NaN (пустая ячейка);
+    base None – в истории нет нужных месяцев, весь столбец пустой.
+    """
+
+    def __init__(self, base, sign, default=None):
+        self.base = base
+        self.sign = sign
+        self.default = default
+
+    def value(self, user, value):
+        if self.base is None:
+            return float("nan")
+        prior = self.base.get(user, self.default)
+        return float("nan") if prior is None else value + self.sign * prior
+
+    def __call__(self, users, values):
+        return array("d", [self.value(history_user_key(user), value) for user, value in zip(users, values)])
+
+
+def history_deltas(store, client, sheet_name, header, month, ytd):
+    """Пары (суффикс заголовка, HistoryDelta) столбцов истории: MoM и, если задан ytd ("sum" или "change"), YTD."""
+    deltas = [("MoM", HistoryDelta(store.values(client, sheet_name, header, previous_month(month)), -1))]
+    if ytd == "sum":
+        # Сумма с начала года: текущий месяц плюс прошлые месяцы года; без всех прошлых месяцев года – пусто
+        year_start, last = month[:4] + "-01", previous_month(month)
+        complete = len(store.months(client, year_start, last)) == int(month[5:]) - 1
+        deltas.append(("YTD", HistoryDelta(store.totals(client, sheet_name, header, year_start, last) if complete
+                                           else None, 1, 0.0)))
+    elif ytd == "change":
+        # Изменение к концу прошлого года (декабрь)
+        deltas.append(("YTD", HistoryDelta(store.values(client, sheet_name, header, f"{int(month[:4]) - 1:04d}-12"), -1)))
+    elif ytd is not None:
+        raise ValueError(f"Неизвестный способ расчёта YTD: {ytd!r} (допустимы {', '.join(HISTORY_YTD_MODES)} или None)")
+    return deltas
+
+
+def add_history_columns(report, store, client, month, history_columns, indicator_header="User ID"):
+    """
+    Добавляет столбцы изменений по истории (HistoryStore), объявленные в настройках:
+        { "Имя листа": [{"column": заголовок, "ytd": "sum" | "change" | None} ...] }
+    Для столбца column (полный путь, например "Aggregated / Total Volume", или нижний заголовок) добавляются
+      - "<заголовок> MoM" – изменение к прошлому месяцу;
+      - "<заголовок> YTD" – с начала года: "sum" – сумма за месяцы года по month включительно (обороты, комиссии),
+        "change" – изменение к декабрю прошлого года (остатки).
+    Столбцы ставятся после группы заголовков столбца (см. SheetSchema.group_end), чтобы группы вроде "Aggregated"
+    не разрывались; в многострочном заголовке их заголовок – полный путь, объединённый по вертикали.
+    Если в истории нет ни одного прошлого месяца клиента, столбцы не добавляются и вид отчёта не меняется.
+    Строки сопоставляются с историей по User ID, агрегированная строка – с сохранёнными агрегированными строками;
+    нет данных – пустая ячейка. На столбец – один-два запроса по индексу истории, старые raw-файлы не читаются.
+    """
+    if history_columns and not store.months(client, "0000-01", previous_month(month)):
+        print(f"В истории нет прошлых месяцев клиента '{client}': столбцы MoM/YTD не добавляются.")
+        return
+    for sheet_name, specs in history_columns.items():
+        if sheet_name not in report.sheetnames:
             continue
-        raw_file = os.path.join(raw_data_dir, filename)
-        print("Обработка файла:", raw_file)
-        data_dict = load_raw_data(raw_file, categories)
-        wb = fill_template(template_file, data_dict, categories, numeric_fields, header_font)
-        delete_duplicate_headers(wb, deletion_rules)
-
-        # Массив исключений (на данный момент только "Antalpha")
-        exceptions_list = ["Antalpha"]
-
-        # Если имя файла содержит одно из исключённых слов, обрабатываем лист Balances
-        process_exception_column(wb, filename, exceptions_list, sheet_name="Balances", header_row=categories["Balances"])
-
-        # Вычисление агрегированных строк для листов
-        if "Balances" in wb.sheetnames:
-            ws = wb["Balances"]
-            header_row_num = categories["Balances"]
-            data_start_row = header_row_num + 1
-            compute_aggregated_row(ws, header_row_num, data_start_row, numeric_fields["Balances"], indicator_header="User ID", aggregate_all=False)
-        if "Trading Summary" in wb.sheetnames:
-            ws = wb["Trading Summary"]
-            header_row_num = categories["Trading Summary"]
-            data_start_row = header_row_num + 1
-            compute_aggregated_row(ws, header_row_num, data_start_row, numeric_fields["Trading Summary"], indicator_header="User ID", aggregate_all=True)
-        if "Fees Summary" in wb.sheetnames:
-            ws = wb["Fees Summary"]
-            header_row_num = categories["Fees Summary"]
-            data_start_row = header_row_num + 1
-            compute_aggregated_row(ws, header_row_num, data_start_row, numeric_fields["Fees Summary"], indicator_header="User ID", aggregate_all=True)
-
-        # Формируем новое имя файла по схеме:
-        # Из исходного имени (например, "mm-monthly-report-Orbit.xlsx") берём последнюю часть "Orbit"
-        base_name = os.path.splitext(filename)[0]
-        parts = base_name.split("-")
-        report_name = parts[-1].strip().capitalize() if parts else base_name.capitalize()
-        # Вычисляем сокращённое имя предыдущего месяца (например, если сегодня февраль 2025, то предыдущий месяц - Jan25)
-        today = datetime.date.today()
-        first_day_this_month = today.replace(day=1)
-        last_day_prev_month = first_day_this_month - datetime.timedelta(days=1)
-        suffix = last_day_prev_month.strftime("%b") + last_day_prev_month.strftime("%y")
-        new_base_name = f"{report_name} Coincall Monthly Report {suffix}"
-
-        # Сохраняем Excel-файл
+        sheet = report[sheet_name]
+        for spec in specs:
+            schema = sheet.schema
+            col = schema.find_path(spec["column"])
+            user_col = schema.find(indicator_header)
+            if col is None or user_col is None:
+                print(f"Столбец '{spec['column'] if col is None else indicator_header}' не найден в заголовке листа '{sheet_name}'.")
+                continue
+            header = schema.header_path(col) or schema.label(col)
+            label = header.replace(" / ", " ")
+            # Заголовок – со строки под названием листа, как у столбцов вне групп ("User ID")
+            header_row = min(2, sheet.header_rows)
+            current = (sheet.summary or {}).get(col, (None,))[0]
+            target = schema.group_end(col)
+            for suffix, delta in history_deltas(store, client, sheet_name, header, month, spec.get("ytd")):
+                # Столбцы вставляются правее исходного, поэтому его номер col не меняется
+                column = sheet.derived_column([user_col, col], delta)
+                target += 1
+                if normalize_header(schema.label(target)) == normalize_header(f"{label} {suffix}"):
+                    sheet.set_column(target, column)
+                else:
+                    sheet.insert_column(target, header_row, f"{label} {suffix}", column)
+                    schema.merge_down(header_row, target)
+                if sheet.summary is not None and isinstance(current, (int, float)):
+                    value = delta.value(HISTORY_AGGREGATED, current)
+                    sheet.summary[target] = (value, NUMBER_FORMAT) if value == value else (None, "General")
+
+
+def history_plan(result_folder, settings, raw_files, report_time):
+    """
+    Состояние истории для решения о пересборке (см. plan_raw_file): пара
+    ({ имя raw-файла: отпечаток истории (HistoryStore.fingerprint) }, { имена файлов, чьих показателей за месяц
+    ещё нет в истории }). Отпечатки считаются, только если в отчёты добавляются столбцы истории (history_columns).
+    Без истории – ({}, set()).
+    """
+    path = history_file(result_folder, settings)
+    if path is None:
+        return {}, set()
+    month = report_month(report_time)
+    fingerprints = {}
+    store = HistoryStore(path, readonly=True)
+    try:
+        recorded = store.clients(month)
+        clients = {os.path.basename(raw_file): make_report_base_name(os.path.basename(raw_file), report_time)[0]
+                   for raw_file in raw_files}
+        if settings["history_columns"]:
+            fingerprints = {filename: store.fingerprint(client, month) for filename, client in clients.items()}
+    finally:
+        store.close()
+    return fingerprints, {filename for filename, client in clients.items() if client not in recorded}
+
+
+def report_history(result_folder, settings, raw_file, report_time, record=True):
+    """
+    Параметры этапа истории (см. history_stage) для отчёта по raw_file за месяц report_time или None,
+    если история отключена. record=False – история только читается (например, в сервисе отчётов).
+    """
+    path = history_file(result_folder, settings)
+    if path is None:
+        return None
+    filename = os.path.basename(raw_file)
+    return {"file": path, "client": make_report_base_name(filename, report_time)[0],
+            "month": report_month(report_time), "source": filename, "record": record}
+
+
+def history_stage(report, history, settings, metrics):
+    """
+    Этап «история» при построении модели: добавляет столбцы изменений к прошлым месяцам (см. add_history_columns).
+    История здесь только читается; показатели месяца записывает record_history_stage после сохранения отчёта.
+    history – см. report_history.
+    """
+    store = HistoryStore(history["file"], readonly=True)
+    try:
+        with metrics.stage("add_history_columns"):
+            add_history_columns(report, store, history["client"], history["month"], settings["history_columns"])
+    finally:
+        store.close()
+
+
+def record_history_stage(report, history, settings, filename, profile=None, profile_dir=None):
+    """
+    Этап «запись истории»: записывает показатели модели за месяц в историю (HistoryStore.record).
+    Выполняется после сохранения xlsx и PDF: если отчёт не записан, месяц не считается записанным, и следующий
+    запуск пересоберёт отчёт (см. history_plan). Возвращает метрики этапа.
+    """
+    metrics = StageMetrics(filename, profile=profile, profile_dir=profile_dir)
+    with metrics.stage("record_history") as record:
+        figures = history_figures(report, settings["history_sheets"], settings["numeric_fields"])
+        store = HistoryStore(history["file"])
+        try:
+            store.record(history["client"], history["month"], history["source"], figures)
+        finally:
+            store.close()
+        record["rows"] = len(figures)
+    return metrics.as_dict()
+
+
+def backfill_history(month, base_folder=BASE_FOLDER, raw_data_dir=None, template_file=None, result_folder=None):
+    """
+    Записывает в историю показатели raw-файлов из raw_data_dir за месяц month ("ГГГГ-ММ") без построения
+    отчётов – например, выгрузки прошлых месяцев при первом включении истории. Папки – как в
+    process_all_raw_files; отчёты, манифест и кэш raw-файлов не меняются. Возвращает число записанных клиентов.
+    """
+    raw_data_dir, template_file, result_folder = report_folders(base_folder, raw_data_dir, template_file, result_folder)
+    settings = get_report_settings()
+    month = report_month(month_report_time(month))
+    path = history_file(result_folder, settings)
+    if path is None:
+        print("История показателей отключена (настройка history_sheets).")
+        return 0
+
+    recorded = 0
+    store = HistoryStore(path)
+    try:
+        for client, raw_file in sorted(client_raw_files(raw_data_dir).items()):
+            try:
+                report = build_report(raw_file, template_file, settings)
+                try:
+                    figures = history_figures(report, settings["history_sheets"], settings["numeric_fields"])
+                finally:
+                    report.close()
+                store.record(client, month, os.path.basename(raw_file), figures)
+            except Exception:
+                print(f"Ошибка при записи истории по файлу '{os.path.basename(raw_file)}':\n{traceback.format_exc()}")
+                continue
+            recorded += 1
+            print(f"История: {client} за {month} – записано значений: {len(figures)}.")
+    finally:
+        store.close()
+    print(f"Готово: в историю {path} за {month} записаны {recorded} клиентов.")
+    return recorded
+
+
+# =============================================================================
+# Обработка одного raw-файла: загрузка -> заполнение -> агрегаты -> xlsx -> PDF
+# =============================================================================
+def build_report(raw_file, template_file, settings, metrics=None, cache_dir=None):
+    """
+    Строит модель отчёта (ReportModel) по raw-файлу: загрузка данных (без дублирующих заголовков),
+    типизированные столбцы по шаблону, производные столбцы из настроек (например, "Trading credits")
+    и агрегированные строки.
+    Все вычисления выполняются над моделью; книга openpyxl заполняется только при записи xlsx (см. fill_template).
+    Если в настройках задан memory_budget_mb, данные листов хранятся порциями на диске (см. SpilledSheetModel);
+    временные файлы удаляет report.close() после записи отчёта.
+    metrics – StageMetrics, в который записываются замеры этапов (по умолчанию создаётся новый).
+    cache_dir – папка кэша разобранных raw-файлов (см. load_raw_columns); None – raw-файл всегда разбирается заново.
+    """
+    filename = os.path.basename(raw_file)
+    categories = settings["categories"]
+    numeric_fields = settings["numeric_fields"]
+    if metrics is None:
+        metrics = StageMetrics(filename)
+
+    if settings["memory_budget_mb"]:
+        # Режим ограниченной памяти: строки сразу уходят порциями на диск, модель строится по мере чтения
+        with metrics.stage("load_raw_data") as record:
+            numeric_cols = raw_numeric_columns(template_file, categories, numeric_fields)
+            rows = iter_raw_rows(raw_file, categories, settings["deletion_rules"], numeric_cols)
+            report = create_spilled_report_model(template_file, rows, categories, numeric_fields,
+                                                  settings["memory_budget_mb"], settings["spill_dir"])
+            record["rows"] = sum(sheet.n_rows for sheet in report.sheets.values())
+    elif cache_dir:
+        with metrics.stage("load_raw_data") as record:
+            numeric_cols = raw_numeric_columns(template_file, categories, numeric_fields)
+            sheet_columns = load_raw_columns(raw_file, categories, settings["deletion_rules"], numeric_cols, cache_dir)
+            record["rows"] = sum(n_rows for n_rows, _ in sheet_columns.values())
+        with metrics.stage("create_report_model", rows=record["rows"]):
+            report = report_model_from_columns(template_file, sheet_columns, categories)
+    else:
+        with metrics.stage("load_raw_data") as record:
+            numeric_cols = raw_numeric_columns(template_file, categories, numeric_fields)
+            data_dict = load_raw_data(raw_file, categories, settings["deletion_rules"], numeric_cols)
+            record["rows"] = sum(len(rows) for rows in data_dict.values())
+        with metrics.stage("create_report_model", rows=record["rows"]):
+            report = create_report_model(template_file, data_dict, categories, numeric_fields)
+
+    try:
+        compute_report(report, filename, settings, metrics)
+    except BaseException:
+        report.close()
+        raise
+    return report
+
+
+def compute_report(report, filename, settings, metrics):
+    """Производные столбцы и агрегированные строки модели отчёта (см. build_report)."""
+    categories = settings["categories"]
+    numeric_fields = settings["numeric_fields"]
+
+    # Производные столбцы (например, "Trading credits" для клиентов из настроек)
+    with metrics.stage("apply_derived_columns", rows=sum(sheet.n_rows for sheet in report.sheets.values())):
+        apply_derived_columns(report, filename, settings["derived_columns"])
+
+    # Вычисление агрегированных строк для листов
+    if "Balances" in report.sheetnames:
+        sheet = report["Balances"]
+        header_row_num = categories["Balances"]
+        data_start_row = header_row_num + 1
+        with metrics.stage("compute_aggregated_row", sheet="Balances", rows=sheet.n_rows):
+            compute_aggregated_row(sheet, header_row_num, data_start_row, numeric_fields["Balances"], indicator_header="User ID", aggregate_all=False)
+    if "Trading Summary" in report.sheetnames:
+        sheet = report["Trading Summary"]
+        header_row_num = categories["Trading Summary"]
+        data_start_row = header_row_num + 1
+        with metrics.stage("compute_aggregated_row", sheet="Trading Summary", rows=sheet.n_rows):
+            compute_aggregated_row(sheet, header_row_num, data_start_row, numeric_fields["Trading Summary"], indicator_header="User ID", aggregate_all=True)
+    if "Fees Summary" in report.sheetnames:
+        sheet = report["Fees Summary"]
+        header_row_num = categories["Fees Summary"]
+        data_start_row = header_row_num + 1
+        with metrics.stage("compute_aggregated_row", sheet="Fees Summary", rows=sheet.n_rows):
+            compute_aggregated_row(sheet, header_row_num, data_start_row, numeric_fields["Fees Summary"], indicator_header="User ID", aggregate_all=True)
+
+    metrics.rows = {name: sheet.n_rows for name, sheet in report.sheets.items()}
+
+
+def report_rows(report):
+    """Число строк данных по листам: для модели – строки данных, для книги openpyxl – max_row листов."""
+    if isinstance(report, ReportModel):
+        return {name: sheet.n_rows for name, sheet in report.sheets.items()}
+    return {ws.title: ws.max_row for ws in report.worksheets}
+
+
+def build_stage(raw_file, template_file, settings, profile=None, profile_dir=None, cache_dir=None, history=None):
+    """
+    Этап «загрузка и вычисления»: модель отчёта и метрики этапа (см. build_report).
+    history – параметры истории показателей (см. report_history) для столбцов MoM/YTD; None – без истории.
+    Показатели месяца записываются в историю позже, после сохранения отчёта (см. record_history_stage).
+    """
+    print("Обработка файла:", raw_file)
+    metrics = StageMetrics(os.path.basename(raw_file), profile=profile, profile_dir=profile_dir)
+    report = build_report(raw_file, template_file, settings, metrics, cache_dir)
+    if history:
+        try:
+            history_stage(report, history, settings, metrics)
+        except BaseException:
+            report.close()
+            raise
+    return report, metrics.as_dict()
+
+
+def xlsx_stage(report, xlsx_file, report_time, filename, profile=None, profile_dir=None):
+    """Этап «запись xlsx»: заполнение книги по модели и сохранение. Возвращает метрики этапа."""
+    metrics = StageMetrics(filename, profile=profile, profile_dir=profile_dir)
+    rows = sum(report_rows(report).values())
+    with metrics.stage("fill_template", rows=rows):
+        wb = fill_template(report, Font(bold=True, size=11))
+    with metrics.stage("save_xlsx", rows=rows):
+        save_workbook_stable(wb, xlsx_file, report_time)
+    print("Сохранён Excel-файл:", xlsx_file)
+    return metrics.as_dict()
+
+
+def pdf_stage(report, pdf_file, settings, report_name, report_time, filename, profile=None, profile_dir=None):
+    """
+    Этап «PDF»: экспорт модели отчёта в PDF. Вместо модели можно передать путь к готовому xlsx-отчёту
+    (пересборка только PDF) – тогда книга сначала загружается. Возвращает метрики этапа.
+    """
+    metrics = StageMetrics(filename, profile=profile, profile_dir=profile_dir)
+    if isinstance(report, str):
+        print("Пересборка только PDF по файлу:", report)
+        with metrics.stage("load_workbook") as record:
+            report = load_workbook(report)
+            metrics.rows = report_rows(report)
+            record["rows"] = sum(metrics.rows.values())
+    with metrics.stage("export_to_pdf", rows=sum(report_rows(report).values())):
+        export_to_pdf(report, settings["sheet_order"], pdf_file, settings["header_rows_pdf"],
+                      cover_company=report_name, report_time=report_time,
+                      fast_rows_threshold=settings["pdf_fast_rows_threshold"], workers=settings["pdf_workers"])
+    print("Сохранён PDF-файл:", pdf_file)
+    return metrics.as_dict()
+
+
+def merge_metrics(parts):
+    """Объединяет метрики этапов одного файла (StageMetrics.as_dict) в одну запись."""
+    merged = {"rows": {}, "stages": []}
+    for part in parts:
+        merged["rows"].update(part["rows"])
+        merged["stages"].extend(part["stages"])
+    return merged
+
+
+def process_raw_file(raw_file, template_file, result_folder, settings, report_time, pdf_only=False, profile=None,
+                     outputs=REPORT_OUTPUTS):
+    """
+    Полностью обрабатывает один raw-файл клиента и сохраняет xlsx и PDF в result_folder
+    (outputs – какие из них строить, по умолчанию оба; "xlsx"/"pdf" записи-результата для остальных – None).
+    Если pdf_only=True и xlsx-отчёт уже существует, пересобирается только PDF – по сохранённому xlsx.
+    Ошибки не пробрасываются: функция всегда возвращает запись-результат вида
+        { "file": имя файла, "status": "ok" | "error", "xlsx": путь, "pdf": путь, "error": текст ошибки,
+          "wall": секунды, "cpu": секунды, "metrics": метрики этапов (см. StageMetrics.as_dict) }
+    чтобы один испорченный файл не прерывал обработку всего пакета.
+    profile – хук профилирования этапов (см. StageMetrics); профили cProfile пишутся в result_folder/profiles.
+    Разобранные raw-файлы кэшируются в result_folder/cache (или raw_cache_dir), если включена настройка raw_cache
+    (см. load_raw_columns).
+    Если история включена (history_sheets), в отчёт добавляются столбцы MoM/YTD (см. history_stage), а показатели
+    месяца записываются в result_folder/history.sqlite только после сохранения выходных файлов.
+    Этапы выполняются последовательно; при нескольких файлах и процессах см. run_pipeline.
+    """
+    filename = os.path.basename(raw_file)
+    result = {"file": filename, "status": "ok", "xlsx": None, "pdf": None, "error": None}
+    profile_dir = os.path.join(result_folder, "profiles")
+    cache_dir = raw_cache_dir(result_folder, settings)
+    parts = []
+    report = None
+    history = report_history(result_folder, settings, raw_file, report_time)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        report_name, new_base_name = make_report_base_name(filename, report_time)
         new_xlsx_file = os.path.join(result_folder, new_base_name + ".xlsx")
-        wb.save(new_xlsx_file)
-        print("Сохранён Excel-файл:", new_xlsx_file)
-        # Экспорт в PDF
         new_pdf_file = os.path.join(result_folder, new_base_name + ".pdf")
-        export_to_pdf(wb, sheet_order, new_pdf_file, header_rows_pdf, cover_company=report_name)
-        print("Сохранён PDF-файл:", new_pdf_file)
+
+        if pdf_only and os.path.exists(new_xlsx_file):
+            report = new_xlsx_file
+            result["xlsx"] = new_xlsx_file
+        else:
+            report, build_metrics = build_stage(raw_file, template_file, settings, profile, profile_dir, cache_dir,
+                                                history)
+            parts.append(build_metrics)
+            result["summary"] = report_summary(report)
+            # Сохраняем Excel-файл
+            if "xlsx" in outputs:
+                parts.append(xlsx_stage(report, new_xlsx_file, report_time, filename, profile, profile_dir))
+                result["xlsx"] = new_xlsx_file
+
+        # Экспорт в PDF
+        if "pdf" in outputs:
+            parts.append(pdf_stage(report, new_pdf_file, settings, report_name, report_time, filename, profile,
+                                   profile_dir))
+            result["pdf"] = new_pdf_file
+
+        # Показатели месяца – в историю, когда отчёт уже сохранён
+        if history and isinstance(report, ReportModel):
+            parts.append(record_history_stage(report, history, settings, filename, profile, profile_dir))
+    except Exception:
+        result["status"] = "error"
+        result["error"] = traceback.format_exc()
+        print(f"Ошибка при обработке файла '{filename}':\n{result['error']}")
+    if isinstance(report, ReportModel):
+        report.close()
+    result["wall"] = round(time.perf_counter() - wall_start, 4)
+    result["cpu"] = round(time.process_time() - cpu_start, 4)
+    result["metrics"] = merge_metrics(parts)
+    return result
+
+
+# =============================================================================
+# Конвейер: загрузка, запись xlsx и PDF разных клиентов выполняются одновременно
+# =============================================================================
+def run_pipeline(tasks, template_file, result_folder, settings, report_time, workers, profile=None, max_in_flight=None,
+                 on_result=None, outputs=REPORT_OUTPUTS):
+    """
+    Обрабатывает файлы tasks = [(raw_file, pdf_only) ...] конвейером из трёх этапов, у каждого свой пул процессов
+    из workers процессов:
+        загрузка и вычисления (build_stage) -> запись xlsx (xlsx_stage)
+                                            -> PDF (pdf_stage)
+    Запись xlsx и PDF одного клиента идут параллельно (оба этапа только читают готовую модель), а в это время
+    загружаются следующие клиенты. Модель передаётся между процессами через pickle.
+    max_in_flight (по умолчанию 2 * workers) ограничивает число клиентов на конвейере одновременно –
+    это ограниченная очередь между этапами, чтобы модели не накапливались в памяти.
+    Имена выходных файлов те же, что при последовательной обработке; ошибка этапа отмечается только
+    в записи своего файла (см. process_raw_file). on_result(запись) вызывается, как только файл готов.
+    outputs – какие выходные файлы строить (этап xlsx или PDF, которого нет в outputs, пропускается).
+    Показатели месяца записываются в историю в этом процессе, когда выходные файлы клиента сохранены
+    (см. record_history_stage).
+    Возвращает { имя файла: запись-результат }.
+    """
+    profile_dir = os.path.join(result_folder, "profiles")
+    cache_dir = raw_cache_dir(result_folder, settings)
+    max_in_flight = max_in_flight or 2 * workers
+    queued = list(reversed(tasks))
+    states = {}    # имя файла -> состояние файла на конвейере
+    futures = {}   # future -> (имя файла, этап)
+    results = {}
+
+    def fail(state, stage):
+        state["result"]["status"] = "error"
+        error = f"[{stage}] " + traceback.format_exc()
+        state["result"]["error"] = (state["result"]["error"] or "") + error
+        print(f"Ошибка при обработке файла '{state['result']['file']}':\n{error}")
+
+    with ProcessPoolExecutor(max_workers=workers) as build_pool, \
+            ProcessPoolExecutor(max_workers=workers) as xlsx_pool, \
+            ProcessPoolExecutor(max_workers=workers) as pdf_pool:
+
+        def submit(pool, stage, state, func, *args):
+            # Пул может быть сломан падением процесса (например, нехватка памяти) – это ошибка только этого файла
+            try:
+                future = pool.submit(func, *args)
+            except Exception:
+                fail(state, stage)
+                return
+            futures[future] = (state["result"]["file"], stage)
+            state["remaining"] += 1
+
+        def submit_pdf(state, report):
+            submit(pdf_pool, "pdf", state, pdf_stage, report, state["pdf_file"], settings, state["report_name"],
+                   report_time, state["result"]["file"], profile, profile_dir)
+
+        def start_next():
+            while queued and len(states) < max_in_flight:
+                raw_file, pdf_only = queued.pop()
+                filename = os.path.basename(raw_file)
+                result = {"file": filename, "status": "ok", "xlsx": None, "pdf": None, "error": None}
+                state = {"result": result, "parts": [], "remaining": 0, "start": time.perf_counter()}
+                states[filename] = state
+                try:
+                    state["report_name"], base_name = make_report_base_name(filename, report_time)
+                except Exception:
+                    fail(state, "name")
+                    finish(state)
+                    continue
+                state["xlsx_file"] = os.path.join(result_folder, base_name + ".xlsx")
+                state["pdf_file"] = os.path.join(result_folder, base_name + ".pdf")
+                if pdf_only and os.path.exists(state["xlsx_file"]):
+                    result["xlsx"] = state["xlsx_file"]
+                    submit_pdf(state, state["xlsx_file"])
+                else:
+                    state["history"] = report_history(result_folder, settings, raw_file, report_time)
+                    submit(build_pool, "build", state, build_stage, raw_file, template_file, settings, profile, profile_dir,
+                           cache_dir, state["history"])
+                if state["remaining"] == 0:
+                    finish(state)
+
+        def finish(state):
+            result = state["result"]
+            if "report" in state:
+                report = state.pop("report")
+                # Показатели месяца – в историю, когда xlsx и PDF уже сохранены
+                if state.get("history") and result["status"] == "ok":
+                    try:
+                        state["parts"].append(record_history_stage(report, state["history"], settings,
+                                                                   result["file"], profile, profile_dir))
+                    except Exception:
+                        fail(state, "history")
+                report.close()  # временные файлы режима ограниченной памяти
+            result["wall"] = round(time.perf_counter() - state["start"], 4)
+            result["metrics"] = merge_metrics(state["parts"])
+            result["cpu"] = round(sum(stage["cpu"] for stage in result["metrics"]["stages"]), 4)
+            results[result["file"]] = result
+            del states[result["file"]]
+            if on_result is not None:
+                on_result(result)
+
+        start_next()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename, stage = futures.pop(future)
+                state = states[filename]
+                state["remaining"] -= 1
+                try:
+                    value = future.result()
+                except Exception:
+                    fail(state, stage)
+                else:
+                    if stage == "build":
+                        report, metrics = value
+                        state["report"] = report
+                        state["parts"].append(metrics)
+                        state["result"]["summary"] = report_summary(report)
+                        if "xlsx" in outputs:
+                            submit(xlsx_pool, "xlsx", state, xlsx_stage, report, state["xlsx_file"], report_time,
+                                   filename, profile, profile_dir)
+                        if "pdf" in outputs:
+                            submit_pdf(state, report)
+                    else:
+                        state["parts"].append(value)
+                        state["result"][stage] = state[stage + "_file"]
+                if state["remaining"] == 0:
+                    finish(state)
+            start_next()
+    return results
+
+
+# =============================================================================
+# Сводный отчёт по всем клиентам (roll-up)
+# =============================================================================
+ROLLUP_COMPANY = "All market makers"
+
+
+def report_summary(report):
+    """
+    Числовые значения агрегированных строк модели: { лист: [[заголовок столбца, значение] ...] } – списком пар,
+    чтобы порядок столбцов сохранялся и в манифесте (он пишется с сортировкой ключей).
+    Заголовок – полный путь по заголовочным строкам (см. SheetSchema.header_path), например
+    "Perpetuals / Taker Volume" – в Trading Summary одинаковые нижние заголовки повторяются в разных группах.
+    """
+    summary = {}
+    for name, sheet in report.sheets.items():
+        if not sheet.summary:
+            continue
+        schema = sheet.schema
+        values = []
+        for col, (value, _) in sorted(sheet.summary.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values.append([schema.header_path(col) or schema.label(col) or str(col), value])
+        summary[name] = values
+    return summary
+
+
+class RollupReport:
+    """
+    Сводный отчёт за месяц по всем маркет-мейкерам: для каждого листа с агрегированной строкой –
+    строка на клиента со значениями его строки "Aggregated" и итоговая строка "Total".
+    Клиенты добавляются по мере готовности (add), итоги обновляются сразу; они хранятся точно (Fraction),
+    поэтому не зависят от порядка, в котором клиенты завершились. Выходные файлы клиентов не перечитываются:
+    сводки берутся из моделей (report_summary) или из манифеста для клиентов без изменений.
+    """
+
+    def __init__(self):
+        self.clients = {}  # имя raw-файла -> (имя клиента, сводка)
+        self.totals = {}   # лист -> { столбец: Fraction }
+
+    def add(self, filename, client, summary):
+        """Добавляет (или заменяет) сводку клиента (см. report_summary) и обновляет итоги."""
+        summary = {sheet_name: dict(values) for sheet_name, values in summary.items()}
+        previous = self.clients.get(filename)
+        if previous is not None:
+            self._accumulate(previous[1], -1)
+        self.clients[filename] = (client, summary)
+        self._accumulate(summary, 1)
+
+    def _accumulate(self, summary, sign):
+        for sheet_name, values in summary.items():
+            totals = self.totals.setdefault(sheet_name, {})
+            for column, value in values.items():
+                if math.isfinite(value):
+                    totals[column] = totals.get(column, 0) + sign * Fraction(value)
+
+    def workbook(self, sheet_order):
+        """Книга openpyxl со сводными листами в порядке sheet_order; клиенты – по алфавиту."""
+        wb = Workbook()
+        wb.remove(wb.active)
+        clients = sorted(self.clients.items(), key=lambda item: (item[1][0].lower(), item[0]))
+        bold = Font(bold=True)
+        fill = PatternFill("solid", fgColor="D9D9D9")
+        for sheet_name in sheet_order:
+            if sheet_name not in self.totals:
+                continue
+            columns = []
+            for _, (_, summary) in clients:
+                for column in summary.get(sheet_name, {}):
+                    if column not in columns:
+                        columns.append(column)
+            totals = self.totals[sheet_name]
+
+            ws = wb.create_sheet(sheet_name)
+            ws.append([f"USDT {sheet_name} – {ROLLUP_COMPANY}"])
+            ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(columns) + 1)
+            ws.append(["Client"] + columns)
+            for _, (client, summary) in clients:
+                values = summary.get(sheet_name, {})
+                ws.append([client] + [values.get(column) for column in columns])
+            ws.append(["Total"] + [float(totals[column]) if column in totals else None for column in columns])
+
+            for cell in ws[1] + ws[2] + ws[ws.max_row]:
+                cell.font = bold
+            for cell in ws[2] + ws[ws.max_row]:
+                cell.fill = fill
+            for row in ws.iter_rows(min_row=3, min_col=2):
+                for cell in row:
+                    if isinstance(cell.value, (int, float)):
+                        cell.number_format = NUMBER_FORMAT
+            ws.column_dimensions["A"].width = 16.7109375
+        return wb
+
+    def save(self, result_folder, sheet_order, report_time, outputs=REPORT_OUTPUTS):
+        """
+        Сохраняет сводный отчёт "Coincall Monthly Rollup <МесГГ>" (xlsx и PDF, см. outputs) в result_folder.
+        Возвращает список путей сохранённых файлов.
+        """
+        base_name = os.path.join(result_folder, f"Coincall Monthly Rollup {report_month_suffix(report_time)}")
+        wb = self.workbook(sheet_order)
+        wb.properties.created = report_time
+        saved = []
+        if "xlsx" in outputs:
+            save_workbook_stable(wb, base_name + ".xlsx", report_time)
+            saved.append(base_name + ".xlsx")
+        if "pdf" in outputs:
+            export_to_pdf(wb, wb.sheetnames, base_name + ".pdf", {name: 2 for name in wb.sheetnames},
+                          cover_company=ROLLUP_COMPANY, report_time=report_time)
+            saved.append(base_name + ".pdf")
+        return saved
+
+
+# =============================================================================
+# Главная функция для обработки всех файлов в директории raw_data
+# =============================================================================
+def report_folders(base_folder=BASE_FOLDER, raw_data_dir=None, template_file=None, result_folder=None):
+    """
+    Пути запуска (папка raw-файлов, файл шаблона, папка результатов): по умолчанию raw_data,
+    template/temp1.xlsx и result внутри base_folder; каждый путь можно задать отдельно.
+    Папка результатов создаётся, если её нет.
+    """
+    raw_data_dir = raw_data_dir or os.path.join(base_folder, "raw_data")
+    template_file = template_file or os.path.join(base_folder, "template", "temp1.xlsx")
+    result_folder = result_folder or os.path.join(base_folder, "result")
+    os.makedirs(result_folder, exist_ok=True)
+    return raw_data_dir, template_file, result_folder
+
+
+def list_raw_files(raw_data_dir):
+    """Пути raw-файлов (.xlsx, .csv, .parquet – см. RAW_READERS) в папке raw_data_dir по имени, без временных файлов Excel."""
+    return [os.path.join(raw_data_dir, filename) for filename in sorted(os.listdir(raw_data_dir))
+            if filename.lower().endswith(RAW_EXTENSIONS) and not filename.startswith("~$")]
+
+
+def process_all_raw_files(base_folder=BASE_FOLDER, workers=1, report_time=None, force=False, pdf_only=(), profile=None,
+                          rollup=True, raw_data_dir=None, template_file=None, result_folder=None,
+                          outputs=REPORT_OUTPUTS):
+    """
+    Обрабатывает все raw-файлы (.xlsx, .csv, .parquet – см. RAW_READERS) из base_folder/raw_data
+    и сохраняет отчёты в base_folder/result. Папки и шаблон можно задать отдельно (см. report_folders).
+    workers – число процессов: 1 – последовательная обработка в текущем процессе,
+    None или 0 – по числу ядер, больше 1 – конвейер с пулом из workers процессов на каждый этап (см. run_pipeline).
+    report_time – время отчёта (UTC); по умолчанию текущее. Оно фиксируется один раз на весь запуск,
+    поэтому результат не зависит от числа процессов.
+    Пересборка инкрементальная: в result/manifest.json хранятся хэши raw-файла, шаблона и настроек
+    для каждого клиента, и клиенты без изменений пропускаются (если их показатели за месяц уже есть
+    в истории result/history.sqlite, см. HistoryStore). Если изменились только настройки PDF,
+    пересобирается только PDF. Отчёты со столбцами MoM/YTD пересобираются и при дозаписи или исправлении
+    прошлых месяцев в истории (см. history_plan). force=True пересобирает всё; pdf_only – имена raw-файлов,
+    для которых нужно пересобрать только PDF.
+    По окончании запуска метрики этапов каждого файла (время, CPU, строки, пиковая память) записываются
+    в result/metrics.json и result/metrics.csv; profile – хук профилирования этапов ("cprofile" или "tracemalloc").
+    rollup=True – в конце запуска сохраняется сводный отчёт по всем клиентам (см. RollupReport):
+    сводки агрегированных строк собираются по мере готовности клиентов, для клиентов без изменений –
+    из манифеста, без чтения выходных файлов.
+    outputs – какие выходные файлы строить: ("xlsx",) – без PDF (ReportLab не загружается),
+    ("pdf",) – без записи xlsx; по умолчанию оба.
+    Возвращает список записей-результатов (см. process_raw_file, статус "skipped" – без изменений)
+    в порядке имён файлов.
+    """
+    # Пути к папкам
+    raw_data_dir, template_file, result_folder = report_folders(base_folder, raw_data_dir, template_file, result_folder)
+
+    settings = get_report_settings()
+    if report_time is None:
+        report_time = datetime.datetime.utcnow().replace(microsecond=0)
+
+    raw_files = list_raw_files(raw_data_dir)
+
+    # Выгрузки одного клиента в разных форматах дали бы один и тот же отчёт – берём первую по имени
+    seen_reports = {}
+    for raw_file in list(raw_files):
+        _, base_name = make_report_base_name(os.path.basename(raw_file), report_time)
+        if base_name in seen_reports:
+            print(f"Файл '{os.path.basename(raw_file)}' пропущен: отчёт '{base_name}' уже строится по "
+                  f"'{os.path.basename(seen_reports[base_name])}'.")
+            raw_files.remove(raw_file)
+        else:
+            seen_reports[base_name] = raw_file
+
+    # Решаем по манифесту, что нужно пересобрать
+    manifest = load_manifest(result_folder)
+    pdf_only = {os.path.basename(name) for name in pdf_only}
+    common = common_fingerprints(template_file, settings)
+    # Отчёты зависят и от прошлых месяцев в истории; файлы без записи в истории за месяц пересобираются
+    history_fingerprints, unrecorded = history_plan(result_folder, settings, raw_files, report_time)
+    tasks = []
+    current_entries = {}
+    results_by_file = {}
+    rollup_report = RollupReport()
+
+    def add_to_rollup(result):
+        if result["status"] == "error":
+            return
+        summary = result.get("summary") or (manifest["files"].get(result["file"]) or {}).get("summary")
+        if summary:
+            rollup_report.add(result["file"], make_report_base_name(result["file"], report_time)[0], summary)
+
+    for raw_file in raw_files:
+        filename = os.path.basename(raw_file)
+        action, current = plan_raw_file(raw_file, manifest, common, result_folder, report_time,
+                                        force=force, pdf_only=filename in pdf_only, outputs=outputs,
+                                        history=history_fingerprints.get(filename),
+                                        history_recorded=filename not in unrecorded)
+        current_entries[filename] = current
+        if action == "skip":
+            results_by_file[filename] = {
+                "file": filename, "status": "skipped",
+                "xlsx": os.path.join(result_folder, current["xlsx"]) if "xlsx" in outputs else None,
+                "pdf": os.path.join(result_folder, current["pdf"]) if "pdf" in outputs else None, "error": None}
+            add_to_rollup(results_by_file[filename])
+        else:
+            tasks.append((raw_file, action == "pdf"))
+
+    if not workers:
+        workers = os.cpu_count() or 1
+
+    if workers == 1 or not tasks:
+        for raw_file, pdf_only_task in tasks:
+            result = process_raw_file(raw_file, template_file, result_folder, settings, report_time,
+                                      pdf_only=pdf_only_task, profile=profile, outputs=outputs)
+            results_by_file[result["file"]] = result
+            add_to_rollup(result)
+    else:
+        # Даже для одного файла конвейер полезен: запись xlsx и PDF идут параллельно
+        workers = min(workers, len(tasks))
+        print(f"Конвейерная обработка {len(tasks)} файлов: по {workers} процессов на этап (загрузка, xlsx, PDF).")
+        results_by_file.update(run_pipeline(tasks, template_file, result_folder, settings, report_time, workers,
+                                            profile=profile, on_result=add_to_rollup, outputs=outputs))
+
+    results = [results_by_file[os.path.basename(raw_file)] for raw_file in raw_files]
+
+    # Обновляем манифест: ошибочные файлы удаляются из него, чтобы при следующем запуске они были пересобраны
+    for r in results:
+        record_result(manifest, r, current_entries[r["file"]])
+    save_manifest(result_folder, manifest)
+    # Кэш удалённых raw-файлов больше не нужен
+    if settings["raw_cache"]:
+        prune_raw_cache(raw_cache_dir(result_folder, settings), raw_files)
+
+    write_metrics(result_folder, results, {"report_time": report_time.isoformat(), "workers": workers,
+                                           "profile": profile, "files": len(results), "processed": len(tasks)})
+    if profile == "tracemalloc" and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    if rollup and rollup_report.clients:
+        try:
+            saved = rollup_report.save(result_folder, settings["sheet_order"], report_time, outputs)
+            print(f"Сводный отчёт по {len(rollup_report.clients)} клиентам сохранён: {', '.join(saved)}")
+        except Exception:
+            print(f"Ошибка при сохранении сводного отчёта:\n{traceback.format_exc()}")
+        missing = [r["file"] for r in results if r["status"] != "error" and r["file"] not in rollup_report.clients]
+        if missing:
+            print("Нет сводки агрегированных строк (пересоберите с --force):", ", ".join(missing))
+
+    failed = [r for r in results if r["status"] == "error"]
+    skipped = sum(1 for r in results if r["status"] == "skipped")
+    print(f"Готово: обработано {len(results) - len(failed)} из {len(results)} файлов (без изменений: {skipped}).")
+    for r in failed:
+        print(f"  Ошибка в файле '{r['file']}': {r['error'].strip().splitlines()[-1]}")
+    stages = [stage for r in results for stage in (r.get("metrics") or {}).get("stages", [])]
+    if stages:
+        print("Самые долгие этапы (подробно – в", os.path.join(result_folder, METRICS_JSON_FILE) + "):")
+        for stage in sorted(stages, key=lambda stage: stage["wall"], reverse=True)[:5]:
+            sheet = f" [{stage['sheet']}]" if stage["sheet"] else ""
+            print(f"  {stage['file']}: {stage['stage']}{sheet} – {stage['wall']:.2f} с (CPU {stage['cpu']:.2f} с, строк: {stage['rows']})")
+    return results
+
+# =============================================================================
+# Режим наблюдения за папкой raw_data (демон)
+# =============================================================================
+class WakeUpHandler:
+    """Обработчик событий watchdog: любое изменение в папке будит цикл наблюдения раньше интервала опроса."""
+
+    def __init__(self, event):
+        self.event = event
+
+    def dispatch(self, event):
+        self.event.set()
+
+
+def file_state(path):
+    """(размер, mtime в нс) файла или None, если файла нет."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def warm_worker(template_file, pdf=True):
+    """
+    Инициализация процесса-обработчика в режимах наблюдения и сервиса: шаблон (и при pdf=True – ReportLab
+    со шрифтом) загружается заранее, а Ctrl+C обрабатывает только главный процесс (он завершает пул штатно).
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    load_template(template_file)
+    if pdf:
+        load_reportlab()
+
+
+def raw_file_complete(path):
+    """
+    Грубая проверка, что raw-файл дописан: .xlsx читается как zip-архив, .parquet заканчивается
+    сигнатурой PAR1; для .csv проверки нет – остаётся только пауза debounce.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".xlsx":
+        return is_zipfile(path)
+    if extension == ".parquet":
+        try:
+            with open(path, "rb") as f:
+                f.seek(-4, os.SEEK_END)
+                return f.read(4) == b"PAR1"
+        except OSError:
+            return False
+    return True
+
+
+def watch_raw_files(base_folder=BASE_FOLDER, workers=1, poll_interval=2.0, debounce=3.0, queue_size=16,
+                    profile=None, raw_data_dir=None, template_file=None, result_folder=None, outputs=REPORT_OUTPUTS):
+    """
+    Долгоживущий режим: следит за base_folder/raw_data и собирает отчёт, как только новый или изменённый
+    raw-файл (.xlsx, .csv, .parquet) перестаёт меняться. Процесс остаётся «тёплым»: ReportLab и шрифты загружены
+    заранее (load_reportlab, если outputs включает PDF), шаблон разобран один раз (load_template),
+    а процессы-обработчики при workers > 1 создаются один раз и тоже загружают их при старте.
+    Папки, шаблон и outputs – как в process_all_raw_files.
+      - Изменения обнаруживаются через watchdog (inotify и аналоги), если он установлен, иначе –
+        опросом папки каждые poll_interval секунд.
+      - Файл ставится в очередь, когда его размер и mtime не меняются debounce секунд и он выглядит
+        целым (см. raw_file_complete); временные файлы Excel (~$...) пропускаются.
+      - Очередь ограничена queue_size файлами: если она заполнена, файлы ждут следующего цикла.
+      - Решение о пересборке принимается по манифесту (см. plan_raw_file), как в process_all_raw_files;
+        при изменении шаблона все файлы проверяются заново.
+    Работает до Ctrl+C; метрики обработанных файлов обновляются в result/metrics.json после каждого файла.
+    """
+    raw_data_dir, template_file, result_folder = report_folders(base_folder, raw_data_dir, template_file, result_folder)
+
+    settings = get_report_settings()
+    manifest = load_manifest(result_folder)
+    workers = workers or os.cpu_count() or 1
+    load_template(template_file)
+    if "pdf" in outputs:
+        load_reportlab()
+
+    template_state = None
+    common = None
+    seen = {}         # имя файла -> (размер, mtime) версии, уже поставленной в обработку
+    pending = {}      # имя файла -> ((размер, mtime), момент, с которого версия не меняется)
+    active = set()    # файлы в очереди или в обработке
+    ready = queue.Queue(maxsize=queue_size)
+    running = {}      # future -> (имя файла, запись для манифеста)
+    results = []
+    wake = threading.Event()
+
+    def finish(result, current):
+        active.discard(result["file"])
+        record_result(manifest, result, current)
+        save_manifest(result_folder, manifest)
+        results.append(result)
+        del results[:-1000]  # метрики – только по последним файлам
+        write_metrics(result_folder, results, {"mode": "watch", "workers": workers, "profile": profile,
+                                               "files": len(results), "processed": len(results)})
+        status = "готово" if result["status"] == "ok" else "ошибка"
+        print(f"[{datetime.datetime.now():%H:%M:%S}] {result['file']}: {status} за {result.get('wall', 0):.1f} с")
+
+    observer = None
+    observers = optional_import("watchdog.observers")
+    if observers is not None:
+        observer = observers.Observer()
+        observer.schedule(WakeUpHandler(wake), raw_data_dir)
+        observer.start()
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=warm_worker,
+                                       initargs=(template_file, "pdf" in outputs))
+    print(f"Наблюдение за папкой {raw_data_dir} ({'watchdog' if observer else f'опрос каждые {poll_interval} с'}, "
+          f"процессов: {workers}). Остановка – Ctrl+C.")
+
+    try:
+        while True:
+            now = time.monotonic()
+            state = file_state(template_file)
+            if state != template_state:
+                template_state = state
+                common = common_fingerprints(template_file, settings)
+                seen.clear()  # шаблон изменился – проверить все файлы заново
+
+            # Новые и изменённые файлы ждут, пока перестанут меняться
+            with os.scandir(raw_data_dir) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if not name.lower().endswith(RAW_EXTENSIONS) or name.startswith("~$") or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    state = (stat.st_size, stat.st_mtime_ns)
+                    if seen.get(name) != state and pending.get(name, (None,))[0] != state:
+                        pending[name] = (state, now)
+
+            # Устоявшиеся файлы – в очередь
+            for name, (state, since) in list(pending.items()):
+                if now - since < debounce or name in active:
+                    continue
+                path = os.path.join(raw_data_dir, name)
+                current_state = file_state(path)
+                if current_state is None:
+                    del pending[name]  # файл удалён, пока ждал
+                    continue
+                if current_state != state or not raw_file_complete(path):
+                    pending[name] = (current_state, now)  # файл ещё пишется
+                    continue
+                try:
+                    ready.put_nowait(name)
+                except queue.Full:
+                    break
+                del pending[name]
+                seen[name] = state
+                active.add(name)
+
+            # Запуск обработки из очереди
+            while len(running) < workers and not ready.empty():
+                name = ready.get_nowait()
+                raw_file = os.path.join(raw_data_dir, name)
+                report_time = datetime.datetime.utcnow().replace(microsecond=0)
+                try:
+                    history_fingerprints, unrecorded = history_plan(result_folder, settings, [raw_file], report_time)
+                    action, current = plan_raw_file(raw_file, manifest, common, result_folder, report_time,
+                                                    outputs=outputs, history=history_fingerprints.get(name),
+                                                    history_recorded=name not in unrecorded)
+                except OSError as e:
+                    print(f"Файл '{name}' недоступен: {e}")
+                    active.discard(name)
+                    continue
+                if action == "skip":
+                    print(f"Файл '{name}' не изменился – пропускаем.")
+                    active.discard(name)
+                    continue
+                args = (raw_file, template_file, result_folder, settings, report_time)
+                kwargs = {"pdf_only": action == "pdf", "profile": profile, "outputs": outputs}
+                if executor is None:
+                    finish(process_raw_file(*args, **kwargs), current)
+                else:
+                    running[executor.submit(process_raw_file, *args, **kwargs)] = (name, current)
+
+            # Завершённые задачи
+            for future in [future for future in running if future.done()]:
+                name, current = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    result = {"file": name, "status": "error", "xlsx": None, "pdf": None,
+                              "error": traceback.format_exc()}
+                finish(result, current)
+
+            wake.wait(min(poll_interval, debounce) if pending or running else poll_interval)
+            wake.clear()
+    except KeyboardInterrupt:
+        print("Наблюдение остановлено.")
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+# =============================================================================
+# Сервис отчётов: отчёт одного клиента по запросу (HTTP на localhost или Unix-сокет)
+# =============================================================================
+SERVICE_ADDRESS = "127.0.0.1:8765"
+# Формат отчёта -> тип содержимого ответа
+SERVICE_FORMATS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "pdf": "application/pdf",
+}
+MONTH_RE = re.compile(r"([0-9]{4})-([0-9]{2})$")
+
+
+def month_report_time(month):
+    """
+    Время отчёта за месяц "ГГГГ-ММ": полночь первого дня следующего месяца (UTC) – имя отчёта и обложка
+    относятся к month (см. report_month_suffix). Без месяца – текущее время, как в пакетном режиме.
+    Данные за month здесь не проверяются: сервис принимает только месяц текущих выгрузок (см. ReportRequests).
+    """
+    if not month:
+        return datetime.datetime.utcnow().replace(microsecond=0)
+    match = MONTH_RE.match(month.strip())
+    if not match or not 1 <= int(match.group(2)) <= 12:
+        raise ValueError(f"Месяц '{month}' задаётся в виде ГГГГ-ММ.")
+    year, mon = int(match.group(1)), int(match.group(2))
+    return datetime.datetime(year + mon // 12, mon % 12 + 1, 1)
+
+
+def client_raw_files(raw_data_dir):
+    """
+    Raw-файлы по клиентам: { имя клиента: путь }. Имя клиента – как в имени отчёта (см. make_report_base_name);
+    из нескольких выгрузок одного клиента берётся первая по имени, как в process_all_raw_files.
+    """
+    clients = {}
+    for raw_file in list_raw_files(raw_data_dir):
+        report_name = make_report_base_name(os.path.basename(raw_file), datetime.datetime.utcnow())[0]
+        clients.setdefault(report_name, raw_file)
+    return clients
+
+
+def render_client_report(raw_file, template_file, settings, report_time, fmt, output_dir, cache_dir=None,
+                         history=None):
+    """
+    Строит отчёт одного клиента только в формате fmt ("xlsx" или "pdf") в папке output_dir
+    и возвращает путь к файлу. Выполняется в процессе-обработчике сервиса (см. serve_reports).
+    history – путь к истории показателей для столбцов MoM/YTD (только чтение) или None.
+    """
+    filename = os.path.basename(raw_file)
+    report_name, base_name = make_report_base_name(filename, report_time)
+    output_file = os.path.join(output_dir, f"{base_name}.{fmt}")
+    if history:
+        history = {"file": history, "client": report_name, "month": report_month(report_time), "source": filename,
+                   "record": False}
+    report, _ = build_stage(raw_file, template_file, settings, cache_dir=cache_dir, history=history)
+    try:
+        if fmt == "xlsx":
+            xlsx_stage(report, output_file, report_time, filename)
+        else:
+            pdf_stage(report, output_file, settings, report_name, report_time, filename)
+    finally:
+        report.close()
+    return output_file
+
+
+class ReportRequests:
+    """
+    Запросы к сервису отчётов (см. serve_reports):
+        GET /clients                                          – клиенты, для которых есть raw-файлы (JSON)
+        GET /report?client=Orbit&month=2026-09&format=pdf     – отчёт клиента за месяц (xlsx или pdf)
+    В raw_data лежат только текущие выгрузки клиентов, поэтому month (необязательный) может быть только
+    месяцем этих выгрузок – тем же, что подставляет пакетный режим (см. report_month); за другие месяцы
+    данных нет, и запрос отклоняется, а не отдаёт текущие данные под чужим месяцем.
+    Отчёт строится во временной папке процессом из пула сервиса и отдаётся потоком; ошибки – JSON
+    вида {"error": текст} с кодом 400 (неверный запрос), 404 (нет клиента или данных за месяц)
+    или 500 (ошибка построения).
+    Методы обработчика; сам класс с базовым BaseHTTPRequestHandler создаёт report_server.
+    """
+    server_version = "CoincallReport/1.0"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == "/clients":
+            self.send_json(200, {"clients": sorted(client_raw_files(self.server.raw_data_dir))})
+        elif url.path == "/report":
+            self.send_report(params)
+        else:
+            self.send_json(404, {"error": f"Неизвестный путь '{url.path}'."})
+
+    def send_report(self, params):
+        fmt = params.get("format", "pdf").lower()
+        if fmt not in SERVICE_FORMATS:
+            self.send_json(400, {"error": f"Формат '{fmt}' не поддерживается (xlsx или pdf)."})
+            return
+        try:
+            report_time = month_report_time(params.get("month"))
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        raw_month = report_month(datetime.datetime.utcnow())
+        if report_month(report_time) != raw_month:
+            self.send_json(404, {"error": f"Нет данных за {params['month'].strip()}: raw-файлы содержат выгрузку "
+                                          f"за {raw_month}."})
+            return
+        client = params.get("client", "").strip().capitalize()
+        raw_file = client_raw_files(self.server.raw_data_dir).get(client)
+        if raw_file is None:
+            self.send_json(404, {"error": f"Нет raw-файла для клиента '{client}'."})
+            return
+
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory(prefix="cc_report_") as output_dir:
+            try:
+                output_file = self.server.executor.submit(
+                    render_client_report, raw_file, self.server.template_file, self.server.settings, report_time,
+                    fmt, output_dir, self.server.cache_dir, self.server.history_file).result()
+            except Exception:
+                error = traceback.format_exc()
+                print(f"Ошибка при построении отчёта клиента '{client}':\n{error}")
+                self.send_json(500, {"error": error})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", SERVICE_FORMATS[fmt])
+            self.send_header("Content-Length", str(os.path.getsize(output_file)))
+            self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(os.path.basename(output_file))}")
+            self.send_header("X-Render-Seconds", f"{time.perf_counter() - start:.3f}")
+            self.end_headers()
+            with open(output_file, "rb") as f:
+                shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # У клиента Unix-сокета нет адреса
+        return self.client_address[0] if self.client_address else "unix"
+
+
+def report_server(address):
+    """
+    HTTP-сервер сервиса отчётов на address: "хост:порт" или "unix:путь" (Unix-сокет; сокет от предыдущего
+    запуска удаляется). Каждый запрос обрабатывается в своём потоке. http.server импортируется только здесь.
+    """
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    handler = type("ReportRequestHandler", (ReportRequests, BaseHTTPRequestHandler), {})
+    if address.startswith("unix:"):
+        socket_path = address[len("unix:"):]
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server_class = type("UnixHTTPServer", (socketserver.ThreadingMixIn, socketserver.UnixStreamServer),
+                            {"daemon_threads": True})
+        return server_class(socket_path, handler)
+    host, _, port = address.rpartition(":")
+    return ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+
+
+def serve_reports(base_folder=BASE_FOLDER, address=SERVICE_ADDRESS, workers=1, raw_data_dir=None, template_file=None,
+                  result_folder=None):
+    """
+    Долгоживущий режим сервиса: отчёты отдельных клиентов строятся по запросу (см. ReportRequests).
+    address – "хост:порт" для HTTP или "unix:путь" для Unix-сокета.
+    Сервис остаётся «тёплым»: ReportLab и шрифты загружены (load_reportlab), настройки прочитаны один раз,
+    шаблон разобран до запуска пула (load_template), а процессы-обработчики (workers, 0 – по числу ядер)
+    создаются при старте и обслуживают все запросы. Папки и шаблон – как в process_all_raw_files. Разобранные raw-файлы кэшируются в base_folder/result/cache
+    (настройки raw_cache и raw_cache_dir, см. load_raw_columns), поэтому повторный отчёт клиента не разбирает выгрузку заново.
+    Отчёты строятся во временных папках и в base_folder/result не сохраняются; манифест не меняется,
+    история показателей (result/history.sqlite) только читается – для столбцов MoM/YTD.
+    Работает до Ctrl+C.
+    """
+    raw_data_dir, template_file, result_folder = report_folders(base_folder, raw_data_dir, template_file, result_folder)
+
+    settings = get_report_settings()
+    workers = workers or os.cpu_count() or 1
+    load_template(template_file)
+    load_reportlab()
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=warm_worker, initargs=(template_file,))
+    executor.submit(os.getpid).result()  # процессы создаются сейчас, до запуска потоков сервера
+
+    server = report_server(address)
+    server.raw_data_dir = raw_data_dir
+    server.template_file = template_file
+    server.settings = settings
+    server.cache_dir = raw_cache_dir(result_folder, settings)
+    server.history_file = history_file(result_folder, settings)
+    server.executor = executor
+    print(f"Сервис отчётов: {address} (процессов: {workers}). Запрос: GET /report?client=<клиент>&month=ГГГГ-ММ&format=pdf|xlsx. "
+          f"Остановка – Ctrl+C.")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Сервис остановлен.")
+    finally:
+        server.server_close()
+        executor.shutdown(wait=True, cancel_futures=True)
+        if address.startswith("unix:") and os.path.exists(address[len("unix:"):]):
+            os.remove(address[len("unix:"):])
+
 
 # =============================================================
 # Точка входа в программу
 # =============================================================
 if __name__ == "__main__":
-    process_all_raw_files()
+    parser = argparse.ArgumentParser(description="Генерация ежемесячных отчётов Coincall для маркет-мейкеров.")
+    parser.add_argument("--base-folder", default=BASE_FOLDER,
+                        help="папка с данными: raw_data, template/temp1.xlsx и result внутри неё "
+                             f"(по умолчанию {BASE_FOLDER})")
+    parser.add_argument("--raw-dir", default=None, help="папка raw-файлов (по умолчанию <base-folder>/raw_data)")
+    parser.add_argument("--template", default=None,
+                        help="файл шаблона (по умолчанию <base-folder>/template/temp1.xlsx)")
+    parser.add_argument("--output", default=None, help="папка результатов (по умолчанию <base-folder>/result)")
+    parser.add_argument("--font", default=None,
+                        help=f"файл шрифта Calibri для PDF (по умолчанию {PDF_FONT_FILE} в текущей папке)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="число процессов для пакетной обработки (0 – по числу ядер, по умолчанию 1)")
+    parser.add_argument("--force", action="store_true",
+                        help="пересобрать все отчёты, даже если raw-файлы, шаблон и настройки не изменились")
+    only = parser.add_mutually_exclusive_group()
+    only.add_argument("--xlsx-only", action="store_true",
+                      help="строить только xlsx-отчёты (без PDF; ReportLab не загружается)")
+    only.add_argument("--pdf-only", nargs="?", action="append", default=[], const=True, metavar="RAW_FILE",
+                      help="без аргумента – строить только PDF-отчёты (без записи xlsx); с именем raw-файла – "
+                           "пересобрать только PDF этого файла по сохранённому xlsx (можно указать несколько раз)")
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=None,
+                        help="профилирование этапов: cprofile – профили в result/profiles, "
+                             "tracemalloc – пик памяти Python по этапам (медленнее)")
+    parser.add_argument("--watch", action="store_true",
+                        help="режим наблюдения: обрабатывать новые и изменённые raw-файлы по мере появления")
+    parser.add_argument("--poll-interval", type=float, default=2.0,
+                        help="интервал опроса папки raw_data в режиме --watch, с (по умолчанию 2)")
+    parser.add_argument("--debounce", type=float, default=3.0,
+                        help="сколько секунд файл не должен меняться перед обработкой в режиме --watch (по умолчанию 3)")
+    parser.add_argument("--queue-size", type=int, default=16,
+                        help="максимальная длина очереди файлов в режиме --watch (по умолчанию 16)")
+    parser.add_argument("--no-rollup", action="store_true",
+                        help="не сохранять сводный отчёт по всем клиентам")
+    parser.add_argument("--serve", nargs="?", const=SERVICE_ADDRESS, default=None, metavar="ADDRESS",
+                        help="режим сервиса: отчёты клиентов по запросу на хост:порт или unix:путь "
+                             f"(по умолчанию {SERVICE_ADDRESS}), процессов – --workers")
+    parser.add_argument("--history-backfill", default=None, metavar="ГГГГ-ММ",
+                        help="записать в историю показатели raw-файлов (--raw-dir) за месяц ГГГГ-ММ "
+                             "без построения отчётов, например выгрузки прошлых месяцев")
+    args = parser.parse_args()
+
+    if args.font:
+        # Через переменную окружения путь к шрифту получают и процессы-обработчики
+        os.environ[PDF_FONT_ENV] = PDF_FONT_FILE = os.path.abspath(args.font)
+    outputs = REPORT_OUTPUTS
+    if args.xlsx_only:
+        outputs = ("xlsx",)
+    elif True in args.pdf_only:
+        outputs = ("pdf",)
+    folders = {"raw_data_dir": args.raw_dir, "template_file": args.template, "result_folder": args.output}
+
+    if args.history_backfill:
+        try:
+            month_report_time(args.history_backfill)
+        except ValueError as e:
+            parser.error(str(e))
+        backfill_history(args.history_backfill, args.base_folder, **folders)
+        sys.exit(0)
+    if args.serve:
+        serve_reports(args.base_folder, address=args.serve, workers=args.workers, **folders)
+        sys.exit(0)
+    if args.watch:
+        watch_raw_files(args.base_folder, workers=args.workers, poll_interval=args.poll_interval,
+                        debounce=args.debounce, queue_size=args.queue_size, profile=args.profile, outputs=outputs,
+                        **folders)
+        sys.exit(0)
+    results = process_all_raw_files(args.base_folder, workers=args.workers, force=args.force,
+                                    pdf_only=[name for name in args.pdf_only if name is not True],
+                                    profile=args.profile, rollup=not args.no_rollup, outputs=outputs, **folders)
+    sys.exit(1 if any(r["status"] == "error" for r in results) else 0)
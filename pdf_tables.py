@@ -0,0 +1,73 @@
+"""
+Потоковая таблица PDF для листов с данными на диске (режим ограниченной памяти, см. exporter.SpilledSheetModel).
+Модуль импортирует ReportLab при загрузке, поэтому exporter импортирует его только на пути экспорта в PDF
+(см. exporter.load_reportlab): запуски без PDF ReportLab не загружают.
+"""
+from reportlab.platypus import Flowable, LongTable, TableStyle
+
+
+class SpilledTable(Flowable):
+    """
+    Таблица большого листа с данными на диске (SpilledSheetModel) для режима ограниченной памяти.
+    Строки данных берутся из итератора окнами: для очередной страницы строится LongTable из заголовочных
+    строк и окна строк, от неё отрезается часть, которая помещается на страницу (Table.split), а остаток окна
+    ждёт следующей страницы. В памяти одновременно только заголовок и несколько страниц строк, а страницы
+    выглядят так же, как у одной LongTable с повтором заголовка (режим больших листов, см. export_to_pdf).
+    Готовые страницы ReportLab держит в памяти до записи файла (десятки КБ на страницу) – это единственная
+    часть PDF, которая растёт с числом строк.
+    fill_commands(cell_fills, max_cols) – команды заливки строк окна по [(столбец с 1, строка PDF, цвет) ...]
+    (exporter.background_commands).
+    """
+
+    def __init__(self, header, rows, col_widths, style_commands, fill_commands, window=128):
+        Flowable.__init__(self)
+        self.header = header                  # заголовочные строки (повторяются на каждой странице)
+        self.rows = rows                      # итератор (ячейки строки, [(столбец с 0, цвет заливки) ...])
+        self.col_widths = col_widths
+        self.style_commands = style_commands  # команды стиля таблицы без заливок строк данных
+        self.fill_commands = fill_commands
+        self.window = window
+        self.pending = []
+        self.exhausted = False
+        self.table = None
+
+    def _build_table(self):
+        while not self.exhausted and len(self.pending) < self.window:
+            row = next(self.rows, None)
+            if row is None:
+                self.exhausted = True
+            else:
+                self.pending.append(row)
+        header_count = len(self.header)
+        cell_fills = [(col + 1, i, color) for i, (_, fills) in enumerate(self.pending, start=header_count)
+                      for col, color in fills]
+        commands = self.style_commands + self.fill_commands(cell_fills, len(self.col_widths))
+        table = LongTable(self.header + [cells for cells, _ in self.pending], colWidths=self.col_widths,
+                          repeatRows=header_count)
+        table.setStyle(TableStyle(commands))
+        return table
+
+    def wrap(self, availWidth, availHeight):
+        while True:
+            self.table = self._build_table()
+            width, height = self.table.wrap(availWidth, availHeight)
+            if height > availHeight or self.exhausted:
+                return width, height
+            self.window *= 2  # окно поместилось целиком, а строки ещё есть – берём окно больше
+
+    def split(self, availWidth, availHeight):
+        if self.table is None:
+            self.wrap(availWidth, availHeight)
+        parts = self.table.split(availWidth, availHeight)
+        taken = parts[0]._nrows - len(self.header) if parts else 0
+        if taken <= 0:
+            return []  # на странице не помещается ни одной строки данных – переходим на следующую
+        # Остаток – новая таблица, как у Table.split (ReportLab хранит на разделяемой таблице служебные пометки)
+        rest = SpilledTable(self.header, self.rows, self.col_widths, self.style_commands, self.fill_commands,
+                            self.window)
+        rest.pending = self.pending[taken:]
+        rest.exhausted = self.exhausted
+        return [parts[0], rest]
+
+    def drawOn(self, canvas, x, y, _sW=0):
+        self.table.drawOn(canvas, x, y, _sW)
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import benchmark  # noqa: E402
+import exporter  # noqa: E402
+
+
+@pytest.fixture
+def template_file():
+    """Шаблон отчёта из корня репозитория."""
+    return os.path.join(ROOT, "temp1.xlsx")
+
+
+@pytest.fixture
+def settings():
+    """Настройки по умолчанию (копия на тест – тест может их менять)."""
+    return exporter.get_report_settings()
+
+
+@pytest.fixture
+def make_raw_file(tmp_path):
+    """Синтетический raw-файл клиента (см. benchmark.generate_raw_workbook) в tmp_path/raw_data."""
+    raw_data = tmp_path / "raw_data"
+    raw_data.mkdir(exist_ok=True)
+
+    def make(client="orbit", users=20, positions=40, seed=0):
+        path = str(raw_data / f"mm-monthly-report-{client}.xlsx")
+        benchmark.generate_raw_workbook(path, users, positions, seed=seed)
+        return path
+
+    return make
@@ -0,0 +1,94 @@
+import math
+import os
+
+import pytest
+
+import exporter
+
+HISTORY_COLUMNS = {
+    "Balances": [{"column": "Equity", "ytd": "change"}],
+    "Trading Summary": [{"column": "Aggregated / Total Volume", "ytd": "sum"}],
+}
+
+
+def build_month(raw_file, template_file, settings, history_file, month):
+    """Модель отчёта за month со столбцами MoM/YTD (см. build_stage) и записью месяца в историю."""
+    history = {"file": history_file, "client": "Orbit", "month": month, "source": os.path.basename(raw_file),
+               "record": True}
+    report, _ = exporter.build_stage(raw_file, template_file, settings, history=history)
+    exporter.record_history_stage(report, history, settings, os.path.basename(raw_file))
+    return report
+
+
+def column_values(sheet, header):
+    """{ User ID: значение } столбца header и значение агрегированной строки."""
+    schema = sheet.schema
+    users, values = sheet.numbers(schema.find("User ID")), sheet.numbers(schema.find_path(header))
+    return dict(zip(users, values)), sheet.summary[schema.find_path(header)][0]
+
+
+def test_mom_and_ytd_from_two_months(make_raw_file, template_file, settings, tmp_path):
+    settings["history_sheets"] = ["Balances", "Trading Summary"]
+    settings["history_columns"] = HISTORY_COLUMNS
+    history_file = str(tmp_path / "history.sqlite")
+
+    january = build_month(make_raw_file(seed=0), template_file, settings, history_file, "2026-01")
+    # Прошлых месяцев в истории нет – вид отчёта не меняется
+    assert january["Balances"].schema.find("Equity MoM") is None
+    jan_equity, jan_equity_total = column_values(january["Balances"], "Equity")
+    jan_volume, jan_volume_total = column_values(january["Trading Summary"], "Aggregated / Total Volume")
+    january.close()
+
+    february = build_month(make_raw_file(seed=1), template_file, settings, history_file, "2026-02")
+    try:
+        balances = february["Balances"]
+        equity, equity_total = column_values(balances, "Equity")
+        mom, mom_total = column_values(balances, "Equity MoM")
+        assert mom == {user: pytest.approx(value - jan_equity[user]) for user, value in equity.items()}
+        assert mom_total == pytest.approx(equity_total - jan_equity_total)
+        # Декабря прошлого года в истории нет – YTD пустой
+        ytd, ytd_total = column_values(balances, "Equity YTD")
+        assert all(math.isnan(value) for value in ytd.values()) and ytd_total is None
+
+        trading = february["Trading Summary"]
+        schema = trading.schema
+        volume, volume_total = column_values(trading, "Aggregated / Total Volume")
+        mom, mom_total = column_values(trading, "Aggregated Total Volume MoM")
+        ytd, ytd_total = column_values(trading, "Aggregated Total Volume YTD")
+        assert mom == {user: pytest.approx(value - jan_volume[user]) for user, value in volume.items()}
+        assert ytd == {user: pytest.approx(value + jan_volume[user]) for user, value in volume.items()}
+        assert mom_total == pytest.approx(volume_total - jan_volume_total)
+        assert ytd_total == pytest.approx(volume_total + jan_volume_total)
+        # Столбцы истории стоят после группы "Aggregated", не разрывая её
+        assert (schema.find_path("Aggregated / Maker Volume") < schema.find("Aggregated Total Volume MoM")
+                < schema.find("Aggregated Total Volume YTD") < schema.find_path("Perpetuals / Total Volume"))
+    finally:
+        february.close()
+
+
+def test_history_is_off_by_default(make_raw_file, template_file, settings, tmp_path):
+    result = exporter.process_raw_file(make_raw_file(), template_file, str(tmp_path), settings,
+                                       exporter.month_report_time("2026-02"), outputs=("xlsx",))
+    assert result["status"] == "ok"
+    assert not (tmp_path / exporter.HISTORY_FILE).exists()
+
+
+def test_month_is_recorded_only_after_outputs_are_saved(make_raw_file, template_file, settings, tmp_path,
+                                                        monkeypatch):
+    settings["history_sheets"] = ["Balances"]
+    raw_file = make_raw_file()
+    report_time = exporter.month_report_time("2026-02")
+
+    def failing_xlsx_stage(*args, **kwargs):
+        raise OSError("диск заполнен")
+
+    xlsx_stage = exporter.xlsx_stage
+    monkeypatch.setattr(exporter, "xlsx_stage", failing_xlsx_stage)
+    result = exporter.process_raw_file(raw_file, template_file, str(tmp_path), settings, report_time, outputs=("xlsx",))
+    assert result["status"] == "error"
+    assert exporter.history_plan(str(tmp_path), settings, [raw_file], report_time)[1] == {os.path.basename(raw_file)}
+
+    monkeypatch.setattr(exporter, "xlsx_stage", xlsx_stage)
+    result = exporter.process_raw_file(raw_file, template_file, str(tmp_path), settings, report_time, outputs=("xlsx",))
+    assert result["status"] == "ok"
+    assert exporter.history_plan(str(tmp_path), settings, [raw_file], report_time)[1] == set()
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+import exporter
+
+REPORT_TIME = exporter.month_report_time("2026-02")
+
+
+@pytest.fixture
+def run(make_raw_file, template_file, settings, tmp_path, monkeypatch):
+    """Пакетный запуск над tmp_path (только xlsx, без сводного отчёта): { raw-файл: статус }."""
+    make_raw_file("orbit")
+    make_raw_file("antalpha", seed=1)
+    # Запуск читает настройки сам – тест меняет их через фикстуру settings
+    monkeypatch.setattr(exporter, "get_report_settings", lambda: settings)
+
+    def run():
+        results = exporter.process_all_raw_files(str(tmp_path), report_time=REPORT_TIME, template_file=template_file,
+                                                 rollup=False, outputs=("xlsx",))
+        return {result["file"]: result["status"] for result in results}
+
+    return run
+
+
+def xlsx_files(tmp_path):
+    """{ имя xlsx-отчёта: mtime } в папке результатов."""
+    result = tmp_path / "result"
+    return {name: os.stat(result / name).st_mtime_ns for name in os.listdir(result) if name.endswith(".xlsx")}
+
+
+def test_unchanged_input_is_skipped(run, tmp_path):
+    assert set(run().values()) == {"ok"}
+    before = xlsx_files(tmp_path)
+    assert len(before) == 2
+    assert set(run().values()) == {"skipped"}
+    assert xlsx_files(tmp_path) == before
+
+
+def test_report_config_change_forces_rebuild(run, settings):
+    run()
+    assert "deletion_rules" in exporter.REPORT_CONFIG_KEYS
+    settings["deletion_rules"] = {name: rule for name, rule in settings["deletion_rules"].items() if name != "Positions"}
+    assert set(run().values()) == {"ok"}
+    assert set(run().values()) == {"skipped"}
+
+
+def test_deleted_output_forces_rebuild(run, tmp_path):
+    run()
+    name = next(name for name in xlsx_files(tmp_path) if "Orbit" in name)
+    os.remove(tmp_path / "result" / name)
+    assert run() == {"mm-monthly-report-antalpha.xlsx": "skipped", "mm-monthly-report-orbit.xlsx": "ok"}
+    assert name in xlsx_files(tmp_path)
@@ -0,0 +1,29 @@
+import os
+
+import exporter
+
+REPORT_TIME = exporter.month_report_time("2026-02")
+
+
+def run_batch(raw_data_dir, template_file, result_folder, workers):
+    """Пакетный запуск (xlsx и сводный отчёт): workers=1 – последовательно, иначе конвейер run_pipeline."""
+    results = exporter.process_all_raw_files(raw_data_dir=raw_data_dir, template_file=template_file,
+                                             result_folder=str(result_folder), workers=workers,
+                                             report_time=REPORT_TIME, outputs=("xlsx",))
+    assert {result["status"] for result in results} == {"ok"}
+    return {name: (result_folder / name).read_bytes() for name in sorted(os.listdir(result_folder))
+            if name.endswith(".xlsx")}
+
+
+def test_pipeline_output_does_not_depend_on_workers(make_raw_file, template_file, tmp_path):
+    make_raw_file("orbit", users=30, positions=80)
+    make_raw_file("antalpha", users=40, positions=60, seed=1)
+    raw_data_dir = str(tmp_path / "raw_data")
+
+    serial = run_batch(raw_data_dir, template_file, tmp_path / "serial", workers=1)
+    parallel = run_batch(raw_data_dir, template_file, tmp_path / "parallel", workers=2)
+    # Отчёты двух клиентов и сводный отчёт – байт в байт
+    assert len(serial) == 3 and any(name.startswith("Coincall Monthly Rollup") for name in serial)
+    assert parallel.keys() == serial.keys()
+    for name, data in serial.items():
+        assert parallel[name] == data, name
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+import exporter
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Счётчики разбора raw-файла (load_raw_data) и хэширования (file_sha256)."""
+    counts = {"parse": 0, "sha256": 0}
+    load_raw_data, file_sha256 = exporter.load_raw_data, exporter.file_sha256
+
+    def counting_load(*args, **kwargs):
+        counts["parse"] += 1
+        return load_raw_data(*args, **kwargs)
+
+    def counting_sha256(path):
+        counts["sha256"] += 1
+        return file_sha256(path)
+
+    monkeypatch.setattr(exporter, "load_raw_data", counting_load)
+    monkeypatch.setattr(exporter, "file_sha256", counting_sha256)
+    return counts
+
+
+def load_columns(raw_file, template_file, settings, cache_dir):
+    categories = settings["categories"]
+    numeric_cols = exporter.raw_numeric_columns(template_file, categories, settings["numeric_fields"])
+    return exporter.load_raw_columns(raw_file, categories, settings["deletion_rules"], numeric_cols, cache_dir)
+
+
+def test_cache_is_reused_until_config_changes(make_raw_file, template_file, settings, tmp_path, calls):
+    raw_file = make_raw_file()
+    cache_dir = str(tmp_path / "cache")
+    first = load_columns(raw_file, template_file, settings, cache_dir)
+    assert os.path.exists(exporter.raw_cache_path(cache_dir, raw_file))
+    assert load_columns(raw_file, template_file, settings, cache_dir).keys() == first.keys()
+    assert calls["parse"] == 1
+
+    # Другие правила удаления дублирующих заголовков – другой разбор: кэш не подходит
+    settings["deletion_rules"] = {name: rule for name, rule in settings["deletion_rules"].items() if name != "Positions"}
+    changed = load_columns(raw_file, template_file, settings, cache_dir)
+    assert calls["parse"] == 2
+    assert changed["Positions"][0] > first["Positions"][0]  # дублирующие заголовки Positions остались
+    load_columns(raw_file, template_file, settings, cache_dir)
+    assert calls["parse"] == 2
+
+
+def test_touched_file_is_hashed_once(make_raw_file, template_file, settings, tmp_path, calls):
+    raw_file = make_raw_file()
+    cache_dir = str(tmp_path / "cache")
+    load_columns(raw_file, template_file, settings, cache_dir)
+    st = os.stat(raw_file)
+    os.utime(raw_file, ns=(st.st_atime_ns, st.st_mtime_ns + 5 * 10 ** 9))
+    calls["sha256"] = 0
+
+    # Содержимое то же: кэш используется, а ключ в нём обновляется – следующий запуск не хэширует файл
+    load_columns(raw_file, template_file, settings, cache_dir)
+    assert calls == {"parse": 1, "sha256": 1}
+    load_columns(raw_file, template_file, settings, cache_dir)
+    assert calls == {"parse": 1, "sha256": 1}
+
+    # Изменённое содержимое – разбор заново
+    make_raw_file(seed=1)
+    load_columns(raw_file, template_file, settings, cache_dir)
+    assert calls["parse"] == 2
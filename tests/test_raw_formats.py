@@ -0,0 +1,46 @@
+import csv
+
+from openpyxl import Workbook
+
+import benchmark
+import exporter
+
+
+def write_raw(path, rows):
+    """Строки raw-выгрузки в .xlsx (ячейки с типами как есть) или .csv (всё текстом)."""
+    if path.suffix == ".xlsx":
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Report")
+        for row in rows:
+            ws.append(row)
+        wb.save(path)
+    else:
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            csv.writer(f).writerows(rows)
+
+
+def test_csv_matches_xlsx(template_file, settings, tmp_path):
+    rows = list(benchmark.iter_synthetic_rows(users=10, positions=20))
+    # Инструмент, похожий на десятичную дробь, в текстовом столбце Positions: в .xlsx это строка "100.10"
+    position = next(row for row in rows if len(row) > 1 and row[1] == "BTCUSD-PERP")
+    position[1] = "100.10"
+
+    reports = []
+    try:
+        for extension in (".xlsx", ".csv"):
+            raw_file = tmp_path / f"mm-monthly-report-orbit{extension}"
+            write_raw(raw_file, rows)
+            reports.append(exporter.build_report(str(raw_file), template_file, settings))
+        xlsx_report, csv_report = reports
+        assert csv_report.sheetnames == xlsx_report.sheetnames
+        for name in xlsx_report.sheetnames:
+            xlsx_sheet, csv_sheet = xlsx_report[name], csv_report[name]
+            assert csv_sheet.n_rows == xlsx_sheet.n_rows
+            assert ([csv_sheet.row_cells(i) for i in range(csv_sheet.n_rows)]
+                    == [xlsx_sheet.row_cells(i) for i in range(xlsx_sheet.n_rows)])
+        positions = csv_report["Positions"]
+        col = positions.schema.find("Instrument")
+        assert positions.value(0, col) == "100.10" and not positions.columns[col - 1].is_number(0)
+    finally:
+        for report in reports:
+            report.close()
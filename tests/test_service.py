@@ -0,0 +1,91 @@
+import datetime
+import http.client
+import json
+import threading
+
+import pytest
+from openpyxl import load_workbook
+
+import exporter
+
+
+@pytest.fixture
+def server(make_raw_file, template_file, settings, tmp_path):
+    """Сервис отчётов на свободном порту (без пула: проверяются только отклонённые запросы)."""
+    make_raw_file()
+    server = exporter.report_server("127.0.0.1:0")
+    server.raw_data_dir = str(tmp_path / "raw_data")
+    server.template_file = template_file
+    server.settings = settings
+    server.cache_dir = None
+    server.history_file = None
+    server.executor = None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def get(server, path):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_clients(server):
+    assert get(server, "/clients") == (200, {"clients": ["Orbit"]})
+
+
+@pytest.mark.parametrize("query", ["format=doc", "month=2026-13", "month=sept"])
+def test_bad_request(server, query):
+    status, body = get(server, f"/report?client=orbit&{query}")
+    assert status == 400 and body["error"]
+
+
+def test_month_without_data(server):
+    # В raw_data только выгрузка за месяц пакетного режима – другие месяцы отклоняются, а не подписываются чужими данными
+    month = exporter.previous_month(exporter.report_month(datetime.datetime.utcnow()))
+    status, body = get(server, f"/report?client=orbit&month={month}&format=xlsx")
+    assert status == 404 and month in body["error"]
+
+
+def test_unknown_client(server):
+    status, body = get(server, "/report?client=nobody")
+    assert status == 404 and body["error"]
+
+
+def test_report_reads_history_without_writing(make_raw_file, template_file, settings, tmp_path):
+    raw_file = make_raw_file()
+    settings["history_columns"] = {"Balances": [{"column": "Equity", "ytd": None}]}
+    report_time = exporter.month_report_time("2026-02")
+    history_file = tmp_path / "result" / exporter.HISTORY_FILE
+    history_file.parent.mkdir()
+
+    # Истории нет – сервис её не создаёт
+    exporter.render_client_report(raw_file, template_file, settings, report_time, "xlsx", str(tmp_path),
+                                  history=str(history_file))
+    assert not history_file.exists()
+
+    # История есть – только читается: файл и папка не меняются
+    store = exporter.HistoryStore(str(history_file))
+    store.record("Orbit", "2026-01", "january.xlsx", {("Balances", "Equity", "100000"): 1.0})
+    store.close()
+    before = sorted(history_file.parent.iterdir()), history_file.stat().st_mtime_ns, history_file.read_bytes()
+    output_file = exporter.render_client_report(raw_file, template_file, settings, report_time, "xlsx",
+                                                str(tmp_path), history=str(history_file))
+    header = [cell.value for row in load_workbook(output_file)["Balances"].iter_rows(max_row=2) for cell in row]
+    assert "Equity MoM" in header
+    assert (sorted(history_file.parent.iterdir()), history_file.stat().st_mtime_ns, history_file.read_bytes()) == before
+    store = exporter.HistoryStore(str(history_file), readonly=True)
+    try:
+        assert store.months("Orbit", "2026-01", "2026-12") == ["2026-01"]  # месяц отчёта не записан
+        with pytest.raises(Exception):
+            store.record("Orbit", "2026-02", "february.xlsx", {})
+    finally:
+        store.close()
@@ -0,0 +1,42 @@
+import pytest
+
+import exporter
+
+
+def sheet_rows(sheet):
+    """Строки данных листа по порциям (column_chunks): [[значение столбца ...] ...]."""
+    rows = []
+    for n, columns in sheet.column_chunks():
+        rows.extend([column[i] for column in columns] for i in range(n))
+    return rows
+
+
+def test_spilled_report_matches_in_memory(make_raw_file, template_file, settings, tmp_path):
+    # Antalpha – с производным столбцом "Trading credits", который в режиме ограниченной памяти считается по порциям
+    raw_file = make_raw_file("antalpha", users=600, positions=1500)
+    report = exporter.build_report(raw_file, template_file, settings)
+    settings["memory_budget_mb"] = 0.01
+    settings["spill_dir"] = str(tmp_path)
+    spilled = exporter.build_report(raw_file, template_file, settings)
+    try:
+        assert spilled.sheetnames == report.sheetnames
+        for name in report.sheetnames:
+            sheet, spilled_sheet = report[name], spilled[name]
+            assert isinstance(spilled_sheet, exporter.SpilledSheetModel)
+            assert spilled_sheet.n_rows > spilled_sheet.store.chunk_rows  # данные действительно в нескольких порциях
+            assert ([spilled_sheet.schema.label(col) for col in range(1, spilled_sheet.width + 1)]
+                    == [sheet.schema.label(col) for col in range(1, sheet.width + 1)])
+            assert sheet_rows(spilled_sheet) == sheet_rows(sheet)
+            assert (spilled_sheet.summary is None) == (sheet.summary is None)
+            if sheet.summary is not None:
+                assert spilled_sheet.summary.keys() == sheet.summary.keys()
+                for col, (value, number_format) in sheet.summary.items():
+                    assert spilled_sheet.summary[col][1] == number_format
+                    if isinstance(value, float):
+                        # Порции суммируются по отдельности – порядок сложения другой
+                        assert spilled_sheet.summary[col][0] == pytest.approx(value, rel=1e-12)
+                    else:
+                        assert spilled_sheet.summary[col][0] == value
+    finally:
+        spilled.close()
+        report.close()